@@ -21,21 +21,476 @@
 '''
 # pylint: disable=no-self-use, star-args
 
+__version__ = '0.2'
+
 ################################################################################
 # Exceptions:
 
+from array import array
+from bisect import bisect_right
+import hashlib
+from itertools import izip
+import marshal
+import os
+import re
+import sys
+import threading
+import time
 from types import GeneratorType
 
 class NotHere(Exception):
     ''' attempted to parse what you asked for, but there ain't one here.
         this is the primary mechanism for returning after a 'forward parse'
-        attempt.'''
-    pass
+        attempt.
+
+        Almost all of these are caught (by Either, Multiple...) and thrown
+        away, so the message is only formatted if someone actually wants it:
+        NotHere('Expected "%s"', word) '''
+
+    def __str__(self):
+        if len(self.args) > 1:
+            return self.args[0] % self.args[1:]
+        return Exception.__str__(self)
+
+class ParseError(NotHere):
+    ''' the parse as a whole failed.  Reports the furthest position that any
+        parser got to, and what would have been accepted there. '''
+
+    def __init__(self, session):
+        NotHere.__init__(self)
+        self.session = session
+        self.position = session.furthest
+        self.expected = set(session.expected)
+        self.line, self.column = session.location(self.position)
+
+    def __str__(self):
+        found = self.session.text[self.position:self.position + 10]
+        return 'line %i, column %i: expected %s, found %s' % (
+            self.line, self.column,
+            ' or '.join(sorted(repr(p) for p in self.expected)) or 'nothing',
+            repr(found) if found else 'end of text')
+
+class BudgetExceeded(Exception):
+    ''' a Session ran out of steps, nodes or time before the parse finished.
+        (Deliberately not a NotHere, so that nothing will catch it and try
+        something else instead.) '''
+
+    def __init__(self, session, reason):
+        Exception.__init__(self, reason)
+        self.session = session
+        self.reason = reason
+        self.position = max(session.reached, session.furthest)
+        self.line, self.column = session.location(self.position)
+
+    def __str__(self):
+        return 'parse budget exceeded (%s) at line %i, column %i, ' \
+               'after %i steps and %i nodes' % (
+                   self.reason, self.line, self.column,
+                   self.session.steps, self.session.nodes)
+
+class ParseCancelled(Exception):
+    ''' a ParseTask was cancelled before it finished. '''
 
 class TooGeneric(Exception):
     ''' when a method needs to be implemented for consistency, but really
         should never occur, as a more specific parser should be used... '''
 
+################################################################################
+# Parse sessions:
+#
+# Everything about one particular parse of one particular text (rather than
+# about the grammar) lives in a Session.  The current one is kept per thread.
+
+class _State(threading.local):
+    ''' the session currently in use on this thread (if any) '''
+    session = None
+
+    def __init__(self):
+        threading.local.__init__(self)
+        # Either's recursion guard, for parses outside of any session:
+        self.current_parses = {}
+
+_state = _State()
+
+class LineIndex(object):
+    ''' where each line of a text starts, so that positions can be turned into
+        (line, column) and back again quickly.  (Lines and columns both count
+        from 1.) '''
+
+    def __init__(self, text):
+        self.starts = [0]
+        newline = text.find('\n')
+        while newline != -1:
+            self.starts.append(newline + 1)
+            newline = text.find('\n', newline + 1)
+
+    def location(self, position):
+        ''' (line, column) of position. '''
+        line = bisect_right(self.starts, position)
+        return line, position - self.starts[line - 1] + 1
+
+    def offset(self, line, column=1):
+        ''' the position of (line, column). '''
+        if not 1 <= line <= len(self.starts):
+            raise IndexError('there is no line %i' % line)
+        return self.starts[line - 1] + column - 1
+
+class Session(object):
+    ''' state for parsing one text.  Use session.parse(parser) rather than
+        parser.parse(text) to get a ParseError explaining where & why the
+        parse failed.
+
+        To bound how long a parse can take, give any of:
+            max_steps - how many times the combining parsers (Joined, Either,
+                        Multiple...) may be run,
+            max_nodes - how many tree nodes may be built (including the ones
+                        thrown away when backtracking),
+            timeout   - seconds (wall clock) the parse may take.
+        and a BudgetExceeded will be raised if the parse goes over.
+
+        With recover=True, lists which know how to get past a syntax error
+        (Multiple(..., recover=Resync(...))) skip over the bad text, as an
+        error node, and carry on - so one parse finds every error (in
+        session.errors, as ParseErrors) rather than just the first.
+
+        With lazy=True, Lazy parsers only find where their part ends, and
+        leave the real parse until their node is first looked in. '''
+
+    # how many steps between looking at the clock:
+    check_every = 256
+
+    def __init__(self, text, max_steps=None, max_nodes=None, timeout=None,
+                 recover=False, lazy=False):
+        self.text = text
+        # furthest position that any parser failed at, and which parsers
+        # failed there.  (only references kept - no messages built.)
+        self.furthest = -1
+        self.expected = []
+        self._expecting = set()     # (the same parsers, to skip repeats)
+
+        # Either's recursion guard:
+        self.current_parses = {}
+
+        # budget:
+        self.steps = 0
+        self.nodes = 0
+        self.reached = 0
+        self.max_steps = max_steps
+        self.max_nodes = max_nodes
+        self.deadline = None if timeout is None else time.time() + timeout
+        self._next_check = self._check_at()
+
+        # error recovery:
+        self.recover = recover
+        self.errors = []
+
+        self.lazy = lazy
+
+        self._lines = None
+
+    @property
+    def lines(self):
+        ''' a LineIndex of the text (only made when first wanted). '''
+        if self._lines is None:
+            self._lines = LineIndex(self.text)
+        return self._lines
+
+    def parse(self, parser, position=0):
+        ''' parser.parse(self.text, position), within this session.  (when
+            recovering, the errors skipped over in the tree it returns are
+            then in self.errors.) '''
+        result = self._run(parser.parse, position)
+        if self.recover:
+            self.errors = [node['error'] for node, _, _
+                           in spans(result[1], position) if 'error' in node]
+        return result
+
+    def match(self, parser, position=0):
+        ''' parser.match(self.text, position), within this session. '''
+        return self._run(parser.match, position)
+
+    def _run(self, method, position):
+        previous = _state.session
+        _state.session = self
+        try:
+            return method(self.text, position)
+        except ParseError:
+            raise
+        except NotHere:
+            self._refine()
+            raise ParseError(self)
+        finally:
+            _state.session = previous
+
+    def step(self, position, nodes=0):
+        ''' a parser is being run at position, and will build nodes (tree
+            nodes).  This is called a *lot*, so the budget is only actually
+            looked at every so often (see checkpoint). '''
+        self.steps += 1
+        self.nodes += nodes
+        if position > self.reached:
+            self.reached = position
+        if self.steps >= self._next_check:
+            self.checkpoint()
+
+    def checkpoint(self):
+        ''' raise BudgetExceeded if the parse has gone over budget. '''
+        if self.max_steps is not None and self.steps > self.max_steps:
+            raise BudgetExceeded(self, 'steps')
+        if self.max_nodes is not None and self.nodes > self.max_nodes:
+            raise BudgetExceeded(self, 'nodes')
+        if self.deadline is not None and time.time() > self.deadline:
+            raise BudgetExceeded(self, 'time')
+
+        self._next_check = self._check_at()
+
+    def _check_at(self):
+        ''' when should checkpoint next be called? '''
+        next_check = self.steps + self.check_every
+        if self.max_steps is not None:
+            return min(next_check, self.max_steps + 1)
+        return next_check
+
+    def expect(self, parser, position):
+        ''' parser failed at position. '''
+        if position > self.furthest:
+            self.furthest = position
+            self.expected = [parser]
+            self._expecting = set([parser])
+        elif position == self.furthest and parser not in self._expecting:
+            self._expecting.add(parser)
+            self.expected.append(parser)
+
+    def _forget(self, position=-1):
+        ''' start again, with nothing expected (yet) at position. '''
+        self.furthest, self.expected, self._expecting = position, [], set()
+
+    def _saved(self):
+        ''' what's been expected so far, to be put back by _restore. '''
+        return (self.furthest, self.expected, self._expecting,
+                len(self.expected))
+
+    def _restore(self, saved):
+        ''' put back what was expected when saved was _saved (without
+            copying it all each time). '''
+        furthest, expected, expecting, count = saved
+        for parser in expected[count:]:
+            expecting.discard(parser)
+        del expected[count:]
+        self.furthest, self.expected, self._expecting = \
+            furthest, expected, expecting
+
+    def _refine(self):
+        ''' fused parsers (see fuse) only report that they failed as a whole,
+            from where they started.  Once the parse has failed, re-run the
+            ones that failed furthest along with the plain parsers, to find
+            exactly which part of them failed, and where. '''
+        position = self.furthest
+        fused = set(p for p in self.expected if _fused(p))
+        for parser in fused:
+            try:
+                _parse_owner(parser).parse(parser, self.text, position)
+            except NotHere:
+                pass
+        if self.furthest == position:
+            self.expected = [p for p in self.expected if p not in fused]
+            self._expecting -= fused
+
+    def location(self, position):
+        ''' (line, column) of a position in the text, both counting from 1 '''
+        return self.lines.location(position)
+
+    def recover_from(self, resync, text, position):
+        ''' a list couldn't carry on at position:  skip over the bad text
+            there with resync, and return (length, error node) - or (0, None)
+            if there's nothing to skip (it's just the end of the list).  The
+            error node has the ParseError as its 'error'. '''
+        # (what resync tries along the way isn't what was expected here)
+        saved = self._saved()
+        try:
+            length, node = resync.parse(text, position)
+        except NotHere:
+            return 0, None
+        finally:
+            self._restore(saved)
+
+        if self.furthest < position:
+            self._forget(position)
+        self._refine()
+        node['error'] = ParseError(self)
+
+        # (the next error is a new one:)
+        self._forget()
+        return length, node
+
+def _expected(parser, text, position):
+    ''' tell the current session (if there is one) that parser failed. '''
+    session = _state.session
+    if session is not None and session.text is text:
+        session.expect(parser, position)
+
+class _TaskSession(Session):
+    ''' a Session which hands control back to its ParseTask every so often '''
+
+    def __init__(self, work, text, **budget):
+        Session.__init__(self, text, **budget)
+        self.work = work
+
+    def checkpoint(self):
+        Session.checkpoint(self)
+        self.work.pause(self)
+
+class _TaskWork(object):
+    ''' the helper thread's side of a ParseTask.  (kept apart, so that the
+        thread never holds on to the ParseTask itself - which can then be
+        cleaned up if it's dropped half way through.) '''
+
+    def __init__(self, steps, chars, position):
+        self.steps = steps
+        self.chars = chars
+        self.done = False
+        self.cancelled = False
+        self.result = None
+        self.error = None
+        self.paused_at = (0, position)
+        self.resume = threading.Semaphore(0)
+        self.paused = threading.Semaphore(0)
+
+    def run(self, session, parser, position):
+        ''' (in the parsing thread) the whole parse. '''
+        try:
+            self.result = session.parse(parser, position)
+        except Exception as err:  # pylint: disable=broad-except
+            self.error = err
+        finally:
+            self.done = True
+            self.paused.release()
+
+    def pause(self, session):
+        ''' (in the parsing thread) hand control back to step(), if it's
+            time to. '''
+        steps, reached = self.paused_at
+        if session.steps - steps >= self.steps \
+        or (self.chars is not None
+                and session.reached - reached >= self.chars):
+            self.paused_at = (session.steps, session.reached)
+            self.paused.release()
+            self.resume.acquire()
+
+        if self.cancelled:
+            raise ParseCancelled()
+
+class ParseTask(object):
+    ''' a parse which is done a bit at a time, whenever step() is called, so
+        that (for instance) an event loop can get on with other things in
+        between.  Control comes back after every `steps` parser steps, or
+        (if given) once the parse has got `chars` characters further along.
+
+            with ParseTask(PHP_BLOCK, text, steps=1000) as task:
+                while task.step():
+                    print task.progress     # (or: await asyncio.sleep(0))
+                length, tree = task.result()
+
+        The parse itself runs in a helper thread, but only ever while step()
+        is waiting for it, so only one of them is actually running at once.
+        A task must be finished (result(), or step() until it's done) or
+        cancel()led - or close()d, which cancels it if need be, as leaving
+        the `with` does.  (a task which is just dropped is closed when it's
+        garbage collected.)  Otherwise its thread waits for ever, holding on
+        to the text and everything parsed so far.  Any other keyword
+        arguments (max_steps, timeout...) are passed on to the Session. '''
+
+    def __init__(self, parser, text, position=0, steps=1000, chars=None,
+                 **budget):
+        self.parser = parser
+        self.position = position
+        self.steps = steps
+        self.chars = chars
+
+        self._work = _TaskWork(steps, chars, position)
+        self.session = _TaskSession(self._work, text, **budget)
+        if chars is not None:
+            self.session.check_every = min(steps, 64)
+        else:
+            self.session.check_every = steps
+        self.session._next_check = self.session._check_at()  # pylint: disable=protected-access
+
+        self._thread = None
+
+    @property
+    def done(self):
+        ''' has the parse finished (or been cancelled)? '''
+        return self._work.done
+
+    @property
+    def cancelled(self):
+        ''' has cancel() been called? '''
+        return self._work.cancelled
+
+    @property
+    def progress(self):
+        ''' roughly how much of the text (0.0 to 1.0) has been parsed. '''
+        if self.done or not self.session.text:
+            return 1.0
+        return float(self.session.reached) / len(self.session.text)
+
+    def step(self):
+        ''' carry on parsing until the next pause.  Returns True if there is
+            still more to do. '''
+        work = self._work
+        if work.done:
+            return False
+
+        if self._thread is None:
+            self._thread = threading.Thread(
+                target=work.run, args=(self.session, self.parser,
+                                       self.position))
+            self._thread.daemon = True
+            self._thread.start()
+        else:
+            work.resume.release()
+
+        work.paused.acquire()
+        return not work.done
+
+    def cancel(self):
+        ''' stop the parse.  result() will raise ParseCancelled. '''
+        work = self._work
+        work.cancelled = True
+        if self._thread is None:
+            work.error = ParseCancelled()
+            work.done = True
+        elif not work.done:
+            self.step()
+
+    def close(self):
+        ''' cancel the parse, if it hasn't finished - and let its thread go. '''
+        if not self.done:
+            self.cancel()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __del__(self):
+        if '_thread' in vars(self):
+            self.close()
+
+    def result(self):
+        ''' (length, tree) - parsing whatever is left first, if need be.
+            Raises whatever the parse raised (ParseError, ...) '''
+        while self.step():
+            pass
+
+        if self._work.error is not None:
+            raise self._work.error
+        return self._work.result
+
 class Parsable(object):
     ''' base class for all parsers '''
 
@@ -56,6 +511,13 @@ class Parsable(object):
             exception if it's not possible to parse one of these here. '''
         raise TooGeneric('Parsable!')
 
+    def match(self, text, position=0):
+        ''' just recognise an instance in text, at position: return the length
+            of it (or raise NotHere), without building any tree.  Parsers
+            which don't have a quicker way just parse it, and throw the tree
+            away. '''
+        return self.parse(text, position)[0]
+
     def output(self, data, clean=False):  #pylint: disable=unused-argument
         ''' return the textual version of this parsable.  If 'clean' is false,
             then return it unchanged.  If 'clean' is true, then return it in
@@ -66,6 +528,10 @@ class Parsable(object):
         raise TooGeneric('class "%s" has no "output" method defined!'
                          % data['class'])
 
+    def subparsers(self):
+        ''' the parsers which this one is built from (if any). '''
+        return ()
+
 
 class Either(Parsable):
     ''' Join mulitple parsers, any one of them can match '''
@@ -74,7 +540,6 @@ class Either(Parsable):
     def __init__(self, *options):
         self.options = []
         add_nothing = False
-        self.current_parses = {}
 
         for option in options:
             if isinstance(option, str):
@@ -113,32 +578,78 @@ class Either(Parsable):
 
 
     def parse(self, text, position=0):
-        if (text, position) in self.current_parses:
-            raise NotHere('Recursive Either... (%s)(%i)' % (text, position))
-        self.current_parses[(text, position)] = True
+        session = _state.session
+        if session is not None:
+            session.step(position)
+            current_parses = session.current_parses
+        else:
+            current_parses = _state.current_parses
+
+        # (Grammars are shared between threads, so this lives in the
+        #  session / thread, not in self)
+        key = (self, text, position)
+        if key in current_parses:
+            raise NotHere('Recursive Either... (%s)(%i)', text, position)
+        current_parses[key] = True
 
         # If an option returns a Nothing (doesn't consume any text) then it
         # may be valid, but we should try later options before accepting it.
         result = False
 
-        for option in self.options:
-            try:
-                result = option.parse(text, position)
-                if result[0]:
-                    break
-            except NotHere:
-                continue
+        try:
+            for option in self.options:
+                try:
+                    result = option.parse(text, position)
+                    if result[0]:
+                        break
+                except NotHere:
+                    continue
+        finally:
+            del current_parses[key]
 
-        del self.current_parses[(text, position)]
         if result != False:
             return result
 
-        raise NotHere("%s:%s:%i" % (repr(self), text, position))
+        raise NotHere('%r:%s:%i', self, text, position)
+
+    def match(self, text, position=0):
+        session = _state.session
+        if session is not None:
+            session.step(position)
+            current_parses = session.current_parses
+        else:
+            current_parses = _state.current_parses
+
+        key = (self, text, position)
+        if key in current_parses:
+            raise NotHere('Recursive Either... (%s)(%i)', text, position)
+        current_parses[key] = True
+
+        result = None
+
+        try:
+            for option in self.options:
+                try:
+                    result = option.match(text, position)
+                    if result:
+                        break
+                except NotHere:
+                    continue
+        finally:
+            del current_parses[key]
+
+        if result is not None:
+            return result
+
+        raise NotHere('%r:%s:%i', self, text, position)
 
     def output(self, data, clean=False):
         raise TooGeneric('This is inside an Either!  It should have given '
                          'a more specific reply!')
 
+    def subparsers(self):
+        return self.options
+
 class Nothing(Parsable):
     ''' a 'NULL' parser, which parses nothing, and returns nothing. '''
     def __init__(self):
@@ -160,11 +671,12 @@ class SingleChar(Parsable):
         try:
             if text[position] == self.letter:
                 return 1, self.data
-            else:
-                raise NotHere('Expected "%s", got "%s"' %
-                                (self.letter, text[position]))
         except IndexError:
-            raise NotHere('EOF! Expected "%s"' % self.letter)
+            _expected(self, text, position)
+            raise NotHere('EOF! Expected "%s"', self.letter)
+
+        _expected(self, text, position)
+        raise NotHere('Expected "%s", got "%s"', self.letter, text[position])
 
 class SpecificWord(Parsable):
     ''' parse a specific word '''
@@ -178,9 +690,9 @@ class SpecificWord(Parsable):
         if text[position:position + self.length] == self.word:
             return self.length, self.data
         else:
-            raise NotHere('Expected "%s", instead found: "%s"'
-                          % (self.word,
-                             text[position:position + len(self.word)]))
+            _expected(self, text, position)
+            raise NotHere('Expected "%s", instead found: "%s"', self.word,
+                          text[position:position + self.length])
 
 
 class Word(Parsable):
@@ -192,7 +704,11 @@ class Word(Parsable):
         self.word = ''
 
     def parse(self, text, position=0):
-        data = {'class': self}
+        length = self.match(text, position)
+        return length, {'class': self,
+                        'text': text[position:position+length]}
+
+    def match(self, text, position=0):
         length = 0
         try:
             while text[position + length] in self.chrs:
@@ -200,12 +716,13 @@ class Word(Parsable):
                 continue
         except IndexError:
             if not length:
+                _expected(self, text, position)
                 raise NotHere('EOF!')
         if not length:
+            _expected(self, text, position)
             raise NotHere()
 
-        data['text'] = text[position:position+length]
-        return length, data
+        return length
 
 class Joined(Parsable):
     ''' Join multiple parsers together, without spaces '''
@@ -235,6 +752,10 @@ class Joined(Parsable):
 
 
     def parse(self, text, position=0):
+        session = _state.session
+        if session is not None:
+            session.step(position, len(self.parts))
+
         data = {'class': self,
                 'parts': []}
 
@@ -246,43 +767,83 @@ class Joined(Parsable):
 
         return total_length, data
 
+    def match(self, text, position=0):
+        session = _state.session
+        if session is not None:
+            session.step(position)
+
+        total_length = 0
+        for part in self.parts:
+            total_length += part.match(text, position + total_length)
+
+        return total_length
+
     def output(self, data, clean=False):
-        return ''.join(p['class'].output(p, clean) for p in data['parts'])
+        return ''.join(output(p, clean) for p in data['parts'])
+
+    def subparsers(self):
+        return self.parts
 
 class NamedJoin(Joined):
     ''' join a group of things, giving them names along the way. '''
+    def __init__(self, *parts):
+        self.parts = []
+        for name, part in parts:
+            if isinstance(part, str):
+                part = SpecificWord(part)
+            self.parts.append((name, part))
+
     def parse(self, text, position=0):
+        session = _state.session
+        if session is not None:
+            session.step(position, len(self.parts))
+
         data = {'class': self,
                 'parts': {}}
         total_length = 0
         for name, part in self.parts:
-            if type(part) == str:
-                part = SpecificWord(part)
             length, part_data = part.parse(text, position + total_length)
             total_length += length
             data['parts'][name] = part_data
 
         return total_length, data
 
+    def match(self, text, position=0):
+        session = _state.session
+        if session is not None:
+            session.step(position)
+
+        total_length = 0
+        for _, part in self.parts:
+            total_length += part.match(text, position + total_length)
+
+        return total_length
+
     def output(self, data, clean=False):
         to_return = []
         for k, v in self.parts:
             if k in data['parts']:
-                to_return.append(data['parts'][k]['class'].output(data['parts'][k], clean))
+                to_return.append(output(data['parts'][k], clean))
 
         return ''.join(to_return)
 
     def __repr__(self):
         return '<NamedJoin:(%s)>' % ('+'.join([k for k,v in self.parts]))
 
+    def subparsers(self):
+        return [part for _, part in self.parts]
+
 
 class Multiple(Joined):
-    ''' accept multiple of a parsable. '''
-    def __init__(self, original, allow_none=True):
+    ''' accept multiple of a parsable.  If recover (a Resync) is given, and
+        the session is recovering from errors, then where original doesn't
+        match, the bad text is skipped over with recover (see Session). '''
+    def __init__(self, original, allow_none=True, recover=None):
         assert allow_none in (True, False)
 
         self.original = original
         self.allow_none = allow_none
+        self.recover = recover
 
     def __repr__(self):
         try:
@@ -293,25 +854,255 @@ class Multiple(Joined):
 
 
     def parse(self, text, position=0):
+        session = _state.session
+        if session is not None:
+            session.step(position)
+
+        recovering = self.recover is not None and session is not None \
+                     and session.recover
 
         data = {'class': self, 'parts': []}
         i = 0
         while True:
             try:
                 part_length, part_data = self.original.parse(text, position + i)
-                if part_length == 0:
-                    # should we add the last Nothing item?
-                    break
-                data['parts'].append(part_data)
-                i += part_length
             except NotHere:
+                part_length = 0
+            if part_length == 0 and recovering:
+                part_length, part_data = session.recover_from(
+                    self.recover, text, position + i)
+            if part_length == 0:
+                # should we add the last Nothing item?
                 break
+            data['parts'].append(part_data)
+            i += part_length
+
+        if session is not None:
+            session.nodes += len(data['parts'])
 
         if data['parts'] == [] and not self.allow_none:
-            raise
+            _expected(self.original, text, position)
+            raise NotHere('Expected at least one %r', self.original)
         else:
             return i, data
 
+    def match(self, text, position=0):
+        session = _state.session
+        if session is not None:
+            session.step(position)
+
+        i = 0
+        while True:
+            try:
+                part_length = self.original.match(text, position + i)
+            except NotHere:
+                break
+            if part_length == 0:
+                break
+            i += part_length
+
+        if not i and not self.allow_none:
+            raise NotHere('Expected at least one %r', self.original)
+        return i
+
+    def subparsers(self):
+        if self.recover is not None:
+            return (self.original, self.recover)
+        return (self.original, )
+
+class Skipper(Multiple):
+    ''' a Multiple for skipping trivia (whitespace, comments...), which gives
+        the same tree as Multiple(original), but is quicker about it:  the
+        options of original are picked by the character they start with, in
+        one loop, and when there's no trivia at all (as is usual) the same
+        empty node is returned every time. '''
+
+    def __init__(self, original):
+        super(Skipper, self).__init__(original)
+        self.empty = {'class': self, 'parts': []}
+        self._dispatch = None
+
+    def dispatch(self):
+        ''' {first character: (options which could start with it)}, or None
+            if we can't tell what some option starts with. '''
+        if self._dispatch is None:
+            options = self.original.options \
+                if _parse_owner(self.original) is Either else [self.original]
+            firsts = [(option, _first_chars(option)) for option in options]
+            if any(first is None for _, first in firsts):
+                self._dispatch = False
+            else:
+                dispatch = {}
+                for option, first in firsts:
+                    for char in first:
+                        dispatch.setdefault(char, []).append(option)
+                self._dispatch = dict((char, tuple(options))
+                                      for char, options in dispatch.items())
+        return self._dispatch
+
+    def parse(self, text, position=0):
+        dispatch = self._dispatch
+        if dispatch is None:
+            dispatch = self.dispatch()
+        if dispatch is False:
+            return Multiple.parse(self, text, position)
+
+        if position >= len(text) or text[position] not in dispatch:
+            return 0, self.empty
+
+        session = _state.session
+        if session is not None:
+            session.step(position)
+
+        parts = []
+        i = position
+        end = len(text)
+        while i < end:
+            for option in dispatch.get(text[i], ()):
+                try:
+                    length, part_data = option.parse(text, i)
+                except NotHere:
+                    continue
+                if length:
+                    break
+            else:
+                break
+            parts.append(part_data)
+            i += length
+
+        if not parts:
+            return 0, self.empty
+
+        if session is not None:
+            session.nodes += len(parts)
+
+        return i - position, {'class': self, 'parts': parts}
+
+    def match(self, text, position=0):
+        dispatch = self._dispatch
+        if dispatch is None:
+            dispatch = self.dispatch()
+        if dispatch and (position >= len(text)
+                         or text[position] not in dispatch):
+            return 0
+        return Multiple.match(self, text, position)
+
+def _first_chars(parser):
+    ''' the set of characters which parser must start with (if it matches
+        anything at all), or None if we can't easily tell. '''
+    owner = _parse_owner(parser)
+    if owner is SingleChar:
+        return set(parser.letter)
+    elif owner is SpecificWord:
+        return set(parser.word[:1]) or None
+    elif owner is Word:
+        return set(parser.chrs)
+    elif owner is Joined and parser.parts:
+        return _first_chars(parser.parts[0])
+    elif owner is Guard:
+        return _first_chars(parser.parser)
+    elif owner is Either:
+        chars = set()
+        for option in parser.options:
+            first = _first_chars(option)
+            if first is None:
+                return None
+            chars |= first
+        return chars
+    return None
+
+class SeparatedBy(Joined):
+    ''' accept a list of item, separated by separator (item, separator, item,
+        ...), as one flat list of parts.  At least `min` items are needed, and
+        if `trailing` is True, one last separator may follow the last item. '''
+
+    def __init__(self, item, separator, trailing=False, min=0):  # pylint: disable=redefined-builtin
+        self.item, self.separator = [
+            (SingleChar(p) if len(p) == 1 else SpecificWord(p))
+            if isinstance(p, str) else p for p in (item, separator)]
+        self.trailing = trailing
+        self.min = min
+
+    def __repr__(self):
+        return '<%s:(%r/%r)>' % (self.__class__.__name__,
+                                 self.item, self.separator)
+
+    def parse(self, text, position=0):
+        session = _state.session
+        if session is not None:
+            session.step(position)
+
+        parts = []
+        count = 0
+        i = 0
+        try:
+            length, item_data = self.item.parse(text, position)
+            parts.append(item_data)
+            count, i = 1, length
+
+            while True:
+                sep_length, sep_data = self.separator.parse(text, position + i)
+                try:
+                    length, item_data = self.item.parse(text, position + i
+                                                        + sep_length)
+                except NotHere:
+                    if self.trailing:
+                        parts.append(sep_data)
+                        i += sep_length
+                    break
+
+                if not sep_length + length:
+                    break
+                parts.append(sep_data)
+                parts.append(item_data)
+                count += 1
+                i += sep_length + length
+        except NotHere:
+            pass
+
+        if count < self.min:
+            raise NotHere('Expected at least %i of %r', self.min, self.item)
+
+        if session is not None:
+            session.nodes += len(parts)
+
+        return i, {'class': self, 'parts': parts}
+
+    def match(self, text, position=0):
+        session = _state.session
+        if session is not None:
+            session.step(position)
+
+        count = 0
+        i = 0
+        try:
+            i = self.item.match(text, position)
+            count = 1
+
+            while True:
+                sep_length = self.separator.match(text, position + i)
+                try:
+                    length = self.item.match(text, position + i + sep_length)
+                except NotHere:
+                    if self.trailing:
+                        i += sep_length
+                    break
+
+                if not sep_length + length:
+                    break
+                count += 1
+                i += sep_length + length
+        except NotHere:
+            pass
+
+        if count < self.min:
+            raise NotHere('Expected at least %i of %r', self.min, self.item)
+
+        return i
+
+    def subparsers(self):
+        return (self.item, self.separator)
+
 class Until(Parsable):
     ''' accept any text, up until a certain 'end' marker '''
 
@@ -322,7 +1113,11 @@ class Until(Parsable):
         self.fail_on_eof = fail_on_eof
 
     def parse(self, text, position=0):
-        data = {'class': self}
+        length = self.match(text, position)
+        return length, {'class': self,
+                        'text': text[position:position + length]}
+
+    def match(self, text, position=0):
         i = -1
         end = len(text) - position
 
@@ -331,14 +1126,463 @@ class Until(Parsable):
             now = position + i
             if text[now:now + self.ending_length] == self.ending \
             and text[now - 1] != self.escape:
-                data['text'] = text[position:now + self.ending_length]
-                return i + self.ending_length, data
+                return i + self.ending_length
 
         if self.fail_on_eof:
+            _expected(self, text, len(text))
             raise NotHere('EOF')
         else:
-            data['text'] = text[position:now + self.ending_length]
-            return i, data
+            return i
+
+class Resync(Parsable):
+    ''' skips over some bad text, when recovering from a syntax error (see
+        Session):  up to and including the next `sync` character (such as
+        ';'), outside of any brackets - or to the end of the enclosing
+        block (an unmatched closing bracket), or anything in `end` (even
+        inside brackets, which may never be closed), or the end of the text.
+        Anything which matches `atoms` (strings, comments...) is skipped over
+        whole, so brackets and sync characters in there don't count.  The
+        node is the skipped text.  A closing bracket which is itself a sync
+        character (such as '}') ends the skip too, once the brackets are
+        balanced.  For the outermost list, which isn't in any block,
+        use outermost=True:  then an unmatched closing bracket is just more
+        bad text to skip. '''
+
+    def __init__(self, sync, end=(), brackets=('()', '[]', '{}'), atoms=None,
+                 outermost=False):
+        self.sync = sync
+        self.end = (end, ) if isinstance(end, str) else tuple(end)
+        self.brackets = dict(brackets)
+        self.closing = ''.join(self.brackets.values())
+        self.atoms = atoms
+        self.outermost = outermost
+
+    def __repr__(self):
+        return '<Resync:%r>' % self.sync
+
+    def parse(self, text, position=0):
+        length = self.match(text, position)
+        return length, {'class': self, 'text': text[position:position + length]}
+
+    def match(self, text, position=0):
+        stack = []
+        i = position
+        while i < len(text):
+            if self.atoms is not None:
+                try:
+                    length = self.atoms.match(text, i)
+                    if length:
+                        i += length
+                        continue
+                except NotHere:
+                    pass
+
+            char = text[i]
+            if text.startswith(self.end, i):
+                break
+            if char in self.brackets:
+                stack.append(self.brackets[char])
+            elif char in self.closing:
+                if stack:
+                    stack.pop()
+                elif not self.outermost:
+                    break
+            i += 1
+            if not stack and char in self.sync:
+                break
+
+        if i == position:
+            raise NotHere('Nothing to skip')
+        return i - position
+
+    def subparsers(self):
+        return () if self.atoms is None else (self.atoms, )
+
+class Regex(Parsable):
+    ''' accept text matching a regular expression (pattern string, or an
+        already compiled pattern). '''
+
+    def __init__(self, pattern, flags=0):
+        if hasattr(pattern, 'match'):
+            self.regex = pattern
+        else:
+            self.regex = re.compile(pattern, flags)
+
+    def __repr__(self):
+        return '<Regex:/%s/>' % self.regex.pattern
+
+    def parse(self, text, position=0):
+        match = self.regex.match(text, position)
+        if match is None:
+            _expected(self, text, position)
+            raise NotHere('Expected /%s/', self.regex.pattern)
+
+        return match.end() - position, {'class': self, 'text': match.group()}
+
+    def match(self, text, position=0):
+        match = self.regex.match(text, position)
+        if match is None:
+            _expected(self, text, position)
+            raise NotHere('Expected /%s/', self.regex.pattern)
+
+        return match.end() - position
+
+class And(Parsable):
+    ''' lookahead: matches (reading nothing) only where predicate would
+        match.  The predicate never builds a tree (only its .match is used),
+        and simple ones (SingleChar, SpecificWord, Word) are just a check of
+        the next character(s).  The node is a shared empty one, like
+        Nothing's. '''
+    expect = True
+
+    def __init__(self, predicate):
+        if isinstance(predicate, str):
+            predicate = SingleChar(predicate) if len(predicate) == 1 \
+                else SpecificWord(predicate)
+        self.predicate = predicate
+        self.data = {'class': self, 'text': ''}
+
+    def __repr__(self):
+        return '<%s:%r>' % (self.__class__.__name__, self.predicate)
+
+    def parse(self, text, position=0):
+        session = _state.session
+        if session is not None:
+            session.step(position)
+
+        if _looking_at(self.predicate, text, position) != self.expect:
+            _expected(self, text, position)
+            raise NotHere('%r failed', self)
+        return 0, self.data
+
+    def subparsers(self):
+        return (self.predicate, )
+
+class Not(And):
+    ''' negative lookahead: matches (reading nothing) only where predicate
+        wouldn't match.  (see And) '''
+    expect = False
+
+class End(Not):
+    ''' matches (reading nothing) only at the end of the text. '''
+
+    def __init__(self):
+        super(End, self).__init__(Regex(r'[\s\S]'))
+
+    def __repr__(self):
+        return '<End>'
+
+class Guard(Parsable):
+    ''' parser, but only where guard (a lookahead:  And or Not) matches
+        first - so it can be ruled out with one quick check, rather than a
+        whole parse.  The node is parser's own (the guard adds nothing). '''
+
+    def __init__(self, guard, parser):
+        self.guard = guard
+        self.parser = parser
+
+    def __repr__(self):
+        return '<Guard:(%r+%r)>' % (self.guard, self.parser)
+
+    def parse(self, text, position=0):
+        self.guard.parse(text, position)
+        return self.parser.parse(text, position)
+
+    def match(self, text, position=0):
+        self.guard.parse(text, position)
+        return self.parser.match(text, position)
+
+    def subparsers(self):
+        return (self.guard, self.parser)
+
+def _looking_at(predicate, text, position):
+    ''' would predicate match text at position? '''
+    owner = _parse_owner(predicate)
+    if owner is SingleChar:
+        return text[position:position + 1] == predicate.letter
+    elif owner is SpecificWord:
+        return text.startswith(predicate.word, position)
+    elif owner is Word:
+        return position < len(text) and text[position] in predicate.chrs
+
+    # (the predicate failing isn't the parse failing, so the session isn't
+    #  told about any of it.)
+    session = _state.session
+    if session is not None:
+        saved = session._saved()  # pylint: disable=protected-access
+    try:
+        predicate.match(text, position)
+        return True
+    except NotHere:
+        return False
+    finally:
+        if session is not None:
+            session._restore(saved)  # pylint: disable=protected-access
+
+class Islands(Parsable):
+    ''' a whole text which is mostly something that doesn't need parsing
+        (such as HTML), with islands of something which does (<?php ... ?>)
+        in it.  islands is a list of (start, parser):  each island begins
+        with one of the starts, and is parsed from there by its parser.
+        They're found with one regular expression search, so the text in
+        between is never looked at a character at a time - it's a single
+        node each, as if parsed by `between` (which is only used for that).
+        The node's parts are the texts & islands, in order.  If recover (a
+        Resync, or anything else which skips over bad text) is given, and
+        the session is recovering from errors, then an island which doesn't
+        parse is skipped over with recover, from its start (see Session). '''
+
+    def __init__(self, between, islands, recover=None):
+        self.between = between
+        self.islands = list(islands)
+        self.recover = recover
+        self._parsers = dict(self.islands)
+        # (longest first, so that '<?php' is found rather than '<?')
+        starts = sorted(self._parsers, key=len, reverse=True)
+        self._search = re.compile('|'.join(re.escape(s) for s in starts)).search
+
+    def __repr__(self):
+        return '<Islands:(%s)>' % '|'.join(start for start, _ in self.islands)
+
+    def find(self, text, position=0):
+        ''' (where the next island starts, and which start it is), or
+            (len(text), None) if there aren't any more. '''
+        match = self._search(text, position)
+        if match is None:
+            return len(text), None
+        return match.start(), match.group()
+
+    def parser(self, start):
+        ''' the parser for islands which begin with start. '''
+        return self._parsers[start]
+
+    def parse(self, text, position=0):
+        session = _state.session
+        begin = position
+        parts = []
+        while True:
+            if session is not None:
+                session.step(position)
+            start, found = self.find(text, position)
+            if start > position:
+                parts.append({'class': self.between,
+                              'text': text[position:start]})
+            if found is None:
+                return len(text) - begin, {'class': self, 'parts': parts}
+            try:
+                length, island = self._parsers[found].parse(text, start)
+            except NotHere as err:
+                if self.recover is None or session is None \
+                   or not session.recover:
+                    raise
+                length, island = session.recover_from(self.recover, text,
+                                                      start)
+                if island is None:
+                    raise err
+            parts.append(island)
+            position = start + length
+
+    def output(self, data, clean=False):
+        return ''.join(output(part, clean) for part in data['parts'])
+
+    def subparsers(self):
+        recover = () if self.recover is None else (self.recover, )
+        return (self.between, ) + tuple(parser for _, parser in self.islands) \
+               + recover
+
+class Lazy(Parsable):
+    ''' parser - but in a lazy session (Session(text, lazy=True)), it isn't
+        really parsed until something looks inside its node.  Until then,
+        scan(text, position) (something quick, which builds nothing) says
+        how much it would read, or raises NotHere.  The node is an
+        UnparsedNode, which does the real parse the first time it's
+        needed.  Otherwise (or when recovering from errors), this is just
+        parser.  Either way, the tree is the same - as long as scan agrees
+        with parser. '''
+
+    def __init__(self, parser, scan):
+        self.parser = parser
+        self.scan = scan
+
+    def __repr__(self):
+        return '<Lazy:%r>' % self.parser
+
+    def parse(self, text, position=0):
+        session = _state.session
+        if session is None or not session.lazy or session.recover:
+            return self.parser.parse(text, position)
+
+        session.step(position, 1)
+        try:
+            length = self.scan(text, position)
+        except NotHere:
+            _expected(self.parser, text, position)
+            raise
+        return length, UnparsedNode(self.parser, (text, position, length))
+
+    def match(self, text, position=0):
+        session = _state.session
+        if session is None or not session.lazy:
+            return self.parser.match(text, position)
+        return self.parse(text, position)[0]
+
+    def subparsers(self):
+        return (self.parser, )
+
+class DeferredNode(dict):
+    ''' a tree node which only works out what's in it (apart from its
+        'class') the first time anything looks:  expand() fills it in, from
+        whatever is in _lazy (which is None once it has).  Otherwise, just a
+        normal node. '''
+    __slots__ = ('_lazy', )
+
+    def __init__(self, parser, lazy):
+        dict.__init__(self)
+        dict.__setitem__(self, 'class', parser)
+        self._lazy = lazy
+
+    def expand(self):
+        ''' fill in the rest of this node (if it hasn't been already). '''
+        raise TooGeneric('DeferredNode!')
+
+    def __getitem__(self, key):
+        if self._lazy is not None and key != 'class':
+            self.expand()
+        return dict.__getitem__(self, key)
+
+    def get(self, key, default=None):
+        if self._lazy is not None and key != 'class':
+            self.expand()
+        return dict.get(self, key, default)
+
+    def copy(self):
+        ''' another node the same as this one - which is still deferred, if
+            this one is. '''
+        if self._lazy is None:
+            return dict.copy(self)
+        node = type(self)(dict.__getitem__(self, 'class'), self._lazy)
+        for key, value in dict.items(self):
+            dict.__setitem__(node, key, value)
+        return node
+
+def _expanding(method):
+    ''' method (of dict), but expand()ing the node first. '''
+    def expanding(self, *args, **kwargs):
+        if self._lazy is not None:
+            self.expand()
+        return method(self, *args, **kwargs)
+    expanding.__name__ = method.__name__
+    return expanding
+
+for _name in ('__contains__', '__iter__', '__len__', '__repr__', '__eq__',
+              '__ne__', '__setitem__', '__delitem__', 'keys', 'values',
+              'items', 'iterkeys', 'itervalues', 'iteritems', 'has_key',
+              'pop', 'setdefault', 'update'):
+    if hasattr(dict, _name):
+        setattr(DeferredNode, _name, _expanding(getattr(dict, _name)))
+
+class UnparsedNode(DeferredNode):
+    ''' the node of a Lazy parser, which hasn't really been parsed yet:  it
+        parses itself (in a lazy session of its own, so anything lazy inside
+        it waits too) the first time it's looked in.  If that fails, or
+        reads a different amount than the scan said, that's a ParseError
+        then. '''
+    __slots__ = ()
+
+    def expand(self):
+        if self._lazy is None:
+            return
+        text, position, length = self._lazy
+        session = Session(text, lazy=True)
+        found, node = session.parse(dict.__getitem__(self, 'class'), position)
+        if found != length:
+            raise ParseError(session)
+        self._lazy = None
+        dict.update(self, node)
+
+class Trivia(Parsable):
+    ''' the 'trivia' of a grammar (whitespace, comments...) which may come
+        before or after any token.  Declare it once, and then wrap tokens with
+        trivia.around(token) - the trivia then isn't a node of its own in the
+        tree, but is attached to the node next to it. '''
+
+    def __init__(self, skip):
+        self.skip = skip
+
+    def __repr__(self):
+        return '<Trivia:%r>' % self.skip
+
+    def parse(self, text, position=0):
+        ''' (length, node) of the trivia here, or (0, None) if there isn't
+            any. '''
+        try:
+            return self.skip.parse(text, position)
+        except NotHere:
+            return 0, None
+
+    def match(self, text, position=0):
+        try:
+            return self.skip.match(text, position)
+        except NotHere:
+            return 0
+
+    def around(self, parser):
+        ''' parser, with (optional) trivia before and after it. '''
+        return WithTrivia(parser, self)
+
+    def subparsers(self):
+        return (self.skip, )
+
+class WithTrivia(Parsable):
+    ''' a parser, with trivia either side.  The parsed node is the actual
+        parser's own one, with any trivia found as its 'before' and 'after'
+        (which output() puts back in). '''
+
+    def __init__(self, actual, trivia):
+        if isinstance(actual, str):
+            actual = SingleChar(actual) if len(actual) == 1 \
+                else SpecificWord(actual)
+        self.actual = actual
+        self.trivia = trivia
+
+    def __repr__(self):
+        return '<WithTrivia:%r>' % self.actual
+
+    def parse(self, text, position=0):
+        session = _state.session
+        if session is not None:
+            session.step(position)
+
+        before, before_data = self.trivia.parse(text, position)
+        length, data = self.actual.parse(text, position + before)
+        after, after_data = self.trivia.parse(text, position + before + length)
+
+        return before + length + after, \
+            _attach(data, before and before_data, after and after_data)
+
+    def match(self, text, position=0):
+        session = _state.session
+        if session is not None:
+            session.step(position)
+
+        length = self.trivia.match(text, position)
+        length += self.actual.match(text, position + length)
+        return length + self.trivia.match(text, position + length)
+
+    def subparsers(self):
+        return (self.actual, self.trivia)
+
+def _attach(data, before, after):
+    ''' data, with before/after trivia attached (if there is any). The data
+        is copied first, as it may well be a shared one (SingleChar...). '''
+    if before or after:
+        # (a DeferredNode stays deferred - dict() would only copy its class)
+        data = data.copy() if isinstance(data, DeferredNode) else dict(data)
+        if before:
+            dict.__setitem__(data, 'before', before)
+        if after:
+            dict.__setitem__(data, 'after', after)
+    return data
 
 #######################################################
 # Aliases, and other useful bits:
@@ -354,9 +1598,23 @@ SPACES = ' \t'
 def output(parsed, clean=False):
     ''' go through a parsed tree, and output each thing as it thinks it should
         be done.  If the parse was successful, then you should probably end up
-        with the same as you put in. '''
+        with the same as you put in.  (Any trivia attached to a node is
+        output either side of it.) '''
+
+    # (nodes of an EditableTree keep what they last output)
+    cache = parsed.get('output')
+    if cache is not None and clean in cache:
+        return cache[clean]
 
-    return parsed['class'].output(parsed, clean)
+    text = parsed['class'].output(parsed, clean)
+    if 'before' in parsed:
+        text = output(parsed['before'], clean) + text
+    if 'after' in parsed:
+        text += output(parsed['after'], clean)
+
+    if cache is not None:
+        cache[clean] = text
+    return text
 
 def pretty_print(parsed_block, level=0):
     ''' take an output from the parser, and display it as a tree for easier
@@ -380,6 +1638,10 @@ def parts(parsed):
 
     assert isinstance(parsed, dict)
 
+    if 'before' in parsed:
+        for i in parts(parsed['before']):
+            yield i
+
     if 'parts' in parsed:
         for p in parsed['parts']:
             o = parts(p)
@@ -394,5 +1656,795 @@ def parts(parsed):
             if 'text' in parsed:
                 yield parsed['text']
 
+    if 'after' in parsed:
+        for i in parts(parsed['after']):
+            yield i
+
+def spans(parsed, position=0):
+    ''' [(node, start, end), ...] for every node of a parsed tree (which was
+        parsed from position), parents before their parts.  A node's span
+        doesn't include any trivia attached to it - that has its own.  Use a
+        LineIndex (or session.location) to turn them into lines & columns. '''
+    found = []
+    _spans(parsed, position, found)
+    return found
+
+def _spans(node, position, found):
+    ''' add the spans of node (and its parts) to found, return where it ends. '''
+    if 'before' in node:
+        position = _spans(node['before'], position, found)
+
+    index = len(found)
+    found.append(None)
+    start = position
+
+    parts = node.get('parts')
+    if parts is None:
+        position += len(node.get('text', ''))
+    else:
+        if isinstance(parts, dict):
+            parts = [parts[name] for name, _ in node['class'].parts
+                     if name in parts]
+        for part in parts:
+            position = _spans(part, position, found)
+
+    found[index] = (node, start, position)
+
+    if 'after' in node:
+        position = _spans(node['after'], position, found)
+    return position
+
+class EditableTree(object):
+    ''' a parsed tree which is going to be changed and output() again and
+        again (by a formatter, say).  Each node keeps what it last output
+        (for each `clean`, which must be hashable), so after a change only
+        the changed node and its ancestors are output again - as long as the
+        changes are made with replace / insert / remove, or the tree is told
+        about them with changed(node).
+
+            tree = EditableTree(PHP_BLOCK.parse(text)[1])
+            tree.replace(node, IF.parse(new_text)[1])
+            tree.output()
+
+        (The tree itself is used, not a copy:  its nodes get an 'output',
+        which the output() function uses.) '''
+
+    def __init__(self, root):
+        # (nodes which parsers share between trees are copied, so that every
+        #  node here is this tree's own)
+        self.root = _own(root)
+        self.parents = {}       # id(node) -> parent node
+        self._add(self.root, None)
+
+    def output(self, clean=False):
+        ''' output(the tree, clean), only redoing what has changed. '''
+        return output(self.root, clean)
+
+    def parent(self, node):
+        ''' the node which node is a part of (or None for the root). '''
+        return self.parents[id(node)]
+
+    def changed(self, node):
+        ''' node has been changed (in place), so it and its ancestors need to
+            be output again. '''
+        while node is not None:
+            cache = node.get('output')
+            if cache:
+                cache.clear()
+            node = self.parents[id(node)]
+
+    def replace(self, node, new):
+        ''' put the tree new where node is now. '''
+        parent = self.parents[id(node)]
+        new = _own(new)
+        if parent is None:
+            self.root = new
+        else:
+            for container, key in _children(parent):
+                if container[key] is node:
+                    container[key] = new
+                    break
+
+        self._remove(node)
+        self._add(new, parent)
+        if parent is not None:
+            self.changed(parent)
+
+    def insert(self, parent, index, new):
+        ''' put the tree new into the parts (list) of parent, at index. '''
+        new = _own(new)
+        parent['parts'].insert(index, new)
+        self._add(new, parent)
+        self.changed(parent)
+
+    def remove(self, node):
+        ''' take node out of its parent's parts. '''
+        parent = self.parents[id(node)]
+        for container, key in _children(parent):
+            if container is parent['parts'] and container[key] is node:
+                del container[key]
+                break
+        self._remove(node)
+        self.changed(parent)
+
+    def _add(self, node, parent):
+        ''' start keeping track of node (and everything in it). '''
+        found = [(node, parent)]
+        while found:
+            node, parent = found.pop()
+            self.parents[id(node)] = parent
+            if 'parts' in node:
+                node.setdefault('output', {})
+            for container, key in _children(node):
+                child = container[key] = _own(container[key])
+                found.append((child, node))
+
+    def _remove(self, node):
+        ''' stop keeping track of node (and everything in it). '''
+        found = [node]
+        while found:
+            node = found.pop()
+            del self.parents[id(node)]
+            node.pop('output', None)
+            found.extend(container[key] for container, key in _children(node))
+
+def _children(node):
+    ''' (container, key) for where each node directly in node is:  its parts
+        (a list or dict), and any trivia before & after it. '''
+    found = [(node, key) for key in ('before', 'after') if key in node]
+    parts = node.get('parts')
+    if isinstance(parts, dict):
+        found.extend((parts, key) for key in parts)
+    elif parts is not None:
+        found.extend((parts, i) for i in range(len(parts)))
+    return found
+
+def _own(node):
+    ''' node - or a copy of it, if it's one which its parser returns every
+        time (SingleChar, a Skipper's empty one...) '''
+    if any(value is node for value in vars(node['class']).values()):
+        node = dict(node)
+        if 'parts' in node:
+            node['parts'] = list(node['parts'])
+    return node
+
+def walk(parser):
+    ''' yield every parser in a grammar (parser, and everything it is built
+        from) exactly once, in a stable (depth first) order.  Recursive
+        grammars are fine. '''
+    seen = set()
+    stack = [parser]
+    while stack:
+        current = stack.pop()
+        if id(current) in seen:
+            continue
+        seen.add(id(current))
+        yield current
+        stack.extend(reversed(list(current.subparsers())))
+
+################################################################################
+# Fusing lexical (regular, non-recursive) sub-grammars into single regexps:
+#
+# A sub-grammar made only of Nothing, SingleChar, SpecificWord, Word, Until,
+# Regex, Joined, NamedJoin, Either, Multiple, Skipper, SeparatedBy, Trivia,
+# And/Not (which are regexp lookaheads) and Guard, and which doesn't refer back
+# to itself, can be matched by one regular expression.  Every 'choice making' part (Word, Until, Regex, Either,
+# Multiple, Skipper, SeparatedBy) is wrapped in an atomic group ( (?=(...))\N )
+# so that the regexp never backtracks into it, which is how these parsers
+# behave.  The tree is then rebuilt from the (known good) match without any
+# NotHere exceptions being raised along the way.
+
+def _parse_owner(parser):
+    ''' which class actually provides the .parse method for this parser? '''
+    for cls in type(parser).__mro__:
+        if 'parse' in cls.__dict__:
+            return cls
+
+class _RegexCompiler(object):
+    ''' turns a regular sub-grammar into a regexp pattern string. '''
+
+    def __init__(self):
+        self.groups = 0
+
+    def atomic(self, build):
+        ''' an atomic group around the pattern which build() returns.  (the
+            group number is taken first, as it comes before any in there.) '''
+        self.groups += 1
+        group = self.groups
+        return '(?=(%s))\\%i' % (build(), group)
+
+    def pattern(self, node, atomic=False):  # pylint: disable=too-many-return-statements
+        owner = _parse_owner(node)
+
+        if atomic and owner in (Word, Until, Regex, Either, Multiple,
+                                Skipper, SeparatedBy):
+            return self.atomic(lambda: self.pattern(node))
+
+        if owner is Nothing:
+            return ''
+        elif owner is SingleChar:
+            return re.escape(node.letter)
+        elif owner is SpecificWord:
+            return re.escape(node.word)
+        elif owner is Word:
+            if not node.chrs:
+                return '(?!)'
+            return '[%s]+' % ''.join(re.escape(c) for c in node.chrs)
+        elif owner is Until:
+            ending = '(?:%s)' % re.escape(node.ending)
+            if node.escape and len(node.escape) == 1:
+                ending = '(?<!%s)%s' % (re.escape(node.escape), ending)
+            if node.fail_on_eof:
+                return '[\\s\\S]*?' + ending
+            return '(?:[\\s\\S]*?%s|[\\s\\S]*)' % ending
+        elif owner is Regex:
+            return '(?:%s)' % node.regex.pattern
+        elif owner is NamedJoin:
+            return ''.join(self.pattern(p, True) for p in node.subparsers())
+        elif owner is Either:
+            if not node.options:
+                return '(?!)'
+            return '(?:%s)' % '|'.join(self.pattern(o, True)
+                                       for o in node.options)
+        elif owner in (Multiple, Skipper):
+            return '(?:%s)%s' % (self.pattern(node.original, True),
+                                 '*' if node.allow_none else '+')
+        elif owner is SeparatedBy:
+            separator = lambda: self.pattern(node.separator, True)
+            item = lambda: self.pattern(node.item, True)
+
+            items = item()
+            if node.min > 1:
+                items += '(?:%s%s){%i}' % (separator(), item(), node.min - 1)
+            items += self.atomic(lambda: '(?:%s%s)*' % (separator(), item()))
+            if node.trailing:
+                items += self.atomic(lambda: '(?:%s)?' % separator())
+            return items if node.min else '(?:%s)?' % items
+        elif owner is Joined:
+            return ''.join(self.pattern(p, True) for p in node.parts)
+        elif owner is Trivia:
+            return '(?:%s)?' % self.pattern(node.skip, True)
+        elif owner is WithTrivia:
+            return ''.join(self.pattern(p, True) for p in
+                           (node.trivia, node.actual, node.trivia))
+        elif owner is And:
+            return '(?%s%s)' % ('=' if node.expect else '!',
+                                self.pattern(node.predicate, True))
+        elif owner is Guard:
+            return self.pattern(node.guard, True) \
+                 + self.pattern(node.parser, atomic)
+
+class _RegularGrammar(object):
+    ''' works out which parts of a grammar are regular (can be fused), and
+        keeps a compiled regexp for each of them. '''
+
+    def __init__(self):
+        self.regular = {}   # id(parser) -> True / False
+        self.nullable = {}  # id(parser) -> True / False
+        self.patterns = {}  # id(parser) -> regexp pattern string
+        self.compiled = {}  # id(parser) -> compiled regexp
+
+    def is_regular(self, node, _in_progress=None):
+        if id(node) in self.regular:
+            return self.regular[id(node)]
+
+        in_progress = _in_progress if _in_progress is not None else set()
+        if id(node) in in_progress:
+            return False
+
+        in_progress.add(id(node))
+        result = self._check(node, in_progress)
+        in_progress.discard(id(node))
+
+        self.regular[id(node)] = result
+        return result
+
+    def _check(self, node, in_progress):
+        owner = _parse_owner(node)
+
+        if owner in (Nothing, SingleChar, SpecificWord, Word, Until):
+            return True
+        elif owner is Regex:
+            # groups of our own would upset the atomic group numbering:
+            return not node.regex.groups \
+               and not node.regex.flags & ~(re.UNICODE | getattr(re, 'ASCII', 0))
+        elif owner in (Joined, NamedJoin, Trivia, WithTrivia, And, Guard):
+            return all(self.is_regular(p, in_progress)
+                       for p in node.subparsers())
+        elif owner is Either:
+            if not all(self.is_regular(o, in_progress) for o in node.options):
+                return False
+            # Either takes the first option which consumes something, or
+            # else the last one which matched nothing.  A regexp takes the
+            # first which matches at all - which is only the same thing if
+            # only the last option can match nothing.
+            return not any(self.is_nullable(o) for o in node.options[:-1])
+        elif owner in (Multiple, Skipper):
+            return self.is_regular(node.original, in_progress) \
+               and not self.is_nullable(node.original) \
+               and node.recover is None
+        elif owner is SeparatedBy:
+            return self.is_regular(node.item, in_progress) \
+               and self.is_regular(node.separator, in_progress) \
+               and not self.is_nullable(node.item)
+
+        return False
+
+    def is_nullable(self, node):
+        ''' can this (regular) node ever match without consuming anything? '''
+        if id(node) in self.nullable:
+            return self.nullable[id(node)]
+
+        owner = _parse_owner(node)
+        if owner is Nothing:
+            result = True
+        elif owner is SingleChar:
+            result = False
+        elif owner is SpecificWord:
+            result = not node.word
+        elif owner is Word:
+            result = False
+        elif owner is Until:
+            result = not node.fail_on_eof or not node.ending
+        elif owner in (Joined, NamedJoin, WithTrivia, Guard):
+            result = all(self.is_nullable(p) for p in node.subparsers())
+        elif owner in (Trivia, And):
+            result = True
+        elif owner is Either:
+            result = any(self.is_nullable(o) for o in node.options)
+        elif owner in (Multiple, Skipper):
+            result = node.allow_none or self.is_nullable(node.original)
+        elif owner is SeparatedBy:
+            result = not node.min or self.is_nullable(node.item)
+        else:
+            result = True  # Regex, or anything we don't know about.
+
+        self.nullable[id(node)] = result
+        return result
+
+    def pattern(self, node):
+        ''' regexp pattern (string) for a regular node. '''
+        pattern = self.patterns.get(id(node))
+        if pattern is None:
+            pattern = self.patterns[id(node)] = _RegexCompiler().pattern(node)
+        return pattern
+
+    def regex(self, node):
+        ''' compiled regexp for a regular node. (raises re.error &c. if the
+            pattern is too large for this python's re module) '''
+        compiled = self.compiled.get(id(node))
+        if compiled is None:
+            compiled = self.compiled[id(node)] = re.compile(self.pattern(node))
+        return compiled
+
+class _Fused(object):
+    ''' replacement .parse for a regular sub-grammar: one regexp match to see
+        if (and how much) it matches, and then rebuild the usual tree. '''
+
+    def __init__(self, root, grammar):
+        self.root = root
+        self.grammar = grammar
+        # (the regexps - root's too - are only compiled when first needed)
+        self._regex = None
+
+    @property
+    def regex(self):
+        ''' the compiled regexp for root (raises re.error &c. if it's too
+            large for this python's re module) '''
+        if self._regex is None:
+            self._regex = self.grammar.regex(self.root)
+        return self._regex
+
+    def parse(self, text, position=0):
+        session = _state.session
+        if session is not None:
+            session.step(position)
+
+        if (self._regex or self.regex).match(text, position) is None:
+            _expected(self.root, text, position)
+            raise NotHere('Expected %r', self.root)
+
+        return self.build(self.root, text, position)
+
+    def match(self, text, position=0):
+        session = _state.session
+        if session is not None:
+            session.step(position)
+
+        match = (self._regex or self.regex).match(text, position)
+        if match is None:
+            _expected(self.root, text, position)
+            raise NotHere('Expected %r', self.root)
+
+        return match.end() - position
+
+    def install(self):
+        ''' use this for root's .parse (and .match) from now on. '''
+        self.root.parse = self.parse
+        self.root.match = self.match
+
+    def build(self, node, text, position):
+        ''' rebuild the tree for node, which is known to match here. '''
+        owner = _parse_owner(node)
+
+        if owner in (Nothing, And):
+            return 0, node.data
+        elif owner is SingleChar:
+            return 1, node.data
+        elif owner is SpecificWord:
+            return node.length, node.data
+        elif owner is Guard:
+            return self.build(node.parser, text, position)
+        elif owner in (Word, Until, Regex):
+            match = self.grammar.regex(node).match(text, position)
+            return match.end() - position, {'class': node,
+                                            'text': match.group()}
+        elif owner is Joined:
+            data = {'class': node, 'parts': []}
+            total_length = 0
+            for part in node.parts:
+                length, part_data = self.build(part, text,
+                                               position + total_length)
+                total_length += length
+                data['parts'].append(part_data)
+            return total_length, data
+        elif owner is NamedJoin:
+            data = {'class': node, 'parts': {}}
+            total_length = 0
+            for name, part in node.parts:
+                length, part_data = self.build(part, text,
+                                               position + total_length)
+                total_length += length
+                data['parts'][name] = part_data
+            return total_length, data
+        elif owner is Either:
+            for option in node.options:
+                if self.grammar.regex(option).match(text, position) is not None:
+                    return self.build(option, text, position)
+        elif owner is SeparatedBy:
+            return self.build_separated(node, text, position)
+        elif owner is Trivia:
+            if not self.grammar.is_nullable(node.skip) \
+               and self.grammar.regex(node.skip).match(text, position) is None:
+                return 0, None
+            return self.build(node.skip, text, position)
+        elif owner is WithTrivia:
+            before, before_data = self.build(node.trivia, text, position)
+            length, data = self.build(node.actual, text, position + before)
+            after, after_data = self.build(node.trivia, text,
+                                           position + before + length)
+            return before + length + after, \
+                _attach(data, before and before_data, after and after_data)
+        elif owner in (Multiple, Skipper):
+            if owner is Skipper:
+                dispatch = node.dispatch()
+                if dispatch and (position >= len(text)
+                                 or text[position] not in dispatch):
+                    return 0, node.empty
+            regex = self.grammar.regex(node.original)
+            data = {'class': node, 'parts': []}
+            i = 0
+            while regex.match(text, position + i) is not None:
+                length, part_data = self.build(node.original, text,
+                                               position + i)
+                data['parts'].append(part_data)
+                i += length
+            return i, data
+
+    def build_separated(self, node, text, position):
+        ''' rebuild the tree for a SeparatedBy node. '''
+        item = self.grammar.regex(node.item)
+        separator = self.grammar.regex(node.separator)
+
+        data = {'class': node, 'parts': []}
+        if item.match(text, position) is None:
+            return 0, data
+
+        i, item_data = self.build(node.item, text, position)
+        data['parts'].append(item_data)
+        while True:
+            sep_match = separator.match(text, position + i)
+            if sep_match is None:
+                break
+            if item.match(text, sep_match.end()) is None:
+                if node.trailing:
+                    length, sep_data = self.build(node.separator, text,
+                                                  position + i)
+                    data['parts'].append(sep_data)
+                    i += length
+                break
+            for part in (node.separator, node.item):
+                length, part_data = self.build(part, text, position + i)
+                data['parts'].append(part_data)
+                i += length
+
+        return i, data
+
+_TRIVIAL = (Nothing, SingleChar, SpecificWord)
+
+def _fused(parser):
+    ''' the _Fused regexp version of parser, if it has been fused. '''
+    fused = getattr(parser.__dict__.get('parse'), '__self__', None)
+    return fused if isinstance(fused, _Fused) else None
+
+def fuse(grammar, cache=None):
+    ''' find each of the largest regular (lexical, non-recursive) parts of
+        grammar, and replace their .parse with a single compiled regexp
+        (see _Fused).  The trees returned are exactly the same as before.
+        Parsers are changed in place, so call this once the grammar is
+        completely built.  Returns grammar, for convenience.
+
+        If cache is given (a directory, or True for the default one), which
+        parts to fuse, and their patterns, are saved there - and loaded from
+        there next time, rather than worked out again.  Any change to the
+        grammar, to pc.py or to the code of its parsers' classes (php.py...)
+        means a different cache file.  The regexps loaded from there are only
+        compiled when first used. '''
+
+    nodes = list(walk(grammar))
+
+    if cache:
+        key = '%s %s' % (grammar_hash(nodes), _grammar_code(nodes))
+        filename = os.path.join(_cache_dir(cache), 'fused-%s-%s.marshal' % (
+            hashlib.sha1(key.encode('utf-8')).hexdigest(), _code_digest()))
+        if _load_fused(nodes, filename):
+            return grammar
+
+    regular = _RegularGrammar()
+    fused = _fuse(grammar, nodes, regular)
+
+    if cache:
+        _save_fused(nodes, fused, regular, filename)
+
+    return grammar
+
+def _fuse(grammar, nodes, regular):
+    ''' fuse (see fuse) the regular parts of grammar, whose nodes are nodes,
+        returning the list of those which were. '''
+
+    # a regular node is worth fusing if something that isn't regular uses
+    # it (or it's the whole grammar).  Otherwise its parent will do.
+    wanted = set([id(grammar)])
+    for node in nodes:
+        if not regular.is_regular(node):
+            wanted.update(id(p) for p in node.subparsers())
+
+    fused = []
+    for node in nodes:
+        if id(node) not in wanted \
+        or _parse_owner(node) in _TRIVIAL \
+        or not regular.is_regular(node):
+            continue
+        try:
+            fused_node = _Fused(node, regular)
+            fused_node.regex  # pylint: disable=pointless-statement
+            fused_node.install()
+            fused.append(node)
+        except (re.error, AssertionError, OverflowError, RuntimeError):
+            # too big for this re module (python 2 allows only 100 groups).
+            # The parts of it may still fuse happily by themselves:
+            for part in node.subparsers():
+                if _parse_owner(part) not in _TRIVIAL:
+                    fused.extend(_fuse(part, list(walk(part)), regular))
+
+    return fused
+
+def reorder(grammar, filename):
+    ''' put the Either options of grammar in the order saved (by a
+        pcprofile.OptionProfile) in filename.  Does nothing (and returns
+        False) if the file isn't there, or was made for a different grammar.
+        Call it before fuse(). '''
+    try:
+        with open(filename, 'rb') as order_file:
+            saved_hash, orders = marshal.load(order_file)
+    except (IOError, OSError, EOFError, ValueError, TypeError):
+        return False
+
+    nodes = list(walk(grammar))
+    if saved_hash != grammar_hash(nodes):
+        return False
+
+    for i, order in orders.items():
+        either = nodes[i]
+        either.original_options = either.options
+        either.options = [either.options[j] for j in order]
+    return True
+
+################################################################################
+# Matching lots of short texts at once:
+
+def parse_many(parser, texts, whole=False):
+    ''' match parser against the start of each of texts (variable names,
+        numbers... from a database export, say), and return (matched,
+        lengths):  arrays of 1 or 0 for whether each one matched, and how
+        much of it did.  With whole=True, only the ones it matches all of
+        count as matched.  No trees are built.  If parser is regular (see
+        fuse), it's all one compiled regexp, with no parsers run, and no
+        NotHere for the ones which don't match. '''
+    regex = _regex_for(parser)
+    if regex is not None:
+        texts = texts if isinstance(texts, (list, tuple)) else list(texts)
+        found = map(regex.match, texts)
+        lengths = array('i', [m.end() if m else 0 for m in found])
+        if whole:
+            return array('B', [m is not None and m.end() == len(text)
+                               for m, text in izip(found, texts)]), lengths
+        return array('B', [m is not None for m in found]), lengths
+
+    matched = array('B')
+    lengths = array('i')
+    match = parser.match
+    for text in texts:
+        try:
+            length = match(text)
+        except NotHere:
+            matched.append(0)
+            lengths.append(0)
+            continue
+        matched.append(not whole or length == len(text))
+        lengths.append(length)
+    return matched, lengths
+
+def _regex_for(parser):
+    ''' the compiled regexp which matches the same as parser, or None if
+        it isn't regular (or is too big for the re module). '''
+    fused = _fused(parser)
+    if fused is not None:
+        return fused.regex
+    regular = _RegularGrammar()
+    if not regular.is_regular(parser):
+        return None
+    try:
+        return regular.regex(parser)
+    except (re.error, AssertionError, OverflowError, RuntimeError):
+        return None
+
+################################################################################
+# Saving (and loading) which parts of a grammar are fused, and their patterns:
+
+def _cache_dir(cache):
+    ''' the directory to use for cache (True for the default one) '''
+    if cache is True:
+        return os.path.join(os.environ.get('XDG_CACHE_HOME')
+                            or os.path.join(os.path.expanduser('~'), '.cache'),
+                            'pc.py')
+    return cache
+
+_SOURCE_DIGESTS = {}
+
+def _source_digest(filename):
+    ''' a (short) hash of the python source of module file filename, or ''
+        if it can't be read. '''
+    if filename not in _SOURCE_DIGESTS:
+        try:
+            with open(os.path.splitext(filename)[0] + '.py', 'rb') as source:
+                digest = hashlib.sha1(source.read()).hexdigest()[:12]
+        except (IOError, OSError):
+            digest = ''
+        _SOURCE_DIGESTS[filename] = digest
+    return _SOURCE_DIGESTS[filename]
+
+def _code_digest():
+    ''' a (short) hash of pc.py's own source, so that a cache made by any
+        other version of it is never used. '''
+    return _source_digest(__file__) or __version__
+
+def _grammar_code(nodes):
+    ''' hashes of the source of each module (other than pc.py) which any
+        of the classes of nodes (or their bases) are defined in - so that
+        a cache is never used for a grammar whose code has changed. '''
+    files = set()
+    for cls in set(type(node) for node in nodes):
+        for base in cls.__mro__:
+            filename = getattr(sys.modules.get(base.__module__), '__file__',
+                               None)
+            if filename is not None:
+                files.add(filename)
+    files.discard(__file__)
+    return ','.join(_source_digest(name) for name in sorted(files))
+
+# (cache files which haven't been used for this long are cleared out)
+CACHE_DAYS = 30
+
+def _signature(node, index):
+    ''' describe node (its class and settings), with any parsers it uses
+        given by their index. '''
+
+    def describe(value):
+        if isinstance(value, Parsable):
+            return '#%i' % index[id(value)]
+        elif isinstance(value, (list, tuple)):
+            return '(%s)' % ','.join(describe(v) for v in value)
+        elif hasattr(value, 'pattern'):
+            return '/%s/%i' % (value.pattern, value.flags)
+        elif isinstance(value, dict):
+            return ''  # (.data, which is made from the rest)
+        return repr(value)
+
+    # (and which class's parse it uses - a subclass may have its own)
+    owner = _parse_owner(node)
+
+    # (leaving out any .parse & .match put there by fuse, and private caches)
+    return '%s.%s:%s.%s(%s)' % (type(node).__module__, type(node).__name__,
+                                owner.__module__, owner.__name__,
+                                ','.join('%s=%s' % (name, describe(value))
+                                         for name, value
+                                         in sorted(vars(node).items())
+                                         if not name.startswith('_')
+                                         and not callable(value)))
+
+def grammar_hash(grammar):
+    ''' a hash of the structure of a grammar (every parser in it, and
+        their settings), and the version of pc.py. grammar may also be the
+        list(walk(grammar)), if you already have it. '''
+    nodes = grammar if isinstance(grammar, list) else list(walk(grammar))
+    index = dict((id(node), i) for i, node in enumerate(nodes))
+
+    digest = hashlib.sha1()
+    digest.update(('pc.py %s, python %i.%i\n' % ((__version__, )
+                                                + sys.version_info[:2]))
+                  .encode('utf-8'))
+    for node in nodes:
+        digest.update((_signature(node, index) + '\n').encode('utf-8'))
+    return digest.hexdigest()
+
+def _load_fused(nodes, filename):
+    ''' fuse nodes according to a saved cache file.  Returns False if there
+        isn't a (usable) one. '''
+    try:
+        with open(filename, 'rb') as cache_file:
+            fused, patterns = marshal.load(cache_file)
+    except (IOError, OSError, EOFError, ValueError, TypeError):
+        return False
+    try:
+        os.utime(filename, None)    # (still in use - see _clear_cache)
+    except OSError:
+        pass
+
+    regular = _RegularGrammar()
+    for i, pattern in patterns.items():
+        regular.patterns[id(nodes[i])] = pattern
+    for i in fused:
+        _Fused(nodes[i], regular).install()
+    return True
+
+def _save_fused(nodes, fused, regular, filename):
+    ''' save which nodes were fused (and the patterns they & their parts
+        use) to filename.  Failing to is not a problem. '''
+    index = dict((id(node), i) for i, node in enumerate(nodes))
+    patterns = {}
+    for root in fused:
+        for node in walk(root):
+            patterns[index[id(node)]] = regular.pattern(node)
+
+    try:
+        directory = os.path.dirname(filename)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        import tempfile     # (slow to import, and only needed here)
+        handle, temp_name = tempfile.mkstemp(dir=directory)
+        with os.fdopen(handle, 'wb') as cache_file:
+            marshal.dump(([index[id(node)] for node in fused], patterns),
+                         cache_file)
+        os.rename(temp_name, filename)
+        _clear_cache(directory)
+    except (IOError, OSError):
+        pass
+
+def _clear_cache(directory):
+    ''' remove the cache files in directory made by other versions of pc.py,
+        or not used for CACHE_DAYS. '''
+    current = '-%s.marshal' % _code_digest()
+    too_old = time.time() - CACHE_DAYS * 24 * 60 * 60
+    for name in os.listdir(directory):
+        if not (name.startswith('fused-') and name.endswith('.marshal')):
+            continue
+        path = os.path.join(directory, name)
+        try:
+            if not name.endswith(current) or os.path.getmtime(path) < too_old:
+                os.unlink(path)
+        except OSError:
+            pass
+
 # TODO: figure out if recursion limitiation has memory leak. ? add 'del' on
 #       raising NotHere as well.
@@ -0,0 +1,581 @@
+'''
+    pcanalyze.py - Copyright (C) 2014 Daniel Fairhead
+    ------------------------------------------
+    Static analysis of pc.py grammars: which parsers can match nothing at
+    all (nullable), which characters a match can start with (FIRST), and
+    which can come after one (FOLLOW).
+
+    And, from those, mistakes in a grammar which make it slow (or wrong),
+    without having to parse anything:
+
+        python pcanalyze.py php:PHP_BLOCK
+
+    lists options which can never match (shadowed), options which start the
+    same way (so which mean going back and parsing the same thing again -
+    exponentially, in some grammars), Multiples of things which can match
+    nothing, Words which eat whatever was meant to come after them, and left
+    recursion - each with the name of the rule it's in.
+    ------------------------------------------
+    GPL3 Licenced.
+
+    pc.py is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    py.py is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with pc.py.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+
+import importlib
+import sys
+
+from pc import Parsable, Nothing, SingleChar, SpecificWord, Word, Until, \
+               Joined, NamedJoin, Either, Multiple, Skipper, SeparatedBy, \
+               Trivia, WithTrivia, And, Guard, Lazy, walk, _parse_owner
+
+class Analysis(object):
+    ''' nullable, FIRST & FOLLOW for every parser in a grammar.  FIRST and
+        FOLLOW sets are frozensets of characters (and '' for the end of the
+        text, in FOLLOW), or None when it could be anything (Until, Regex,
+        and any parsers this doesn't know about).  Everything is worked out
+        up front (to a fixed point, so recursive grammars are fine) - so
+        don't change the grammar afterwards. '''
+
+    def __init__(self, grammar):
+        self.nodes = list(walk(grammar))
+        self._nullable = dict((id(node), False) for node in self.nodes)
+        self._first = dict((id(node), frozenset()) for node in self.nodes)
+
+        changed = True
+        while changed:
+            changed = False
+            for node in self.nodes:
+                nullable, first = self._rule(node)
+                if nullable != self._nullable[id(node)] \
+                or first != self._first[id(node)]:
+                    self._nullable[id(node)] = nullable
+                    self._first[id(node)] = first
+                    changed = True
+
+        self._follow = self._follows(grammar)
+
+    def nullable(self, parser):
+        ''' can parser ever match without reading anything? '''
+        return self._nullable[id(parser)]
+
+    def first(self, parser):
+        ''' the characters which a (non-empty) match of parser can start
+            with, or None if it could be anything. '''
+        return self._first[id(parser)]
+
+    def follow(self, parser):
+        ''' the characters which could come straight after a match of parser
+            ('' for the end of the text), or None if it could be anything. '''
+        return self._follow[id(parser)]
+
+    def _sequence(self, parts):
+        ''' (nullable, first) of parts, one after the other. '''
+        first = frozenset()
+        for part in parts:
+            part_first = self._first[id(part)]
+            if part_first is None:
+                return all(self._nullable[id(p)] for p in parts), None
+            first |= part_first
+            if not self._nullable[id(part)]:
+                return False, first
+        return True, first
+
+    def _rule(self, node):  # pylint: disable=too-many-return-statements
+        ''' (nullable, first) of node, from what's known of its parts. '''
+        owner = _parse_owner(node)
+
+        if owner is Nothing:
+            return True, frozenset()
+        elif owner is SingleChar:
+            return False, frozenset(node.letter)
+        elif owner is SpecificWord:
+            return not node.word, frozenset(node.word[:1])
+        elif owner is Word:
+            return False, frozenset(node.chrs)
+        elif owner is Until:
+            return not node.fail_on_eof or not node.ending, None
+        elif owner in (Joined, NamedJoin, Guard):
+            return self._sequence(list(node.subparsers()))
+        elif owner is WithTrivia:
+            return self._sequence([node.trivia, node.actual, node.trivia])
+        elif owner is Trivia:
+            return True, self._first[id(node.skip)]
+        elif owner is And:
+            return True, frozenset()    # (reads nothing itself)
+        elif owner is Lazy:
+            return self._nullable[id(node.parser)], self._first[id(node.parser)]
+        elif owner is Either:
+            first = frozenset()
+            for option in node.options:
+                if first is not None:
+                    option_first = self._first[id(option)]
+                    first = None if option_first is None \
+                        else first | option_first
+            return any(self._nullable[id(o)] for o in node.options), first
+        elif owner in (Multiple, Skipper):
+            return node.allow_none or self._nullable[id(node.original)], \
+                   self._first[id(node.original)]
+        elif owner is SeparatedBy:
+            nullable = not node.min or self._nullable[id(node.item)]
+            if self._nullable[id(node.item)]:
+                return nullable, self._sequence([node.item,
+                                                 node.separator])[1]
+            return nullable, self._first[id(node.item)]
+
+        return True, None  # Regex, or anything we don't know about.
+
+    def disjoint(self, one, other):
+        ''' can one and other never both match (at the same place)?  True
+            only if that's certain:  neither can match nothing, and they
+            start with different characters - after any trivia which they
+            both start with (which reads the same either way). '''
+        for one, other in self._past_trivia(one, other):
+            first, other_first = self._first[id(one)], self._first[id(other)]
+            if first is None or other_first is None \
+            or self._nullable[id(one)] or self._nullable[id(other)] \
+            or first & other_first:
+                return False
+        return True
+
+    def _past_trivia(self, one, other):
+        ''' the pairs of parsers to compare, to tell whether one and other
+            could start the same way:  what comes after the trivia they both
+            start with (each option, for an Either) - or just (one, other). '''
+        trivia, after = self._after_trivia(one)
+        other_trivia, other_after = self._after_trivia(other)
+        if trivia is not None and trivia is other_trivia:
+            return [(a, b) for a in after for b in other_after]
+        return [(one, other)]
+
+    def _after_trivia(self, parser, seen=()):
+        ''' (trivia, [the parsers after it]) if parser starts with some
+            trivia and then something which can't match nothing - for an
+            Either, each of its options, which must all start with the same
+            trivia - else (None, None) '''
+        while True:
+            owner = _parse_owner(parser)
+            if owner in (Lazy, Guard):
+                parser = parser.parser
+            elif owner is Joined and parser.parts:
+                parser = parser.parts[0]
+            else:
+                break
+        if owner is Either and parser.options and parser not in seen:
+            found = [self._after_trivia(option, seen + (parser, ))
+                     for option in parser.options]
+            trivia = found[0][0]
+            if trivia is not None \
+            and all(option_trivia is trivia for option_trivia, _ in found):
+                return trivia, [after for _, afters in found
+                                for after in afters]
+        elif owner is WithTrivia and not self._nullable[id(parser.actual)]:
+            return parser.trivia, [parser.actual]
+        return None, None
+
+    def _follows(self, grammar):
+        ''' {id(parser): FOLLOW} for every parser in grammar. '''
+        follow = dict((id(node), frozenset()) for node in self.nodes)
+        follow[id(grammar)] = frozenset([''])
+
+        changed = True
+        while changed:
+            changed = False
+            for node in self.nodes:
+                for part, after in self._followers(node, follow[id(node)]):
+                    new = _union(follow[id(part)], after)
+                    if new != follow[id(part)]:
+                        follow[id(part)] = new
+                        changed = True
+        return follow
+
+    def _then(self, parts, after):
+        ''' what could come first:  parts, one after the other, and then
+            after (a FOLLOW set). '''
+        nullable, first = self._sequence(parts)
+        return _union(first, after) if nullable else first
+
+    def _followers(self, node, after):
+        ''' (part, what could follow it) for each part of node, when after
+            could follow node. '''
+        owner = _parse_owner(node)
+
+        if owner in (Joined, NamedJoin, Guard):
+            parts = list(node.subparsers())
+            return [(part, self._then(parts[i + 1:], after))
+                    for i, part in enumerate(parts)]
+        elif owner is WithTrivia:
+            return [(node.trivia, self._then([node.actual, node.trivia],
+                                             after)),
+                    (node.actual, self._then([node.trivia], after)),
+                    (node.trivia, after)]
+        elif owner is Trivia:
+            return [(node.skip, after)]
+        elif owner is And:
+            return [(node.predicate, None)]   # (anything, as it's lookahead)
+        elif owner is Lazy:
+            return [(node.parser, after)]
+        elif owner is Either:
+            return [(option, after) for option in node.options]
+        elif owner in (Multiple, Skipper):
+            return [(node.original, self._then([node.original], after))]
+        elif owner is SeparatedBy:
+            # (a list can stop after any item, or a trailing separator)
+            return [(node.item, _union(self._first[id(node.separator)],
+                                       after)),
+                    (node.separator, self._then(
+                        [node.item], after if node.trailing else frozenset()))]
+        return []
+
+    ############################################################################
+    # Mistakes:
+
+    def leading(self, parser):
+        ''' the parsers which parser can call at the very place it starts
+            (before it's read anything). '''
+        owner = _parse_owner(parser)
+
+        if owner in (Joined, NamedJoin, Guard):
+            leading = []
+            for part in parser.subparsers():
+                leading.append(part)
+                if not self._nullable[id(part)]:
+                    break
+            return leading
+        elif owner is WithTrivia:
+            return [parser.trivia, parser.actual]
+        elif owner is Trivia:
+            return [parser.skip]
+        elif owner is And:
+            return [parser.predicate]
+        elif owner is Lazy:
+            return [parser.parser]
+        elif owner is Either:
+            return list(parser.options)
+        elif owner in (Multiple, Skipper):
+            return [parser.original]
+        elif owner is SeparatedBy:
+            if self._nullable[id(parser.item)]:
+                return [parser.item, parser.separator]
+            return [parser.item]
+        return []
+
+    def _starts(self, parser):
+        ''' parser, and everything it could start by calling (and they
+            could start with...), nearest first - but not what's inside
+            trivia. '''
+        found = [parser]
+        seen = set([id(parser)])
+        for node in found:
+            if _parse_owner(node) is Trivia:
+                continue
+            for part in self.leading(node):
+                if id(part) not in seen:
+                    seen.add(id(part))
+                    found.append(part)
+        return found
+
+    def _literal(self, parser, seen=()):
+        ''' (the text which every match of parser starts with, is that all
+            of every match?) '''
+        owner = _parse_owner(parser)
+        if owner is SingleChar:
+            return parser.letter, True
+        elif owner is SpecificWord:
+            return parser.word, True
+        elif owner is Nothing:
+            return '', True
+        elif owner in (Lazy, Guard):
+            return self._literal(parser.parser, seen)
+        elif owner in (Joined, NamedJoin) and parser not in seen:
+            text = ''
+            for part in parser.subparsers():
+                part_text, complete = self._literal(part, seen + (parser, ))
+                text += part_text
+                if not complete:
+                    return text, False
+            return text, True
+        return '', False
+
+    def _shadows(self, earlier, later):
+        ''' does earlier (an option of an Either) always match wherever the
+            later one could?  (and so the later one is never used.) '''
+        if self._nullable[id(later)]:
+            return False
+        elif earlier is later:
+            return True
+
+        owner = _parse_owner(earlier)
+        if owner in (SingleChar, Word):
+            # (which match whenever the next character is one of theirs)
+            first = self._first[id(later)]
+            return first is not None and first <= self._first[id(earlier)]
+        elif owner is SpecificWord:
+            return bool(earlier.word) \
+               and self._literal(later)[0].startswith(earlier.word)
+        return False
+
+    def shadowed(self, either):
+        ''' (earlier, later) for each option of either which can never be
+            the one that matches, as an earlier option always matches first:
+            Either('<', '<<') will never match '<<'. '''
+        found = []
+        for i, later in enumerate(either.options):
+            for earlier in either.options[:i]:
+                if self._shadows(earlier, later):
+                    found.append((earlier, later))
+                    break
+        return found
+
+    def overlapping(self, either):
+        ''' (earlier, later, shared) for each pair of options of either which
+            could both match at the same place - so when the earlier one
+            fails, all it read is thrown away, and the later one is tried
+            from the same place.  shared is the parser (if any) which they
+            both start with, and so which is parsed all over again. '''
+        shadowed = set(id(later) for _, later in self.shadowed(either))
+        options = [option for option in either.options
+                   if id(option) not in shadowed]
+        cheap = (Nothing, SingleChar, SpecificWord, Word, Trivia, Skipper, And)
+
+        found = []
+        for i, later in enumerate(options):
+            for earlier in options[:i]:
+                if _parse_owner(earlier) in cheap \
+                or not self._may_overlap(earlier, later):
+                    # (a plain word fails as soon as it's wrong, so trying
+                    #  it first costs next to nothing)
+                    continue
+                starts = set(id(node) for node in self._starts(earlier))
+                shared = [node for node in self._starts(later)
+                          if id(node) in starts
+                          and _parse_owner(node) not in cheap]
+                found.append((earlier, later, shared[0] if shared else None))
+        return found
+
+    def _may_overlap(self, one, other):
+        ''' could one and other both read (some of) the same text, at the
+            same place?  (not counting either matching nothing.) '''
+        for one, other in self._past_trivia(one, other):
+            text, other_text = self._literal(one)[0], self._literal(other)[0]
+            if not (text.startswith(other_text)
+                    or other_text.startswith(text)):
+                continue
+            first, other_first = self._first[id(one)], self._first[id(other)]
+            if first is None or other_first is None or first & other_first:
+                return True
+        return False
+
+    def left_recursion(self):
+        ''' the loops of parsers which can call themselves again at the same
+            place, without reading anything first:  a list of parsers for
+            each, starting and ending with the same one.  (Either stops the
+            loop by failing - so these never match the way they look like
+            they should.) '''
+        loops = []
+        looped = set()
+        for node in self.nodes:
+            if id(node) in looped:
+                continue
+            path = self._path(node, node)
+            if path:
+                loops.append(path)
+                looped.update(id(part) for part in path)
+        return loops
+
+    def _path(self, start, end):
+        ''' the parsers from start to end, through leading() (at least one
+            step), or None if there's no way. '''
+        came_from = {}
+        todo = [start]
+        while todo:
+            node = todo.pop()
+            for part in self.leading(node):
+                if part is end:
+                    path = [end, node]
+                    while path[-1] is not start:
+                        path.append(came_from[id(path[-1])])
+                    return path[::-1]
+                if id(part) not in came_from and part is not start:
+                    came_from[id(part)] = node
+                    todo.append(part)
+        return None
+
+    def starved(self, word):
+        ''' does word (a Word) always eat the start of whatever comes after
+            it?  (so that can never match.) '''
+        follow = self._follow[id(word)]
+        return bool(follow) and '' not in follow \
+           and follow <= self._first[id(word)]
+
+    def findings(self, names=None):
+        ''' all the mistakes in the grammar, as Findings, the worst first.
+            names ({name: parser}, such as vars(php)) are used for saying
+            which rule each is in. '''
+        named = self._rules(names or {})
+
+        def name(parser):
+            ''' parser's name, or failing that, what it is (and which rule
+                it's part of). '''
+            return named.get(id(parser), repr(parser))
+
+        found = []
+        for path in self.left_recursion():
+            found.append(Finding('left-recursion', path[0], name(path[0]),
+                                 'calls itself without reading anything: '
+                                 + ' -> '.join(name(node) for node in path)))
+
+        for node in self.nodes:
+            owner = _parse_owner(node)
+            if owner is Either:
+                for earlier, later in self.shadowed(node):
+                    found.append(Finding(
+                        'shadowed', node, name(node), '%s can never match, '
+                        'as %s always matches first'
+                        % (name(later), name(earlier))))
+                for earlier, later, shared in self.overlapping(node):
+                    if shared is None:
+                        found.append(Finding(
+                            'overlap', node, name(node), '%s and %s can start '
+                            'the same way' % (name(earlier), name(later))))
+                    elif any(part is node for part in walk(shared)):
+                        found.append(Finding(
+                            'exponential', node, name(node), '%s and %s both '
+                            'start with %s, which has %s in it - so the time '
+                            'doubles with each level of nesting'
+                            % (name(earlier), name(later), name(shared),
+                               name(node))))
+                    else:
+                        found.append(Finding(
+                            'overlap', node, name(node), '%s and %s both start '
+                            'with %s, so it is parsed again when %s fails'
+                            % (name(earlier), name(later), name(shared),
+                               name(earlier))))
+            elif owner in (Multiple, Skipper) \
+            and self._nullable[id(node.original)]:
+                found.append(Finding(
+                    'nullable-repeat', node, name(node), '%s can match '
+                    'nothing, which stops the repeat' % name(node.original)))
+            elif owner is Word and self.starved(node):
+                found.append(Finding(
+                    'starved', node, name(node), 'always reads the start of '
+                    'what comes after it (%s)'
+                    % ''.join(sorted(self._follow[id(node)]))))
+
+        return sorted(found, key=lambda f: Finding.KINDS.index(f.kind))
+
+    def _rules(self, names):
+        ''' {id(parser): name} for every parser in the grammar:  its own name
+            from names, or else what it is, in the innermost named rule it's
+            part of (the smallest - and then the nearest).  That may be a
+            rule which isn't in the grammar itself:  STRING, whose options
+            an Either has taken in as its own. '''
+        if not self.nodes:
+            return {}
+        rules = rule_names(self.nodes[0], names)
+        nodes = dict((id(node), node) for node in self.nodes)
+
+        everything = {}
+        for name, value in names.items():
+            if isinstance(value, Parsable):
+                everything.setdefault(id(value), (value, []))[1].append(name)
+
+        innermost = {}  # id(part) -> (rule's size, depth in it, rule's name)
+        for rule, found in everything.values():
+            rule_name = '/'.join(sorted(found))
+            depths = _depths(rule)
+            for key, depth in depths.items():
+                if depth and key in nodes and key not in rules:
+                    place = (len(depths), depth, rule_name)
+                    if key not in innermost or place < innermost[key]:
+                        innermost[key] = place
+        for key, (_, _, rule_name) in innermost.items():
+            rules[key] = '%r in %s' % (nodes[key], rule_name)
+
+        for node in self.nodes:
+            rules.setdefault(id(node), repr(node))
+        return rules
+
+def _depths(parser):
+    ''' {id(part): how many steps down from parser it is} for everything in
+        parser (and parser itself, at 0). '''
+    depths = {id(parser): 0}
+    todo = [parser]
+    while todo:
+        node = todo.pop(0)
+        for part in node.subparsers():
+            if id(part) not in depths:
+                depths[id(part)] = depths[id(node)] + 1
+                todo.append(part)
+    return depths
+
+def _union(one, other):
+    ''' one | other, where either being None (anything) makes it None. '''
+    if one is None or other is None:
+        return None
+    return one | other
+
+class Finding(object):
+    ''' a mistake (of one of KINDS, worst first) in a grammar:  which
+        parser it's in, that parser's name (rule), and what's wrong. '''
+
+    KINDS = ('left-recursion', 'shadowed', 'nullable-repeat', 'starved',
+             'exponential', 'overlap')
+
+    def __init__(self, kind, parser, rule, message):
+        self.kind = kind
+        self.parser = parser
+        self.rule = rule
+        self.message = message
+
+    def __repr__(self):
+        return '<Finding:%s in %s>' % (self.kind, self.rule)
+
+    def __str__(self):
+        return '%s: %s: %s' % (self.kind, self.rule, self.message)
+
+def rule_names(grammar, names):
+    ''' {id(parser): name} for each parser in grammar which has a name in
+        names ({name: parser}).  Where one parser has several names, they're
+        all used (A/B). '''
+    nodes = set(id(node) for node in walk(grammar))
+    named = {}
+    for name, value in names.items():
+        if isinstance(value, Parsable) and id(value) in nodes:
+            named.setdefault(id(value), []).append(name)
+    return dict((node, '/'.join(sorted(found)))
+                for node, found in named.items())
+
+################################################################################
+
+def load_grammar(name):
+    ''' 'module:NAME' -> the grammar called NAME in module. '''
+    module, _, attribute = name.partition(':')
+    return getattr(importlib.import_module(module), attribute)
+
+def main(args):
+    ''' python pcanalyze.py module:GRAMMAR - print what's wrong with it. '''
+    if len(args) != 1:
+        sys.stderr.write('usage: python pcanalyze.py module:GRAMMAR\n')
+        return 2
+
+    module, _, _ = args[0].partition(':')
+    findings = Analysis(load_grammar(args[0])).findings(
+        vars(importlib.import_module(module)))
+    for finding in findings:
+        print(finding)
+    return 1 if findings else 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
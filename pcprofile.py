@@ -0,0 +1,493 @@
+'''
+    pcprofile.py - Copyright (C) 2014 Daniel Fairhead
+    ------------------------------------------
+    Profiling pc.py grammars against real texts.
+
+    Reordering Either options by how often they are actually used:
+
+        python pcprofile.py reorder php:PHP_BLOCK php.order corpus/*.php
+
+    parses the corpus, counts which option of each Either matched, and saves
+    a better order for every Either where the change provably can't make
+    any difference to the results.  php.py uses php.order (if it's there)
+    when it's loaded.
+
+    Which paths through the grammar the time (or text) goes on, as
+    collapsed stacks for flamegraph tools:
+
+        python pcprofile.py stacks php:PHP_BLOCK [--chars] slow.php \\
+            | flamegraph.pl > slow.svg
+
+    And which rules make the trees (and the garbage) which use up memory:
+
+        python pcprofile.py memory php:PHP_BLOCK big.php
+    ------------------------------------------
+    GPL3 Licenced.
+
+    pc.py is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    py.py is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with pc.py.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+
+from contextlib import contextmanager
+import importlib
+import marshal
+import sys
+from sys import getsizeof
+from timeit import default_timer
+
+# (reorder is in pc.py, so grammars can use it without importing all this)
+from pc import Parsable, Either, NotHere, walk, grammar_hash, reorder, \
+               _parse_owner, _fused  # pylint: disable=unused-import
+from pcanalyze import Analysis, rule_names, load_grammar
+
+################################################################################
+# Reordering Either options:
+
+class _Counted(Parsable):
+    ''' stands in for an option of an Either while profiling, counting how
+        often it's tried, and how often it's the one that matched. '''
+
+    def __init__(self, option):
+        self.option = option
+        self.tries = 0
+        self.wins = 0
+
+    def parse(self, text, position=0):
+        self.tries += 1
+        result = self.option.parse(text, position)
+        if result[0]:
+            self.wins += 1
+        return result
+
+class OptionProfile(object):
+    ''' counts which option of each Either in a grammar matches, while
+        parsing (within `with profile:`), and works out better orders from
+        that.
+
+            profile = OptionProfile(PHP_BLOCK)
+            with profile:
+                for text in corpus:
+                    PHP_BLOCK.parse(text)
+            print profile.report()
+            profile.save('php.order')
+
+        (Eithers which have been fused aren't run as such, so aren't counted
+        - or changed.) '''
+
+    def __init__(self, grammar):
+        self.grammar = grammar
+        with _pristine(grammar):
+            self.nodes = list(walk(grammar))
+            self.hash = grammar_hash(self.nodes)
+        # (Eithers inside fused parsers are matched by their regexps, which
+        #  are built from the options as they are now - so leave those be.)
+        fused = set(id(part) for node in self.nodes if _fused(node)
+                    for part in walk(node))
+        self.eithers = [node for node in self.nodes
+                        if _parse_owner(node) is Either
+                        and id(node) not in fused]
+        # either -> [ _Counted, ... ] (in the order of either.options)
+        self.counts = dict((id(either), [_Counted(o) for o in either.options])
+                           for either in self.eithers)
+
+    def __enter__(self):
+        for either in self.eithers:
+            either.options = self.counts[id(either)]
+        return self
+
+    def __exit__(self, *exc_info):
+        for either in self.eithers:
+            either.options = [counted.option for counted in either.options]
+
+    def wins(self, either):
+        ''' [how often each option of either matched], and how often none
+            of them did. '''
+        counted = self.counts[id(either)]
+        wins = [c.wins for c in counted]
+        return wins, (counted[0].tries if counted else 0) - sum(wins)
+
+    def orders(self):
+        ''' {either: [its options, in a better order]} for every Either which
+            can be (safely) improved. '''
+        analysis = Analysis(self.grammar)
+        orders = {}
+        for either in self.eithers:
+            wins, _ = self.wins(either)
+            options = list(either.options)
+            order = _reorder(options, wins, analysis.disjoint)
+            if order != vars(either).get('original_options', options):
+                orders[either] = order
+        return orders
+
+    def tries(self, either, options):
+        ''' how many options would have been tried (in all) by either, with
+            its options in this order. '''
+        wins, misses = self.wins(either)
+        won = dict(zip([id(o) for o in either.options], wins))
+        return sum(won[id(option)] * (i + 1)
+                   for i, option in enumerate(options)) \
+             + misses * len(options)
+
+    def report(self):
+        ''' how much difference the new orders should make. '''
+        orders = self.orders()
+        lines = []
+        before = after = 0
+        for either in self.eithers:
+            now = self.tries(either, either.options)
+            then = self.tries(either, orders.get(either, either.options))
+            before += now
+            after += then
+            if now != then:
+                lines.append('%8i -> %8i tries  #%i %r' % (
+                    now, then, self.nodes.index(either), either))
+
+        lines.append('options tried: %i -> %i (%.0f%% fewer)' % (
+            before, after, 100.0 * (before - after) / before if before else 0))
+        return '\n'.join(lines)
+
+    def save(self, filename):
+        ''' save the new orders, to be used by reorder(grammar, filename). '''
+        index = dict((id(node), i) for i, node in enumerate(self.nodes))
+        orders = {}
+        for either, options in self.orders().items():
+            # (indexes into the options as they were before any reorder())
+            original = vars(either).get('original_options', either.options)
+            orders[index[id(either)]] = [original.index(o) for o in options]
+        with open(filename, 'wb') as order_file:
+            marshal.dump((self.hash, orders), order_file)
+
+def _reorder(options, wins, disjoint):
+    ''' options, with the ones that win most often as early as possible -
+        but never moving one before another which it isn't disjoint from. '''
+    remaining = list(zip(options, wins))
+    order = []
+    while remaining:
+        # the options which could go next (nothing before them conflicts):
+        ready = [i for i, (option, _) in enumerate(remaining)
+                 if all(disjoint(option, earlier)
+                        for earlier, _ in remaining[:i])]
+        best = max(ready, key=lambda i: (remaining[i][1], -i))
+        order.append(remaining.pop(best)[0])
+    return order
+
+@contextmanager
+def _pristine(grammar):
+    ''' (within this) any Eithers which reorder() has changed are put back
+        as they were, so that the grammar has the same hash and indexes as
+        it did before. '''
+    changed = [node for node in walk(grammar)
+               if 'original_options' in vars(node)]
+    reordered = [node.options for node in changed]
+    for node in changed:
+        node.options = node.original_options
+        del node.original_options
+    try:
+        yield
+    finally:
+        for node, options in zip(changed, reordered):
+            node.original_options = node.options
+            node.options = options
+
+################################################################################
+# Rule stacks (for flamegraphs):
+
+class RuleStacks(object):
+    ''' while profiling (within `with stacks:`), keeps track of the stack of
+        named rules being parsed - PHP_BLOCK;STATEMENT_;IF;BLOCK;... - and
+        how much time each stack takes, and how many characters it reads,
+        itself (not counting the named rules it calls).
+
+            stacks = RuleStacks(PHP_BLOCK, vars(php))
+            with stacks:
+                PHP_BLOCK.parse(text)
+            stacks.save('php.stacks', 'time')
+
+        names is {name: parser}, such as the variables of the module the
+        grammar is defined in.  Parsers without a name are counted as part
+        of whichever named rule called them.  Like pctrace, every named
+        parser gets a profiling .parse of its own while profiling, so only
+        profile one parse at a time.  (.match isn't profiled, and neither
+        is anything inside a fused parser.) '''
+
+    WEIGHTS = ('time', 'chars')
+
+    def __init__(self, grammar, names):
+        self.names = rule_names(grammar, names)
+        self.nodes = [node for node in walk(grammar)
+                      if id(node) in self.names]
+        # (rule, rule, ...) -> [seconds, chars]
+        self.stacks = {}
+        self._frames = []
+        self._saved = None
+
+    def __enter__(self):
+        self.install()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.uninstall()
+
+    def install(self):
+        ''' start profiling. '''
+        self._frames = []
+        self._saved = [node.__dict__.get('parse') for node in self.nodes]
+        for node in self.nodes:
+            node.parse = self._profiled(self.names[id(node)], node.parse)
+
+    def uninstall(self):
+        ''' stop profiling, and put the parsers back as they were. '''
+        for node, saved in zip(self.nodes, self._saved):
+            if saved is None:
+                del node.parse
+            else:
+                node.parse = saved
+        self._saved = None
+
+    def _profiled(self, name, parse):
+        ''' a profiling version of parse (for the rule called name). '''
+        frames = self._frames
+        stacks = self.stacks
+
+        def profiled(text, position=0):
+            # each frame is [stack, time in named rules it called, chars..]
+            stack = frames[-1][0] + (name, ) if frames else (name, )
+            frame = [stack, 0.0, 0]
+            frames.append(frame)
+            read = 0
+            start = default_timer()
+            try:
+                result = parse(text, position)
+                read = result[0]
+                return result
+            finally:
+                elapsed = default_timer() - start
+                frames.pop()
+                totals = stacks.get(stack)
+                if totals is None:
+                    totals = stacks[stack] = [0.0, 0]
+                totals[0] += max(elapsed - frame[1], 0.0)
+                totals[1] += max(read - frame[2], 0)
+                if frames:
+                    frames[-1][1] += elapsed
+                    frames[-1][2] += read
+
+        return profiled
+
+    def collapsed(self, weight='time'):
+        ''' the stacks in the 'collapsed' format which flamegraph tools read:
+            a line of `RULE;RULE;RULE count` for each one.  weight is 'time'
+            (counted in microseconds) or 'chars' (characters read by matches
+            - including ones which were then backtracked over, so the total
+            can be more than the length of the text). '''
+        column = self.WEIGHTS.index(weight)
+        scale = 1000000 if weight == 'time' else 1
+        lines = []
+        for stack, totals in sorted(self.stacks.items()):
+            count = int(round(totals[column] * scale))
+            if count:
+                lines.append('%s %i' % (';'.join(stack), count))
+        return '\n'.join(lines)
+
+    def save(self, filename, weight='time'):
+        ''' save the collapsed stacks (see collapsed) to filename. '''
+        with open(filename, 'w') as stacks_file:
+            stacks_file.write(self.collapsed(weight) + '\n')
+
+################################################################################
+# Memory:
+
+KINDS = ('dicts', 'lists', 'strings', 'bytes')
+
+class Allocations(object):
+    ''' while accounting (within `with allocations:`), counts the tree dicts,
+        lists and strings which each parser makes, and how many bytes they
+        take - and then (see settle) which of those ended up in the final
+        tree (retained), and which were thrown away by backtracking
+        (transient).
+
+            allocations = Allocations(PHP_BLOCK, vars(php))
+            with allocations:
+                allocations.settle(PHP_BLOCK.parse(text)[1])
+            print allocations.report()
+
+        Whatever is in a tree a parser returns, which its parts didn't
+        return already, is counted as made by that parser:  a Word's text,
+        a Joined's parts list, WithTrivia's copy of its node, and everything
+        from a fused parser.  (Bytes are sys.getsizeof, so not counting
+        what a dict or list refers to.)  The shared nodes of SingleChar &c.
+        aren't made per parse, so aren't counted.  As everything made is
+        kept until settle(), account for one parse at a time. '''
+
+    def __init__(self, grammar, names=None):
+        self.nodes = list(walk(grammar))
+        named = rule_names(grammar, names or {})
+        self.names = [named.get(id(node), '#%i %r' % (i, node))
+                      for i, node in enumerate(self.nodes)]
+        self.shared = set(id(node.__dict__['data']) for node in self.nodes
+                          if isinstance(node.__dict__.get('data'), dict))
+        # name -> [retained dicts, lists, strings, bytes, transient ...]
+        self.totals = {}
+        self._made = {}     # id(thing) -> (thing, node index, kind, bytes)
+        self._saved = None
+
+    def __enter__(self):
+        self.install()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.uninstall()
+
+    def install(self):
+        ''' start accounting. '''
+        self._saved = [node.__dict__.get('parse') for node in self.nodes]
+        for index, node in enumerate(self.nodes):
+            node.parse = self._accounted(index, node.parse)
+
+    def uninstall(self):
+        ''' stop accounting, and put the parsers back as they were. '''
+        for node, saved in zip(self.nodes, self._saved):
+            if saved is None:
+                del node.parse
+            else:
+                node.parse = saved
+        self._saved = None
+
+    def _accounted(self, index, parse):
+        ''' an accounting version of parse (for nodes[index]). '''
+        made = self._made
+        shared = self.shared
+
+        def accounted(text, position=0):
+            result = parse(text, position)
+            found = [result[1]]
+            while found:
+                thing = found.pop()
+                if id(thing) in made or id(thing) in shared:
+                    continue
+                if isinstance(thing, dict):
+                    made[id(thing)] = (thing, index, 0, getsizeof(thing))
+                    found.extend(value for key, value in thing.items()
+                                 if key != 'class')
+                elif isinstance(thing, list):
+                    made[id(thing)] = (thing, index, 1, getsizeof(thing))
+                    found.extend(thing)
+                elif isinstance(thing, basestring):
+                    made[id(thing)] = (thing, index, 2, getsizeof(thing))
+            return result
+
+        return accounted
+
+    def settle(self, tree):
+        ''' the parse which made tree is done:  add everything made since the
+            last settle() to the totals, as retained if it's in tree, or
+            transient if not - and then forget it.  (tree can be None, if
+            the parse failed.) '''
+        kept = set()
+        found = [tree]
+        while found:
+            thing = found.pop()
+            kept.add(id(thing))
+            if isinstance(thing, dict):
+                found.extend(v for k, v in thing.items() if k != 'class')
+            elif isinstance(thing, list):
+                found.extend(thing)
+
+        for key, (_, index, kind, size) in self._made.items():
+            totals = self.totals.get(self.names[index])
+            if totals is None:
+                totals = self.totals[self.names[index]] = [0] * 8
+            offset = 0 if key in kept else 4
+            totals[offset + kind] += 1
+            totals[offset + 3] += size
+        self._made = {}
+
+    def report(self):
+        ''' the totals for each rule, most (retained + transient) bytes
+            first. '''
+        totals = self.totals
+        lines = ['%32s  %s' % ('retained', 'transient'),
+                 '%7s %7s %7s %9s  %7s %7s %7s %9s  %s'
+                 % (KINDS + KINDS + ('rule', ))]
+        for name in sorted(totals, key=lambda n: (-totals[n][3]
+                                                  - totals[n][7], n)):
+            lines.append('%7i %7i %7i %9i  %7i %7i %7i %9i  %s'
+                         % tuple(totals[name] + [name]))
+        return '\n'.join(lines)
+
+################################################################################
+
+USAGE = '''usage: python pcprofile.py reorder module:GRAMMAR ORDER_FILE TEXT...
+       python pcprofile.py stacks module:GRAMMAR [--chars] TEXT...
+       python pcprofile.py memory module:GRAMMAR TEXT...
+'''
+
+def _parse_all(grammar, filenames):
+    ''' parse each of the files with grammar. '''
+    for filename in filenames:
+        with open(filename) as text_file:
+            try:
+                grammar.parse(text_file.read())
+            except NotHere as err:
+                sys.stderr.write('%s: %s\n' % (filename, err))
+
+def main(args):
+    ''' python pcprofile.py reorder module:GRAMMAR ORDER_FILE TEXT...
+        python pcprofile.py stacks module:GRAMMAR [--chars] TEXT...
+        python pcprofile.py memory module:GRAMMAR TEXT... '''
+    if args[:1] == ['reorder'] and len(args) >= 4:
+        grammar = load_grammar(args[1])
+        profile = OptionProfile(grammar)
+        with profile:
+            _parse_all(grammar, args[3:])
+
+        print(profile.report())
+        profile.save(args[2])
+        return 0
+
+    elif args[:1] == ['stacks'] and len(args) >= 3:
+        weight = 'chars' if '--chars' in args[2:] else 'time'
+        filenames = [arg for arg in args[2:] if arg != '--chars']
+        module, _, _ = args[1].partition(':')
+        grammar = load_grammar(args[1])
+        stacks = RuleStacks(grammar, vars(importlib.import_module(module)))
+        with stacks:
+            _parse_all(grammar, filenames)
+
+        print(stacks.collapsed(weight))
+        return 0
+
+    elif args[:1] == ['memory'] and len(args) >= 3:
+        module, _, _ = args[1].partition(':')
+        grammar = load_grammar(args[1])
+        allocations = Allocations(grammar,
+                                  vars(importlib.import_module(module)))
+        with allocations:
+            for filename in args[2:]:
+                tree = None
+                with open(filename) as text_file:
+                    try:
+                        tree = grammar.parse(text_file.read())[1]
+                    except NotHere as err:
+                        sys.stderr.write('%s: %s\n' % (filename, err))
+                allocations.settle(tree)
+
+        print(allocations.report())
+        return 0
+
+    sys.stderr.write(USAGE)
+    return 2
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
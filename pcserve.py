@@ -0,0 +1,415 @@
+'''
+    pcserve.py - Copyright (C) 2014 Daniel Fairhead
+    ------------------------------------------
+    Keeping grammars loaded (built, fused, reordered...) in a daemon, so that
+    things which parse a file at a time (editors on save, pre-commit hooks)
+    don't have to start python and build the whole grammar each time:
+
+        python pcserve.py serve php:PHP_BLOCK &
+        python pcserve.py validate index.php lib/*.php
+        cat index.php | python pcserve.py parse -
+
+    The daemon listens on a unix socket (--socket, or one in a directory only
+    the user can get into - $XDG_RUNTIME_DIR, or else one of their own in the
+    temp directory), which only the user can connect to (it reads any file it's
+    asked to).  It hands the work out to a pool of worker
+    processes (--workers, one per CPU by default), and stops by itself when
+    it's had nothing to do for a while (--idle seconds, 600 by default).
+
+    Each request and reply is a line of JSON:
+
+        {"command": "validate", "path": "/abs/index.php"}
+        {"command": "parse", "text": "<?php ... ?>", "grammar": "php:BLOCK"}
+
+        {"ok": true, "errors": []}
+        {"ok": true, "tree": {"rule": "BLOCK", "parts": [...]}}
+        {"ok": false, "error": "...", "line": 3, "column": 7}
+
+    (validate recovers from errors where the grammar can, so lists them all;
+    parse replies with the "tree".  There's no format:  none of the grammars
+    have a clean output yet, so it would only ever give the file back as it
+    was.)
+    ------------------------------------------
+    GPL3 Licenced.
+
+    pc.py is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    py.py is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with pc.py.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+
+import errno
+import getopt
+import importlib
+import json
+import multiprocessing
+import os
+import socket
+import stat
+import sys
+import tempfile
+import threading
+import time
+from SocketServer import ThreadingMixIn, UnixStreamServer, \
+                         StreamRequestHandler
+
+from pc import Session, ParseError, BudgetExceeded
+from pcanalyze import rule_names, load_grammar
+
+COMMANDS = ('parse', 'validate')
+
+def default_socket():
+    ''' where the daemon listens, unless told otherwise (one per user):  in
+        $XDG_RUNTIME_DIR, or else in a directory of the user's own (0700) in
+        the temp directory - RuntimeError if that's anyone else's. '''
+    runtime = os.environ.get('XDG_RUNTIME_DIR')
+    if runtime:
+        return os.path.join(runtime, 'pcserve.sock')
+
+    directory = os.path.join(tempfile.gettempdir(), 'pcserve-%i' % os.getuid())
+    try:
+        os.mkdir(directory, 0o700)
+    except OSError as err:
+        if err.errno != errno.EEXIST:
+            raise
+    info = os.lstat(directory)
+    if not stat.S_ISDIR(info.st_mode) or info.st_uid != os.getuid() \
+       or info.st_mode & 0o077:
+        raise RuntimeError('not a private directory: %s' % directory)
+    return os.path.join(directory, 'pcserve.sock')
+
+################################################################################
+# The work:
+
+class Grammars(object):
+    ''' the grammars being served, by their 'module:NAME', and the names of
+        their rules (from their modules).  The first one is the default. '''
+
+    def __init__(self, names, timeout=30):
+        self.order = list(names)
+        self.grammars = {}
+        self.rules = {}
+        self.timeout = timeout      # (seconds, for each parse)
+        for name in self.order:
+            grammar = load_grammar(name)
+            module = importlib.import_module(name.partition(':')[0])
+            self.grammars[name] = grammar
+            self.rules[name] = rule_names(grammar, vars(module))
+        self._replies = {}
+
+    def handle(self, request):
+        ''' the reply (a dict) to request (a dict, from JSON). '''
+        command = request.get('command')
+        name = request.get('grammar') or self.order[0]
+        if command == 'format':
+            return {'ok': False, 'error': 'format is not supported (no grammar '
+                                          'has a clean output yet)'}
+        if command not in COMMANDS:
+            return {'ok': False, 'error': 'unknown command %r' % command}
+        if name not in self.grammars:
+            return {'ok': False, 'error': 'not serving %r' % name}
+
+        key = None
+        if 'text' in request:
+            text = request['text']
+        elif 'path' in request:
+            try:
+                # (a file which hasn't changed gets the same reply again)
+                info = os.stat(request['path'])
+                key = (command, name, request['path'], info.st_mtime,
+                       info.st_size)
+                if key in self._replies:
+                    return self._replies[key]
+                with open(request['path'], 'rb') as text_file:
+                    text = text_file.read().decode('utf-8')
+            except (IOError, OSError, UnicodeDecodeError) as err:
+                return {'ok': False, 'error': str(err)}
+        else:
+            return {'ok': False, 'error': 'needs a "text" or a "path"'}
+
+        reply = self._run(command, name, text)
+        if key is not None:
+            if len(self._replies) >= 256:
+                self._replies.clear()
+            self._replies[key] = reply
+        return reply
+
+    def _run(self, command, name, text):
+        ''' the reply to command, for text, with the grammar called name. '''
+        grammar = self.grammars[name]
+        session = Session(text, timeout=self.timeout,
+                          recover=command == 'validate')
+        try:
+            length, tree = session.parse(grammar)
+            if length < len(text):
+                # (stopped before the end - at whatever it couldn't get past)
+                raise ParseError(session)
+        except (ParseError, BudgetExceeded) as err:
+            return dict(_located(err), ok=False)
+        except Exception as err:  # pylint: disable=broad-except
+            # (anything else - too deeply nested for python, say - still
+            #  gets a reply, rather than the client getting nothing.)
+            return _failed(err)
+
+        if command == 'validate':
+            return {'ok': True,
+                    'errors': [_located(err) for err in session.errors]}
+        return {'ok': True, 'tree': as_json(tree, self.rules[name])}
+
+def _failed(err):
+    ''' the reply for an unexpected exception, err. '''
+    return {'ok': False, 'error': '%s: %s' % (type(err).__name__, err)}
+
+def _located(err):
+    ''' {error, line, column} for a ParseError (or BudgetExceeded). '''
+    message = str(err)
+    where = 'line %i, column %i: ' % (err.line, err.column)
+    if message.startswith(where):
+        message = message[len(where):]
+    return {'error': message, 'line': err.line, 'column': err.column}
+
+def as_json(node, rules):
+    ''' a tree as plain dicts & lists, with each parser as the name of its
+        rule (from rules, see rule_names) or else what it is. '''
+    parser = node['class']
+    found = {'rule': rules.get(id(parser)) or repr(parser)}
+    parts = node.get('parts')
+    if parts is None:
+        found['text'] = node.get('text', '')
+    elif isinstance(parts, dict):
+        found['parts'] = dict((name, as_json(part, rules))
+                              for name, part in parts.items())
+    else:
+        found['parts'] = [as_json(part, rules) for part in parts]
+    for key in ('before', 'after'):
+        if key in node:
+            found[key] = as_json(node[key], rules)
+    if 'error' in node:
+        found['error'] = str(node['error'])
+    return found
+
+# (the worker processes' Grammars:  set before they're forked, so they start
+#  with everything already loaded.)
+_grammars = None
+
+def _work(request):
+    ''' handle request, in a worker process. '''
+    return _grammars.handle(request)
+
+################################################################################
+# The daemon:
+
+class _Handler(StreamRequestHandler):
+    ''' one connection:  one request, one reply. '''
+
+    def handle(self):
+        line = self.rfile.readline()
+        if not line:
+            return      # (just seeing if anything's listening)
+        server = self.server
+        server.busy(1)
+        try:
+            try:
+                request = json.loads(line)
+                if not isinstance(request, dict):
+                    raise ValueError('a request is a JSON object')
+            except ValueError as err:
+                reply = {'ok': False, 'error': 'bad request: %s' % err}
+            else:
+                try:
+                    reply = server.handle_request_dict(request)
+                except Exception as err:  # pylint: disable=broad-except
+                    reply = _failed(err)
+            self.wfile.write(json.dumps(reply) + '\n')
+        finally:
+            server.busy(-1)
+
+class Daemon(ThreadingMixIn, UnixStreamServer):
+    ''' serves grammars (a Grammars) on the unix socket at path, until it's
+        been idle (no requests at all) for idle seconds, or is stop()ped.
+        With workers=0, requests are handled in the daemon's own threads
+        rather than in a pool of processes. '''
+
+    daemon_threads = True
+    poll = 0.5      # (seconds between checking whether it's been idle)
+
+    def __init__(self, path, grammars, workers=None, idle=600):
+        global _grammars  # pylint: disable=global-statement
+        self.path = path
+        self.grammars = grammars
+        self.idle = idle
+        self.last = time.time()
+        self.active = 0
+        self.stopping = False
+        self._lock = threading.Lock()
+
+        _clear_stale(path)
+        UnixStreamServer.__init__(self, path, _Handler)
+        self.timeout = min(self.poll, idle)
+
+        self.pool = None
+        if workers != 0:
+            _grammars = grammars
+            self.pool = multiprocessing.Pool(workers)
+
+    def server_bind(self):
+        ''' make the socket - which only the user can connect to, as the
+            daemon reads any file it's asked to.  (it isn't listening yet,
+            so nobody else can get in before the chmod.) '''
+        UnixStreamServer.server_bind(self)
+        os.chmod(self.path, stat.S_IRUSR | stat.S_IWUSR)
+
+    def busy(self, change):
+        ''' a request has started (1) or finished (-1). '''
+        with self._lock:
+            self.active += change
+            self.last = time.time()
+
+    def handle_request_dict(self, request):
+        ''' the reply to request. '''
+        if request.get('command') == 'stop':
+            self.stopping = True
+            return {'ok': True}
+        if self.pool is None:
+            return self.grammars.handle(request)
+        return self.pool.apply(_work, (request, ))
+
+    def serve(self):
+        ''' handle requests until idle for long enough (or stopped). '''
+        try:
+            while not self.stopping:
+                self.handle_request()
+                with self._lock:
+                    if not self.active and time.time() - self.last > self.idle:
+                        break
+        finally:
+            self.close()
+
+    def close(self):
+        ''' stop listening, and stop the workers. '''
+        self.server_close()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+
+def _clear_stale(path):
+    ''' remove the socket at path if nothing's listening on it any more.
+        (and complain if something is.) '''
+    if not os.path.exists(path):
+        return
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        probe.connect(path)
+    except socket.error as err:
+        if err.errno not in (errno.ECONNREFUSED, errno.ENOENT):
+            raise
+        os.unlink(path)
+    else:
+        raise RuntimeError('already being served: %s' % path)
+    finally:
+        probe.close()
+
+################################################################################
+# The client:
+
+def request(message, path=None):
+    ''' send message (a dict) to the daemon at path, and return its reply.
+        (socket.error if there's no daemon there, RuntimeError if it doesn't
+        reply.) '''
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        connection.connect(path or default_socket())
+        connection.sendall(json.dumps(message) + '\n')
+        connection.shutdown(socket.SHUT_WR)
+        reply = b''.join(iter(lambda: connection.recv(65536), b''))
+    finally:
+        connection.close()
+    if not reply.strip():
+        raise RuntimeError('no reply from the daemon at %s'
+                           % (path or default_socket()))
+    return json.loads(reply)
+
+USAGE = '''usage: python pcserve.py serve [--socket PATH] [--workers N]
+                                [--idle SECONDS] module:GRAMMAR...
+       python pcserve.py parse|validate [--socket PATH]
+                                [--grammar module:GRAMMAR] FILE...  (- is stdin)
+       python pcserve.py stop [--socket PATH]
+'''
+
+def _client(command, options, filenames):
+    ''' send command for each of the files, and print the replies. '''
+    status = 0
+    for filename in filenames:
+        message = {'command': command}
+        if '--grammar' in options:
+            message['grammar'] = options['--grammar']
+        if filename == '-':
+            message['text'] = sys.stdin.read()
+        else:
+            message['path'] = os.path.abspath(filename)
+        reply = request(message, options.get('--socket'))
+
+        if not reply['ok']:
+            status = 1
+            if 'line' in reply:
+                sys.stderr.write('%s:%i:%i: %s\n' % (
+                    filename, reply['line'], reply['column'], reply['error']))
+            else:
+                sys.stderr.write('%s: %s\n' % (filename, reply['error']))
+        elif command == 'validate':
+            for err in reply['errors']:
+                status = 1
+                print('%s:%i:%i: %s' % (filename, err['line'], err['column'],
+                                        err['error']))
+        else:
+            print(json.dumps(reply['tree']))
+    return status
+
+def main(args):
+    ''' see USAGE. '''
+    try:
+        opts, args = getopt.gnu_getopt(args, '', ['socket=', 'workers=',
+                                                  'idle=', 'grammar='])
+    except getopt.GetoptError:
+        args = []
+    options = dict(opts)
+
+    if args[:1] == ['serve'] and len(args) >= 2:
+        workers = options.get('--workers')
+        daemon = Daemon(options.get('--socket') or default_socket(),
+                        Grammars(args[1:]),
+                        workers=None if workers is None else int(workers),
+                        idle=float(options.get('--idle', 600)))
+        daemon.serve()
+        return 0
+
+    elif args[:1] == ['stop']:
+        request({'command': 'stop'}, options.get('--socket'))
+        return 0
+
+    elif args[:1] and args[0] in COMMANDS and len(args) >= 2:
+        try:
+            return _client(args[0], options, args[1:])
+        except socket.error as err:
+            sys.stderr.write('no daemon running? (%s)\n' % err)
+            return 2
+        except RuntimeError as err:
+            sys.stderr.write('%s\n' % err)
+            return 2
+
+    sys.stderr.write(USAGE)
+    return 2
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,231 @@
+'''
+    pctrace.py - Copyright (C) 2014 Daniel Fairhead
+    ------------------------------------------
+    Record every attempt that the parsers of a (pc.py) grammar make, to see
+    where all the backtracking goes:
+
+        tracer = Tracer(PHP_BLOCK)
+        with tracer:
+            PHP_BLOCK.parse(text)
+        tracer.trace().save('slow.pctrace')
+
+    and then see it (and which rules wasted the most work) with
+
+        python pctrace.py slow.pctrace slow.php [--summary]
+    ------------------------------------------
+    GPL3 Licenced.
+
+    pc.py is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    py.py is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with pc.py.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+
+from array import array
+import marshal
+import sys
+
+from pc import NotHere, LineIndex, walk
+
+# Each event is FIELDS longs:  (parser index, start, end, depth, order)
+# where end is where it finished - or, if it failed, -1 - how far it got
+# (the furthest that any of its parts got) - and order is the order in which
+# the attempts were started (events are recorded as they finish).
+FIELDS = 5
+
+class Tracer(object):
+    ''' records (parser, start, end/fail...) for every .parse attempt, into a
+        ring buffer of the last `size` of them.  Nothing is built per event,
+        it's just longs in an array.
+
+        While tracing, every parser in the grammar has a recording .parse of
+        its own (the same way fuse works), so trace one parse at a time, and
+        only while nothing else is using the grammar.  (.match isn't
+        traced.) '''
+
+    def __init__(self, grammar, size=65536):
+        self.nodes = list(walk(grammar))
+        self.size = size
+        self.events = array('l', [0]) * (size * FIELDS)
+        self.count = 0      # events recorded (including any overwritten)
+        self.started = 0
+        self.depth = 0
+        self.high = 0       # furthest along the current attempt has got.
+        self._saved = None
+
+    def __enter__(self):
+        self.install()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.uninstall()
+
+    def install(self):
+        ''' start recording. '''
+        self.depth = 0
+        self._saved = [node.__dict__.get('parse') for node in self.nodes]
+        for index, node in enumerate(self.nodes):
+            node.parse = self._traced(index, node.parse)
+
+    def uninstall(self):
+        ''' stop recording, and put the parsers back as they were. '''
+        for node, saved in zip(self.nodes, self._saved):
+            if saved is None:
+                del node.parse
+            else:
+                node.parse = saved
+        self._saved = None
+
+    def _traced(self, index, parse):
+        ''' a recording version of parse (for nodes[index]). '''
+        tracer = self
+
+        def traced(text, position=0):
+            order = tracer.started
+            tracer.started = order + 1
+            depth = tracer.depth
+            tracer.depth = depth + 1
+            high = tracer.high
+            tracer.high = position
+
+            try:
+                result = parse(text, position)
+            except NotHere:
+                tracer.record(index, position, -1 - tracer.high,
+                              depth, order, high)
+                raise
+            tracer.record(index, position, position + result[0],
+                          depth, order, high)
+            return result
+
+        return traced
+
+    def record(self, index, start, end, depth, order, high):
+        ''' an attempt has finished. '''
+        reached = end if end >= 0 else -1 - end
+        self.high = max(high, reached, self.high)
+        self.depth = depth
+
+        slot = (self.count % self.size) * FIELDS
+        events = self.events
+        events[slot] = index
+        events[slot + 1] = start
+        events[slot + 2] = end
+        events[slot + 3] = depth
+        events[slot + 4] = order
+        self.count += 1
+
+    def trace(self):
+        ''' the events recorded so far (or the last `size` of them), as a
+            Trace. '''
+        if self.count <= self.size:
+            events = self.events[:self.count * FIELDS]
+        else:
+            split = (self.count % self.size) * FIELDS
+            events = self.events[split:] + self.events[:split]
+        return Trace(['#%i %r' % (i, node)
+                      for i, node in enumerate(self.nodes)], events)
+
+class Trace(object):
+    ''' a recorded trace: the parser names, and the events (oldest first). '''
+
+    def __init__(self, names, events):
+        self.names = names
+        self.events = events
+
+    def __len__(self):
+        return len(self.events) // FIELDS
+
+    def __iter__(self):
+        ''' (name, start, end, reached, depth, order) for each event, where end
+            is None if it failed, and reached is how far it got. '''
+        events = self.events
+        for slot in range(0, len(events), FIELDS):
+            index, start, end, depth, order = events[slot:slot + FIELDS]
+            if end < 0:
+                yield self.names[index], start, None, -1 - end, depth, order
+            else:
+                yield self.names[index], start, end, end, depth, order
+
+    def save(self, filename):
+        ''' save it compactly:  a (marshalled) header, and then the events as
+            raw longs. '''
+        with open(filename, 'wb') as trace_file:
+            marshal.dump(('pctrace', 1, self.events.itemsize, self.names),
+                         trace_file)
+            self.events.tofile(trace_file)
+
+    @classmethod
+    def load(cls, filename):
+        ''' read a trace saved by .save() '''
+        with open(filename, 'rb') as trace_file:
+            magic, version, itemsize, names = marshal.load(trace_file)
+            events = array('l')
+            if (magic, version, itemsize) != ('pctrace', 1, events.itemsize):
+                raise ValueError('%s is not a trace this can read' % filename)
+            data = trace_file.read()
+        if hasattr(events, 'frombytes'):
+            events.frombytes(data)
+        else:
+            events.fromstring(data)
+        return cls(names, events)
+
+    def wasted(self):
+        ''' {name: (attempts, failures, wasted chars)} where the wasted chars
+            are how far each failed attempt got before failing. '''
+        rules = {}
+        for name, start, end, reached, _, _ in self:
+            attempts, failures, wasted = rules.get(name, (0, 0, 0))
+            if end is None:
+                failures += 1
+                wasted += reached - start
+            rules[name] = (attempts + 1, failures, wasted)
+        return rules
+
+    def replay(self, text, out=sys.stdout):
+        ''' write out every attempt, in the order they were started, indented
+            by depth, with where in the text it was and what it read. '''
+        lines = LineIndex(text)
+        for name, start, end, reached, depth, _ in sorted(self,
+                                                          key=lambda e: e[5]):
+            line, column = lines.location(start)
+            if end is None:
+                result = 'FAIL %r|' % text[start:reached][:40]
+            else:
+                result = 'ok   %r' % text[start:end][:40]
+            out.write('%5i:%-4i %s%s  %s\n' % (line, column, '  ' * depth,
+                                                name, result))
+
+    def summary(self, out=sys.stdout):
+        ''' write out the rules, most wasteful first. '''
+        out.write('%10s %10s %12s  %s\n' % ('attempts', 'failures',
+                                           'wasted chars', 'rule'))
+        rules = self.wasted()
+        for name in sorted(rules, key=lambda n: (-rules[n][2], -rules[n][1])):
+            out.write('%10i %10i %12i  %s\n' % (rules[name] + (name, )))
+
+def main(args):
+    ''' python pctrace.py TRACE SOURCE [--summary] '''
+    if len(args) not in (2, 3) or args[2:] not in ([], ['--summary']):
+        sys.stderr.write('usage: python pctrace.py TRACE SOURCE [--summary]\n')
+        return 2
+
+    trace = Trace.load(args[0])
+    if not args[2:]:
+        with open(args[1]) as source:
+            trace.replay(source.read())
+        sys.stdout.write('\n')
+    trace.summary()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
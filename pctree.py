@@ -0,0 +1,310 @@
+'''
+    pctree.py - Copyright (C) 2014 Daniel Fairhead
+    ------------------------------------------
+    Saving parsed trees, to use again (in other tools, other processes...)
+    without parsing again:
+
+        save(tree, PHP_BLOCK, 'file.pctree')
+        ...
+        tree = load('file.pctree', PHP_BLOCK)
+
+    (or dumps(tree, PHP_BLOCK) and loads(data, PHP_BLOCK), for bytes.)
+
+    The file has the source text once, and each node as a few varints: its
+    parser (as its place in walk(grammar)), what it has, and how much text
+    and file it takes up.  Loading just maps the file in - each node is only
+    read when something first looks inside it.
+
+    Or, for working out statistics over lots of trees, a tree can be turned
+    into columns (arrays) of numbers, a row per node:
+
+        table = columns(tree, PHP_BLOCK)
+        table.rule, table.start, table.end, table.parent, table.depth
+    ------------------------------------------
+    GPL3 Licenced.
+
+    pc.py is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    py.py is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with pc.py.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+
+from array import array
+import mmap
+
+from pc import DeferredNode, output, walk, grammar_hash
+
+# file:  MAGIC, grammar_hash (40 chars), varint is-unicode, varint length,
+#        the text (utf-8), and then the root node.
+# node:  varint (parser index << 4 | flags), varint chars (of text it covers,
+#        including trivia), varint bytes (of the rest), and then the rest:
+#        [before node] [varint count, ([varint name index] node) * count]
+#        [after node]
+MAGIC = b'PCTREE1\n'
+
+PARTS, BEFORE, AFTER, NAMED = 1, 2, 4, 8
+
+################################################################################
+# Saving:
+
+def save(tree, grammar, filename):
+    ''' save tree (parsed by grammar) to filename.  (only the tree itself is
+        saved - not any 'error' or cached 'output' on its nodes.) '''
+    with open(filename, 'wb') as tree_file:
+        tree_file.write(dumps(tree, grammar))
+
+def dumps(tree, grammar):
+    ''' tree (parsed by grammar) as bytes:  what save() writes to a file. '''
+    nodes = list(walk(grammar))
+    index = dict((id(node), i) for i, node in enumerate(nodes))
+
+    text = output(tree)
+    is_unicode = not isinstance(text, bytes)
+    encoded = text.encode('utf-8') if is_unicode else text
+
+    header = bytearray(MAGIC + grammar_hash(nodes).encode('ascii'))
+    _varint(int(is_unicode), header)
+    _varint(len(encoded), header)
+
+    body = bytearray()
+    _encode(tree, index, body)
+
+    return bytes(header + encoded + body)
+
+def _varint(number, out):
+    ''' add number to out (a bytearray), 7 bits at a time. '''
+    while number > 0x7f:
+        out.append((number & 0x7f) | 0x80)
+        number >>= 7
+    out.append(number)
+
+def _encode(node, index, out):
+    ''' add node to out, and return how many chars of text it covers. '''
+    flags = 0
+    chars = 0
+    rest = bytearray()
+
+    if 'before' in node:
+        flags |= BEFORE
+        chars += _encode(node['before'], index, rest)
+
+    parts = node.get('parts')
+    if parts is None:
+        chars += len(node.get('text', ''))
+    else:
+        flags |= PARTS
+        if isinstance(parts, dict):
+            flags |= NAMED
+            names = [name for name, _ in node['class'].parts]
+            parts = [(names.index(name), parts[name]) for name in names
+                     if name in parts]
+        _varint(len(parts), rest)
+        for part in parts:
+            if flags & NAMED:
+                _varint(part[0], rest)
+                part = part[1]
+            chars += _encode(part, index, rest)
+
+    if 'after' in node:
+        flags |= AFTER
+        chars += _encode(node['after'], index, rest)
+
+    _varint(index[id(node['class'])] << 4 | flags, out)
+    _varint(chars, out)
+    _varint(len(rest), out)
+    out.extend(rest)
+    return chars
+
+################################################################################
+# Loading:
+
+def load(filename, grammar):
+    ''' the tree saved in filename (which must have been parsed by grammar -
+        or else ValueError).  Nodes are LazyNodes, only read from the file
+        when they're first looked in. '''
+    with open(filename, 'rb') as tree_file:
+        data = mmap.mmap(tree_file.fileno(), 0, access=mmap.ACCESS_READ)
+    return _read(data, grammar, filename)
+
+def loads(data, grammar):
+    ''' the tree in data (from dumps), read lazily, the same as load(). '''
+    return _read(data, grammar, 'data')
+
+def _read(data, grammar, name):
+    ''' the root LazyNode of the saved tree in data (called name). '''
+    nodes = list(walk(grammar))
+    if data[:len(MAGIC)] != MAGIC:
+        raise ValueError('%s is not a saved tree' % name)
+    at = len(MAGIC) + 40
+    if data[len(MAGIC):at].decode('ascii') != grammar_hash(nodes):
+        raise ValueError('%s was saved with a different grammar' % name)
+
+    is_unicode, at = _read_varint(data, at)
+    length, at = _read_varint(data, at)
+    text = data[at:at + length]
+    if is_unicode:
+        text = text.decode('utf-8')
+
+    store = _Store(data, nodes, text)
+    return store.node(at + length, 0)[0]
+
+def _read_varint(data, at):
+    ''' (the varint in data at at, where the next thing starts) '''
+    number = shift = 0
+    while True:
+        byte = ord(data[at:at + 1])
+        at += 1
+        number |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return number, at
+        shift += 7
+
+class _Store(object):
+    ''' a mapped tree file: where the LazyNodes read themselves from. '''
+
+    def __init__(self, data, parsers, text):
+        self.data = data
+        self.parsers = parsers
+        self.text = text
+
+    def node(self, at, start):
+        ''' (the node at at in the file, which starts at start in the text,
+            where the next one starts in the file, how many chars it covers) '''
+        header, at = _read_varint(self.data, at)
+        chars, at = _read_varint(self.data, at)
+        length, at = _read_varint(self.data, at)
+        parser = self.parsers[header >> 4]
+        flags = header & 0xf
+
+        if not length:
+            # (a plain leaf:  no need to be lazy - or even to make a new one)
+            text = self.text[start:start + chars]
+            shared = vars(parser).get('data')
+            if isinstance(shared, dict) and shared.get('text') == text:
+                return shared, at, chars
+            return {'class': parser, 'text': text}, at, chars
+
+        return LazyNode(parser, (self, flags, at, start, chars)), \
+               at + length, chars
+
+class LazyNode(DeferredNode):
+    ''' a node of a loaded tree, which reads the rest of itself (its text,
+        or parts, trivia...) from the file when anything but its 'class' is
+        first wanted.  Otherwise, just a normal node. '''
+    __slots__ = ()
+
+    def expand(self):
+        ''' read the rest of this node from the file (if it hasn't been). '''
+        if self._lazy is None:
+            return
+        store, flags, at, start, chars = self._lazy
+        self._lazy = None
+
+        position = start
+        if flags & BEFORE:
+            before, at, length = store.node(at, position)
+            dict.__setitem__(self, 'before', before)
+            position += length
+
+        if flags & PARTS:
+            count, at = _read_varint(store.data, at)
+            if flags & NAMED:
+                names = [name for name, _ in self['class'].parts]
+                parts = {}
+            else:
+                parts = []
+            while count:
+                count -= 1
+                if flags & NAMED:
+                    name, at = _read_varint(store.data, at)
+                part, at, length = store.node(at, position)
+                position += length
+                if flags & NAMED:
+                    parts[names[name]] = part
+                else:
+                    parts.append(part)
+            dict.__setitem__(self, 'parts', parts)
+
+        end = start + chars
+        if flags & AFTER:
+            # (after a text, which is however long the after trivia isn't)
+            _, chars_at = _read_varint(store.data, at)
+            end -= _read_varint(store.data, chars_at)[0]
+            dict.__setitem__(self, 'after', store.node(at, end)[0])
+
+        if not flags & PARTS:
+            dict.__setitem__(self, 'text', store.text[position:end])
+
+################################################################################
+# Columns:
+
+class Columns(object):
+    ''' a tree as parallel arrays of ints, a row for each node (parents
+        before their parts, and trivia as rows of their own, the same as
+        spans()):  rule (the node's parser, as its place in parsers), start,
+        end, parent (row, or -1 for the root) and depth.  (Trivia has the
+        same parent & depth as the node it's attached to.)  Being arrays, they
+        can go straight to numpy (numpy.frombuffer(table.start, 'i')). '''
+
+    FIELDS = ('rule', 'start', 'end', 'parent', 'depth')
+
+    def __init__(self, parsers):
+        self.parsers = parsers      # (walk(grammar))
+        self.index = dict((id(p), i) for i, p in enumerate(parsers))
+        for field in self.FIELDS:
+            setattr(self, field, array('i'))
+
+    def __len__(self):
+        return len(self.rule)
+
+    def parser(self, row):
+        ''' the parser of the node in row. '''
+        return self.parsers[self.rule[row]]
+
+    def rows(self, parser):
+        ''' the rows of all the nodes parsed by parser. '''
+        rule = self.index[id(parser)]
+        return [row for row, found in enumerate(self.rule) if found == rule]
+
+    def add(self, node, position, parent, depth):
+        ''' add rows for node (and everything in it), which starts at
+            position.  Returns where it ends. '''
+        if 'before' in node:
+            position = self.add(node['before'], position, parent, depth)
+
+        row = len(self.rule)
+        self.rule.append(self.index[id(node['class'])])
+        self.start.append(position)
+        self.end.append(position)
+        self.parent.append(parent)
+        self.depth.append(depth)
+
+        parts = node.get('parts')
+        if parts is None:
+            position += len(node.get('text', ''))
+        else:
+            if isinstance(parts, dict):
+                parts = [parts[name] for name, _ in node['class'].parts
+                         if name in parts]
+            for part in parts:
+                position = self.add(part, position, row, depth + 1)
+        self.end[row] = position
+
+        if 'after' in node:
+            position = self.add(node['after'], position, parent, depth)
+        return position
+
+def columns(tree, grammar, position=0):
+    ''' tree (parsed by grammar, from position) as Columns. '''
+    table = Columns(list(walk(grammar)))
+    table.add(tree, position, -1, 0)
+    return table
@@ -24,6 +24,9 @@
 
 '''
 
+import os
+import re
+
 from pc import *
 
 
@@ -44,7 +47,13 @@ VAR = Joined('$', Word(LETTERS + '_'))
 
 WORD = Word(LETTERS + '_')
 
-CONST = WORD # TODO: really????????
+# (a whole word - not just the start of a longer one:)
+KEYWORD = Joined(Either('elseif', 'else', 'if', 'foreach', 'for', 'while',
+                        'echo', 'print', 'return', 'as'),
+                 Not(Word(LETTERS + NUMBERS + '_')))
+
+# any word which isn't a keyword (rejected up front, with one check):
+CONST = Guard(Not(KEYWORD), WORD)
 
 STRING = Joined('"', Until('"', escape='\\')) \
        | Joined("'", Until("'", escape='\\'))
@@ -56,7 +65,7 @@ NUMBER = Joined(Optional(SingleChar('-')),
 OPERATOR = Either('===', '!==', '!=', '==',
                   '+=', '-=', '/=', '.=',
                   '+', '-', '/', '=', '.',
-                  '>', '<', '<<', '>>')
+                  '<<', '>>', '>', '<')
 
 COMMENT_INLINE = Joined("/*", Until("*/", fail_on_eof=True))
 COMMENT_LINE = Joined("//", Until("\n"))
@@ -68,7 +77,8 @@ WHITESPACE = Word(' \t\n')
 
 SEMICOLON = SingleChar(';')
 
-COMMENTS_OR_WHITESPACE = Multiple(Either(WHITESPACE, COMMENT))
+# (the same as Multiple(Either(WHITESPACE, COMMENT)), but quicker:)
+COMMENTS_OR_WHITESPACE = Skipper(Either(WHITESPACE, COMMENT))
 
 ################################################################################
 #
@@ -76,24 +86,25 @@ COMMENTS_OR_WHITESPACE = Multiple(Either(WHITESPACE, COMMENT))
 # optionally between every single item.
 #
 
+TRIVIA = Trivia(COMMENTS_OR_WHITESPACE)
+
 def phpitem(actual):
     ''' most php 'things' can be separated by (x) random amount of whitespace,
-        or comments.  that's just the way it is... '''
-    return NamedJoin(
-        ('before', COMMENTS_OR_WHITESPACE),
-        ('thing', actual),
-        ('after', COMMENTS_OR_WHITESPACE))
+        or comments.  that's just the way it is...  (it's attached to the
+        thing's node as 'before' and 'after', when there is any.) '''
+    return TRIVIA.around(actual)
 
 class PHPJoin(Joined):
     ''' wrap a list of otherwise sensible parsers in PHPItem(s). '''
     def __init__(self, *parts):
         self.parts = [phpitem(part) for part in parts]
 
-def phpmulti(parsable, separator):
+def phpmulti(parsable, separator, min=1):  # pylint: disable=redefined-builtin
     ''' takes a parsable thing, and returns a version of it that can accept
         multiple instances, separated by separator. So phpMulti("x",",")
-        would accept x or x,x or x,x,x,x,x,x,x '''
-    return PHPJoin(parsable, Multiple(PHPJoin(separator, parsable)))
+        would accept x or x,x or x,x,x,x,x,x,x (and, with min=0, nothing
+        at all).  The items and separators come out as one flat list. '''
+    return SeparatedBy(phpitem(parsable), phpitem(separator), min=min)
 
 ################################################################################
 #
@@ -112,10 +123,7 @@ INPLACE_CHANGE = Either(PHPJoin(Either('--', '++'), COMPLEX_VAR),
 
 # Hm.  This is annoying.  Recursive definitions are not easy with this schema:
 
-FUNC_APP = PHPJoin(WORD,
-                   '(',
-                   Either(phpmulti(THING, ','), Nothing()),
-                   ')')
+FUNC_APP = PHPJoin(WORD, '(', phpmulti(THING, ',', min=0), ')')
 
 EXPR = PHPJoin('(', THING, ')')
 
@@ -148,14 +156,47 @@ PHP_LINE = PHPJoin(Either(KEYWORD_STATEMENT, ASSIGNMENT, INPLACE_CHANGE),
 
 STATEMENT = Either(PHP_LINE)
 
-BLOCK = PHPJoin('{', Multiple(STATEMENT), '}')
+# when recovering from errors (Session(text, recover=True)), a bad statement
+# is skipped up to the next ; (or over a whole {...}), or the end of the block:
+RESYNC = Resync(';}', end=('?>', ), atoms=Either(STRING, COMMENT))
+# (and outside of any block, a stray } or ) is just more bad text:)
+OUTER_RESYNC = Resync(';}', end=('?>', ), atoms=RESYNC.atoms, outermost=True)
+
+BLOCK = PHPJoin('{', Multiple(STATEMENT, recover=RESYNC), '}')
+
+# strings & comments, which any braces (or ?>) in don't count:
+_SKIPPED = r'''"(?:[^"\\]|\\.)*"|'(?:[^'\\]|\\.)*'|/\*.*?\*/|//[^\n]*'''
+
+_BRACES = re.compile(_SKIPPED + r'|[{}]', re.S)
+
+def scan_block(text, position):
+    ''' how much of text, from position, BLOCK would read (with the trivia
+        around it), found by just matching up the braces - or NotHere. '''
+    start = position + COMMENTS_OR_WHITESPACE.match(text, position)
+    if not text.startswith('{', start):
+        raise NotHere('Expected a {')
+    depth = 0
+    for token in _BRACES.finditer(text, start):
+        brace = token.group()
+        if brace == '{':
+            depth += 1
+        elif brace == '}':
+            depth -= 1
+            if not depth:
+                end = token.end()
+                return end + COMMENTS_OR_WHITESPACE.match(text, end) - position
+    raise NotHere('Expected a matching }')
+
+# BLOCK, but in a lazy session (Session(text, lazy=True)) only parsed when its
+# node is looked in - for tools which only want what's outside of them:
+LAZY_BLOCK = Lazy(BLOCK, scan_block)
 
 IF = PHPJoin('if',
              EXPR,
-             BLOCK | STATEMENT,
+             LAZY_BLOCK | STATEMENT,
              Multiple(Joined(
-                 Either('else if', 'elseif'), EXPR, BLOCK | STATEMENT)),
-             Multiple(Joined('else', BLOCK | STATEMENT)))
+                 Either('else if', 'elseif'), EXPR, LAZY_BLOCK | STATEMENT)),
+             Multiple(Joined('else', LAZY_BLOCK | STATEMENT)))
 
 FOR_CONDITIONS = PHPJoin(phpmulti(ASSIGNMENT, ','), SEMICOLON,
                          phpmulti(INFIXED, ','), SEMICOLON,
@@ -164,9 +205,10 @@ FOR_CONDITIONS = PHPJoin(phpmulti(ASSIGNMENT, ','), SEMICOLON,
 FOREACH_CONDITIONS = PHPJoin(COMPLEX_VAR, 'as', Either(PHPJoin(VAR, '=>', VAR),
                                                                VAR))
 
-FOR = PHPJoin('for', '(', FOR_CONDITIONS, ')', BLOCK | STATEMENT)
-FOREACH = PHPJoin('foreach', '(', FOREACH_CONDITIONS, ')', BLOCK | STATEMENT)
-WHILE = PHPJoin('while', '(', THING, ')', BLOCK | STATEMENT)
+FOR = PHPJoin('for', '(', FOR_CONDITIONS, ')', LAZY_BLOCK | STATEMENT)
+FOREACH = PHPJoin('foreach', '(', FOREACH_CONDITIONS, ')',
+                  LAZY_BLOCK | STATEMENT)
+WHILE = PHPJoin('while', '(', THING, ')', LAZY_BLOCK | STATEMENT)
 
 STATEMENT.options += (IF, FOR, FOREACH, WHILE, Nothing())
 STATEMENT_ = Joined(STATEMENT, COMMENTS_OR_WHITESPACE)
@@ -175,5 +217,96 @@ STATEMENT_ = Joined(STATEMENT, COMMENTS_OR_WHITESPACE)
 #
 # And Parse PHP files, from <?php ... to the end.
 
-PHP_BLOCK = Joined('<?php', Multiple(STATEMENT_), '?>')
-# TODO: files which end w/o closing ?>
+# (the last block in a file doesn't need closing:)
+CLOSE = Either('?>', End())
+
+PHP_BLOCK = Joined('<?php', Multiple(STATEMENT_, recover=OUTER_RESYNC),
+                   CLOSE)
+
+# <?= $x ?> is short for <?php echo $x; ?>
+ECHO_BLOCK = PHPJoin('<?=', THING, Optional(SEMICOLON), CLOSE)
+
+################################################################################
+#
+# And whole files:  HTML (which isn't parsed at all), with PHP blocks in it.
+
+HTML = Regex(r'(?:[^<]|<(?!\?php|\?=))+')
+
+# (when recovering from errors, a block which doesn't parse at all - a bad
+#  <?= ... ?>, say - is skipped over, up to and including its ?>:)
+ISLAND_RESYNC = Joined(Resync('', end=('?>', ), atoms=RESYNC.atoms,
+                              outermost=True),
+                       CLOSE)
+
+PHP_FILE = Islands(HTML, [('<?php', PHP_BLOCK), ('<?=', ECHO_BLOCK)],
+                   recover=ISLAND_RESYNC)
+
+# Either options in the order they're most often used in, if there's a profile
+# of that (see pcprofile.py) - where it can't make any difference otherwise:
+reorder(PHP_BLOCK, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                'php.order'))
+
+# The purely lexical rules (VAR, NUMBER, STRING, COMMENTS_OR_WHITESPACE, ...)
+# are each matched with a single regexp, rather than nested parsers:
+fuse(PHP_FILE, cache=True)
+
+################################################################################
+#
+# Parsing a file's blocks in parallel:
+
+def parse_file(text, pool=None):
+    ''' PHP_FILE.parse(text) - or, with a multiprocessing.Pool (made after
+        importing this, so its processes have the grammar ready), with the
+        PHP blocks parsed in parallel by the pool.  The tree is the same
+        either way (but the blocks' nodes are pctree.LazyNodes).  Where the
+        blocks end is found without parsing them (see _block_end); if the
+        parse ever disagrees, or a block doesn't parse, the whole file is
+        parsed again the usual way - so errors are the same too. '''
+    if pool is None:
+        return PHP_FILE.parse(text)
+    from pctree import loads    # (only needed here)
+
+    parts, blocks = [], []
+    position = 0
+    while position < len(text):
+        start, found = PHP_FILE.find(text, position)
+        if start > position:
+            parts.append({'class': HTML, 'text': text[position:start]})
+        if found is None:
+            break
+        position = _block_end(text, start + len(found))
+        parts.append(None)
+        blocks.append((found, text[start:position]))
+
+    dumped = iter(pool.map(_parse_block, blocks))
+    for i, part in enumerate(parts):
+        if part is None:
+            found, data = next(dumped)
+            if data is None:
+                return PHP_FILE.parse(text)
+            parts[i] = loads(data, PHP_FILE.parser(found))
+
+    return len(text), {'class': PHP_FILE, 'parts': parts}
+
+# the first ?> which isn't in a string or a comment:
+_BLOCK_END = re.compile(_SKIPPED + r'|\?>', re.S)
+
+def _block_end(text, position):
+    ''' where the PHP block which carries on from position ends (just after
+        its ?>, or at the end of the text), without parsing it. '''
+    for token in _BLOCK_END.finditer(text, position):
+        if token.group() == '?>':
+            return token.end()
+    return len(text)
+
+def _parse_block(block):
+    ''' (start, pctree.dumps of its tree), for a block (start, text) - or
+        (start, None) if it doesn't parse as a whole.  (in the pool.) '''
+    from pctree import dumps
+    found, text = block
+    parser = PHP_FILE.parser(found)
+    try:
+        length, tree = parser.parse(text)
+    except NotHere:
+        return found, None
+    return found, dumps(tree, parser) if length == len(text) else None
@@ -0,0 +1,83 @@
+'''
+    benchmarks for pc.py: how much quicker (and smaller) is just recognising
+    some PHP (.match) than parsing it into a tree (.parse)?
+
+        python tests/benchmarks.py [repeats]
+
+    Copyright (C) 2014 Daniel Fairhead
+    GPL3 Licence.
+
+'''
+# pylint: disable=missing-docstring
+
+import os
+import resource
+import subprocess
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..'))
+
+from php import PHP_BLOCK
+
+SAMPLE = '''
+  $x = 1; // comment
+  if ($x == 2) { echo "hi"; } else { $y = foo($x, $z, 3); }
+  /* block */ for ($i = 0; $i < 10; $i++) { print $i; }
+  while ($a) { $a--; }
+'''
+
+def php_text(repeats):
+    return '<?php' + SAMPLE * repeats + '?>'
+
+def count_nodes(tree):
+    if isinstance(tree, dict):
+        return 1 + sum(count_nodes(v) for v in tree.values())
+    elif isinstance(tree, list):
+        return sum(count_nodes(v) for v in tree)
+    return 0
+
+def peak_memory(mode, repeats):
+    ''' run PHP_BLOCK.<mode> once, in a fresh process, and return how much
+        the peak memory use (KB) went up by. '''
+    return int(subprocess.check_output(
+        [sys.executable, __file__, '--memory', mode, str(repeats)]))
+
+def _memory(mode, repeats):
+    text = php_text(repeats)
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    result = getattr(PHP_BLOCK, mode)(text)
+    after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    assert result
+    print(after - before)
+
+def main(repeats):
+    # (first, as a new process starts with the peak memory use of this one
+    #  so far, on linux.)
+    memory = dict((mode, peak_memory(mode, repeats))
+                  for mode in ('parse', 'match'))
+
+    text = php_text(repeats)
+    length, tree = PHP_BLOCK.parse(text)
+    assert length == PHP_BLOCK.match(text) == len(text)
+
+    print('%i chars of PHP, %i nodes in the tree.\n' % (len(text),
+                                                       count_nodes(tree)))
+    print('%-8s %12s %14s' % ('', 'time (ms)', 'peak mem (KB)'))
+
+    times = {}
+    for mode in ('parse', 'match'):
+        method = getattr(PHP_BLOCK, mode)
+        times[mode] = min(timeit.repeat(lambda: method(text),
+                                        number=1, repeat=5)) * 1000
+        print('%-8s %12.1f %14i' % (mode, times[mode], memory[mode]))
+
+    print('\nmatch takes %.0f%% of the time of parse.'
+          % (100 * times['match'] / times['parse']))
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['--memory']:
+        _memory(sys.argv[2], int(sys.argv[3]))
+    else:
+        main(int(sys.argv[1]) if len(sys.argv) > 1 else 500)
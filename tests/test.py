@@ -9,10 +9,21 @@
 # pylint: disable=no-self-use, wildcard-import
 
 from unittest import TestCase
+from array import array
+import atexit
 from cStringIO import StringIO
+import os
+import shutil
 import sys
+import tempfile
+import time
+
+# (php.py's fuse cache goes somewhere of its own, not the real ~/.cache)
+os.environ['XDG_CACHE_HOME'] = tempfile.mkdtemp()
+atexit.register(shutil.rmtree, os.environ['XDG_CACHE_HOME'], True)
 
 from pc import *
+import pc
 from php import PHP_BLOCK
 
 class PCTestCase(TestCase):
@@ -660,6 +671,1033 @@ class TestMultiple(PCTestCase):
         self.assertReadsFully(M, 'abcaacbbabcccccaab')
 
 
+class TestSkipper(PCTestCase):
+    def setUp(self):
+        self.options = Either(Word(' \n'), Joined('#', Until('\n')))
+        self.S = Skipper(self.options)
+
+    def testSameAsMultiple(self):
+        M = Multiple(self.options)
+        for text in ('', 'x', '  x', '# a\n  # b\nx', '  # no end'):
+            m, s = M.parse(text), self.S.parse(text)
+            self.assertEquals(s[0], m[0])
+            self.assertEquals(s[1]['parts'], m[1]['parts'])
+            self.assertOutputs(s, text[:m[0]])
+
+    def testNothingToSkip(self):
+        a = self.S.parse('abc')
+        b = self.S.parse('abc', 1)
+        self.assertHasRead(a, 0)
+        self.assertIs(a[1], b[1])
+
+    def testUnknownStart(self):
+        # can't tell what Until starts with, so just does what Multiple does:
+        S = Skipper(Either(Word(' '), Until('!')))
+        self.assertReadsFully(S, '   abc!')
+
+
+class TestSeparatedBy(PCTestCase):
+    def testList(self):
+        S = SeparatedBy(Word(LETTERS), ',')
+
+        self.assertReadsFully(S, '')
+        self.assertReadsFully(S, 'a')
+        self.assertReadsFully(S, 'a,bc,def')
+
+        s = S.parse('a,b,')
+        self.assertHasRead(s, 3)
+        self.assertOutputs(s, 'a,b')
+
+    def testFlat(self):
+        S = SeparatedBy(Word(LETTERS), ',')
+        length, s = S.parse(','.join(['x'] * 500))
+
+        self.assertEquals(len(s['parts']), 999)
+        self.assertTrue(all('text' in p for p in s['parts']))
+
+    def testTrailing(self):
+        S = SeparatedBy(Word(LETTERS), ',', trailing=True)
+
+        self.assertReadsFully(S, 'a,b,')
+        self.assertReadsFully(S, 'a,b')
+
+        s = S.parse('a,,')
+        self.assertHasRead(s, 2)
+
+    def testMin(self):
+        S = SeparatedBy(Word(LETTERS), ',', min=2)
+
+        self.assertReadsFully(S, 'a,b')
+        with self.assertRaises(NotHere):
+            S.parse('a')
+        with self.assertRaises(NotHere):
+            S.parse('a,')
+
+
+class TestTrivia(PCTestCase):
+    def setUp(self):
+        self.trivia = Trivia(Multiple(Either(Word(' \n'),
+                                             Joined('#', Until('\n')))))
+        self.P = Multiple(self.trivia.around(Word(LETTERS)))
+
+    def testAttached(self):
+        length, p = self.P.parse('  one # first\ntwo three')
+        one, two, three = p['parts']
+
+        self.assertEquals(output(one['before']), '  ')
+        self.assertEquals(output(one['after']), ' # first\n')
+        self.assertNotIn('before', two)
+        self.assertEquals(output(two['after']), ' ')
+        self.assertEquals([k for k in three if k in ('before', 'after')], [])
+
+        self.assertEquals(one['text'], 'one')
+        self.assertEquals(output(p), '  one # first\ntwo three')
+        self.assertEquals(''.join(parts(p)), '  one # first\ntwo three')
+
+    def testSharedDataUntouched(self):
+        X = SingleChar('x')
+        length, p = self.trivia.around(X).parse(' x ')
+        self.assertHasRead((length, p), 3)
+        self.assertEquals(X.data, {'class': X, 'text': 'x'})
+
+    def testRewrite(self):
+        class Spaces(Word):
+            def output(self, data, clean=False):
+                return ' ' if clean else data['text']
+
+        trivia = Trivia(Spaces(' \t\n'))
+        P = Multiple(trivia.around(Word(LETTERS)))
+        length, p = P.parse('one  \t two\n\nthree')
+
+        self.assertEquals(output(p), 'one  \t two\n\nthree')
+        self.assertEquals(output(p, clean=True), 'one two three')
+
+
+class TestMatch(PCTestCase):
+    ''' .match must read exactly as much as .parse does. '''
+
+    def assertSameMatch(self, parser, texts):
+        for text in texts:
+            try:
+                length, _ = parser.parse(text)
+            except NotHere:
+                with self.assertRaises(NotHere):
+                    parser.match(text)
+                continue
+            self.assertEquals(parser.match(text), length)
+
+    def testTerminals(self):
+        texts = ['', 'a', 'abc', 'cab', 'abc!def', '12']
+        for parser in (Nothing(), SingleChar('a'), SpecificWord('abc'),
+                       Word('abc'), Until('!'), Until('!', fail_on_eof=True),
+                       Regex('[a-c]+!')):
+            self.assertSameMatch(parser, texts)
+
+    def testCombined(self):
+        texts = ['', 'a', 'a,b', 'a,b,', 'ab, ba , c', ' a', 'a b', ',,']
+        item = Word('abc')
+        for parser in (Joined(item, ',', item),
+                       NamedJoin(('a', item), ('comma', ',')),
+                       Either(Joined(item, ','), item, ','),
+                       Optional(','),
+                       Multiple(Either(item, ',', ' ')),
+                       Multiple(item, allow_none=False),
+                       Skipper(Either(' ', ',')),
+                       SeparatedBy(item, ',', min=2),
+                       SeparatedBy(item, Word(' ,'), trailing=True),
+                       Multiple(Trivia(Word(' ')).around(Either(item, ',')))):
+            self.assertSameMatch(parser, texts)
+
+    def testRecursive(self):
+        E = Either('a', 'b')
+        E.options += (Joined('(', Multiple(E), ')'), )
+        self.assertSameMatch(E, ['a', '(ab(a))', '(a(b)', ')'])
+
+    def testFused(self):
+        P = fuse(Multiple(Joined(Word(LETTERS), Optional(','))))
+        self.assertIn('match', P.__dict__)
+        self.assertSameMatch(P, ['', 'a,b,cd', 'a,,b', '!'])
+
+    def testSession(self):
+        P = Multiple(Either(Word(LETTERS), ' '))
+        self.assertEquals(Session('ab cd!').match(P), 5)
+
+        with self.assertRaises(ParseError) as error:
+            Session('abc').match(Joined(P, '!'))
+        self.assertEquals(error.exception.position, 3)
+
+        with self.assertRaises(BudgetExceeded):
+            Session('ab ' * 1000, max_steps=100).match(P)
+
+
+class TestParseMany(PCTestCase):
+    TEXTS = ['$abc', '$a1', 'abc', '$', '', '$xyz_']
+
+    def assertSameAsMatch(self, P, texts):
+        matched, lengths = parse_many(P, texts)
+        for text, ok, length in zip(texts, matched, lengths):
+            try:
+                self.assertEquals((ok, length), (1, P.match(text)))
+            except NotHere:
+                self.assertEquals((ok, length), (0, 0))
+
+    def testRegular(self):
+        VAR = Joined('$', Word(LETTERS + '_'))
+        self.assertIsNotNone(pc._regex_for(VAR))
+        self.assertEquals(parse_many(VAR, self.TEXTS),
+                          (array('B', [1, 1, 0, 0, 0, 1]),
+                           array('i', [4, 2, 0, 0, 0, 5])))
+        self.assertSameAsMatch(VAR, self.TEXTS)
+
+        self.assertEquals(list(parse_many(VAR, self.TEXTS, whole=True)[0]),
+                          [1, 0, 0, 0, 0, 1])
+        self.assertEquals(list(parse_many(VAR, iter(self.TEXTS))[1]),
+                          [4, 2, 0, 0, 0, 5])
+
+    def testFused(self):
+        P = fuse(Joined(Optional('-'), Word(NUMBERS)))
+        self.assertIs(pc._regex_for(P), pc._fused(P).regex)
+        self.assertSameAsMatch(P, ['-12', '3', '-', 'x', '12x'])
+
+    def testNotRegular(self):
+        E = Either(Word(NUMBERS))
+        E.options.append(Joined('(', E, ')'))
+        self.assertIsNone(pc._regex_for(E))
+        texts = ['(1)', '((2))', '(3', '4)', '']
+        self.assertEquals(list(parse_many(E, texts)[0]), [1, 1, 0, 1, 0])
+        self.assertEquals(list(parse_many(E, texts, whole=True)[0]),
+                          [1, 1, 0, 0, 0])
+        self.assertSameAsMatch(E, texts)
+
+
+class TestRegex(PCTestCase):
+    def testBasic(self):
+        R = Regex('[0-9]+(\.[0-9]+)?')
+
+        self.assertReadsFully(R, '3')
+        self.assertReadsFully(R, '3.14')
+
+        r = R.parse('12 monkeys')
+        self.assertHasRead(r, 2)
+        self.assertOutputs(r, '12')
+
+        with self.assertRaises(NotHere):
+            R.parse('monkeys')
+
+    def testPosition(self):
+        R = Regex('b+')
+        r = R.parse('aabbbc', 2)
+        self.assertHasRead(r, 3)
+        self.assertOutputs(r, 'bbb')
+
+
+
+class TestLookahead(PCTestCase):
+    def testAnd(self):
+        P = Joined(And('ab'), Word(LETTERS))
+        self.assertHasRead(P.parse('abc'), 3)
+        self.assertOutputs(P.parse('abc'), 'abc')
+        with self.assertRaises(NotHere):
+            P.parse('bac')
+
+        self.assertHasRead(And(Word(LETTERS)).parse('abc'), 0)
+        self.assertHasRead(And('a').parse('abc'), 0)
+        with self.assertRaises(NotHere):
+            And('a').parse('')
+
+    def testNot(self):
+        KEYWORD = Joined(Either('if', 'for'), Not(Word(LETTERS)))
+        NAME = Joined(Not(KEYWORD), Word(LETTERS))
+
+        for text in ('iffy', 'format', 'x', 'i'):
+            self.assertReadsFully(NAME, text)
+        for text in ('if', 'for', 'if('):
+            with self.assertRaises(NotHere):
+                NAME.parse(text)
+
+        self.assertHasRead(Not('!').parse(''), 0)
+
+    def testNoTree(self):
+        built = []
+
+        class Spy(Word):
+            def parse(self, text, position=0):
+                built.append(position)
+                return Word.parse(self, text, position)
+
+        P = Joined(Not(Joined('x', Spy(LETTERS))), Word(LETTERS))
+        self.assertReadsFully(P, 'abc')
+        with self.assertRaises(NotHere):
+            P.parse('xyz')
+        self.assertEquals(built, [])
+
+        # and the node is a shared one, not built each time:
+        N = Not('x')
+        self.assertIs(N.parse('a')[1], N.parse('b')[1])
+
+    def testMatch(self):
+        P = Multiple(Joined(Not(' '), Either(Word(LETTERS), ',')))
+        self.assertEquals(P.match('a,b c'), 3)
+
+    def testGuard(self):
+        KEYWORD = Joined(Either('if', 'for'), Not(Word(LETTERS)))
+        WORD = Word(LETTERS)
+        NAME = Guard(Not(KEYWORD), WORD)
+
+        # (just the word's own node:  nothing for the guard)
+        length, tree = NAME.parse('iffy')
+        self.assertEquals((length, tree), (4, {'class': WORD, 'text': 'iffy'}))
+        self.assertEquals(NAME.match('format'), 6)
+        for text in ('if', 'for('):
+            with self.assertRaises(NotHere):
+                NAME.parse(text)
+            with self.assertRaises(NotHere):
+                NAME.match(text)
+
+    def testEnd(self):
+        P = Joined(Word(LETTERS), Either(';', End()))
+        self.assertReadsFully(P, 'abc;')
+        self.assertReadsFully(P, 'abc')
+        self.assertHasRead(P.parse('abc;d'), 4)
+        with self.assertRaises(ParseError) as raised:
+            Session('abc d').parse(P)
+        self.assertIn('<End>', str(raised.exception))
+
+        F = fuse(Multiple(Joined(Word(LETTERS), Either(',', End()))))
+        self.assertReadsFully(F, 'a,b,c')
+
+class TestIslands(PCTestCase):
+    def setUp(self):
+        self.TEXT = Regex('[^{]+')
+        self.CODE = Joined('{{', Word(LETTERS), Either('}}', End()))
+        self.BANG = Joined('{!', Word(LETTERS), '}')
+        self.P = Islands(self.TEXT, [('{{', self.CODE), ('{!', self.BANG)])
+
+    def testIslands(self):
+        text = 'Hello {{name}}, {!x} {{ and {{ y'
+        length, tree = self.P.parse('Hello {{name}}, {!x}! {{y}}')
+        self.assertEquals([part['class'] for part in tree['parts']],
+                          [self.TEXT, self.CODE, self.TEXT, self.BANG,
+                           self.TEXT, self.CODE])
+        self.assertEquals(tree['parts'][0]['text'], 'Hello ')
+        self.assertOutputs((length, tree), 'Hello {{name}}, {!x}! {{y}}')
+
+        # (a '{' which doesn't start an island is just text)
+        self.assertReadsFully(self.P, 'a { b {{c}}')
+        with self.assertRaises(NotHere):
+            self.P.parse(text)
+
+    def testEnds(self):
+        self.assertReadsFully(self.P, '')
+        self.assertReadsFully(self.P, 'no islands')
+        self.assertReadsFully(self.P, 'a {{b')
+        self.assertEquals(len(self.P.parse('{{a}}{{b}}')[1]['parts']), 2)
+        self.assertHasRead(self.P.parse('xx{{a}}', 2), 5)
+
+    def testRecover(self):
+        P = Islands(self.TEXT, [('{{', self.CODE), ('{!', self.BANG)],
+                    recover=Resync('}'))
+        text = 'a {!x y} b {{c}}'
+        session = Session(text, recover=True)
+        length, tree = session.parse(P)
+        self.assertEquals(length, len(text))
+        self.assertEquals([part['class'] for part in tree['parts']],
+                          [self.TEXT, P.recover, self.TEXT, self.CODE])
+        self.assertEquals(tree['parts'][1]['text'], '{!x y}')
+        self.assertEquals([err.column for err in session.errors], [6])
+
+        # (only when recovering)
+        with self.assertRaises(ParseError):
+            Session(text).parse(P)
+        self.assertIn(P.recover, P.subparsers())
+
+    def testFind(self):
+        P = Islands(self.TEXT, [('<', self.CODE), ('<<', self.BANG)])
+        self.assertEquals(P.find('ab << c'), (3, '<<'))
+        self.assertEquals(P.find('ab << c', 5), (7, None))
+        self.assertIs(P.parser('<<'), self.BANG)
+
+class TestLazy(PCTestCase):
+    def setUp(self):
+        self.WORD = Word(LETTERS)
+        self.GROUP = Joined('(', SeparatedBy(self.WORD, ','), ')')
+
+        def scan(text, position):
+            end = text.find(')', position)
+            if not text.startswith('(', position) or end < 0:
+                raise NotHere('Expected a group')
+            return end + 1 - position
+        self.LAZY = Lazy(self.GROUP, scan)
+        self.P = Multiple(Either(self.WORD, self.LAZY))
+
+    def testEager(self):
+        # (outside of a lazy session, it's just the parser)
+        tree = self.P.parse('a(b,c)d')[1]
+        self.assertIs(type(tree['parts'][1]), dict)
+        self.assertIs(tree['parts'][1]['class'], self.GROUP)
+        self.assertEquals(self.LAZY.match('(b,c)d'), 5)
+
+    def testDeferred(self):
+        text = 'a(b,c)d(e)'
+        length, tree = Session(text, lazy=True).parse(self.P)
+        self.assertEquals(length, len(text))
+        group = tree['parts'][1]
+        self.assertIsInstance(group, UnparsedNode)
+        self.assertIs(group['class'], self.GROUP)
+        self.assertIsNotNone(group._lazy)
+
+        self.assertEquals(output(group['parts'][1]['parts'][2]), 'c')
+        self.assertIsNone(group._lazy)
+        self.assertIsNotNone(tree['parts'][3]._lazy)
+
+        # (only scanned, so any group will do)
+        self.assertEquals(Session('(b,,)', lazy=True).match(self.LAZY), 5)
+        self.assertEquals(repr(self.LAZY), '<Lazy:%r>' % self.GROUP)
+
+    def testSameTree(self):
+        text = 'a(b,c)d(e)(fg)'
+        eager = self.P.parse(text)
+        lazy = Session(text, lazy=True).parse(self.P)
+        self.assertEquals(list(spans(lazy[1])), list(spans(eager[1])))
+        self.assertEquals(lazy, eager)
+        self.assertOutputs(lazy, text)
+
+    def testErrors(self):
+        # (the scan only finds where it ends:  the parse fails when it's
+        #  looked in)
+        tree = Session('a(b,)', lazy=True).parse(self.P)[1]
+        with self.assertRaises(ParseError):
+            output(tree)
+        with self.assertRaises(ParseError):
+            Session('a(b', lazy=True).parse(Joined(self.P, End()))
+
+        # (and recovering from errors needs the real parse)
+        tree = Session('a(b)', lazy=True, recover=True).parse(self.P)[1]
+        self.assertIs(type(tree['parts'][1]), dict)
+
+class TestFuse(PCTestCase):
+    ''' a fused grammar must give exactly the same trees as before. '''
+
+    def assertSameParses(self, make_grammar, texts):
+        plain = make_grammar()
+        fused = fuse(make_grammar())
+
+        plain_ids = dict((id(p), i) for i, p in enumerate(walk(plain)))
+        fused_ids = dict((id(p), i) for i, p in enumerate(walk(fused)))
+
+        def shape(tree, ids):
+            if isinstance(tree, dict):
+                return dict((k, ids[id(v)] if k == 'class' else shape(v, ids))
+                            for k, v in tree.items())
+            elif isinstance(tree, list):
+                return [shape(v, ids) for v in tree]
+            return tree
+
+        for text in texts:
+            try:
+                expected = plain.parse(text)
+            except NotHere:
+                with self.assertRaises(NotHere):
+                    fused.parse(text)
+                continue
+            got = fused.parse(text)
+            self.assertEquals(got[0], expected[0])
+            self.assertEquals(shape(got[1], fused_ids),
+                              shape(expected[1], plain_ids))
+
+    def testIsFused(self):
+        N = fuse(Joined(Optional('-'), Word(NUMBERS)))
+        self.assertIn('parse', N.__dict__)
+
+        # not regular (recursive), so left alone:
+        E = Either('a', 'b')
+        E.options += (Joined('(', E, ')'), )
+        fuse(E)
+        self.assertNotIn('parse', E.__dict__)
+
+    def testNumbers(self):
+        self.assertSameParses(
+            lambda: Joined(Optional(SingleChar('-')),
+                           Word(NUMBERS),
+                           Optional(Joined('.', Word(NUMBERS)))),
+            ['3', '-3', '3.14', '-', '3.', 'x', '', '300.9 and more'])
+
+    def testNoBacktracking(self):
+        # these parsers never give back what they have read, so none of
+        # these can match (although a normal regexp would):
+        self.assertSameParses(lambda: Joined(Word('a'), 'a'), ['aaa'])
+        self.assertSameParses(lambda: Joined(Multiple(SingleChar('a')), 'a'),
+                              ['aaa'])
+        self.assertSameParses(lambda: Joined(Either('a', 'ab'), 'c'),
+                              ['abc', 'ac'])
+        self.assertSameParses(lambda: Joined(Until('x'), 'y'),
+                              ['abxy', 'abxay'])
+
+    def testUntil(self):
+        self.assertSameParses(
+            lambda: Either(Joined('"', Until('"', escape='\\')),
+                           Joined('/*', Until('*/', fail_on_eof=True))),
+            ['"a string"', '"esc\\"aped" and', '"no end', '/* c */ x',
+             '/* no end'])
+
+    def testNamedAndMultiple(self):
+        self.assertSameParses(
+            lambda: NamedJoin(('spaces', Multiple(Either(' ', '\t'))),
+                              ('word', Word(LETTERS)),
+                              ('end', Multiple(Word('!?'),
+                                               allow_none=False))),
+            ['  hello!?', 'hello', 'hello!', '\t\t', ''])
+
+    def testRegexInside(self):
+        self.assertSameParses(
+            lambda: Multiple(Joined(Regex('[a-z]+'), Optional(','))),
+            ['a,bc,d', 'a,,b', ''])
+
+    def testSeparatedBy(self):
+        texts = ['', 'a', 'a, b', 'a,b,', 'a , ,b', 'a,b,c,d']
+        for trailing in (False, True):
+            for minimum in (0, 1, 2, 3):
+                self.assertSameParses(
+                    lambda: SeparatedBy(Word(LETTERS),
+                                        Joined(Optional(' '), ',',
+                                               Optional(' ')),
+                                        trailing=trailing, min=minimum),
+                    texts)
+
+    def testTrivia(self):
+        def grammar():
+            trivia = Trivia(Multiple(Either(Word(' \n'),
+                                            Joined('#', Until('\n')))))
+            return Multiple(trivia.around(Either(Word(LETTERS), ',')))
+
+        self.assertSameParses(grammar, ['', 'a', ' a , b#c\nd ', 'a,,b  '])
+
+        self.assertSameParses(
+            lambda: Multiple(Trivia(Word(' ')).around(Word(LETTERS))),
+            ['', 'a', ' a b  c ', 'ab'])
+
+    def testSkipper(self):
+        self.assertSameParses(
+            lambda: Multiple(Trivia(Skipper(Either(
+                Word(' '), Joined('#', Until('\n'))))).around(Word(LETTERS))),
+            ['', 'a', ' a b  c ', 'ab#c\n d'])
+
+
+    def testLookahead(self):
+        def grammar():
+            KEYWORD = Joined(Either('if', 'for'), Not(Word(LETTERS)))
+            return Multiple(Either(Joined(Not(KEYWORD), Word(LETTERS)),
+                                   Joined(And('i'), KEYWORD), ' '))
+
+        self.assertSameParses(grammar, ['', 'iffy if x', 'for fort', 'fo'])
+        self.assertIn('parse', fuse(grammar()).__dict__)
+
+        def guarded():
+            KEYWORD = Joined(Either('if', 'for'), Not(Word(LETTERS)))
+            return Multiple(Either(Guard(Not(KEYWORD), Word(LETTERS)),
+                                   KEYWORD, ' '))
+
+        self.assertSameParses(guarded, ['', 'iffy if x', 'for fort', 'fo'])
+        self.assertIn('parse', fuse(guarded()).__dict__)
+
+class TestFuseCache(PCTestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def grammar(self, word='cat'):
+        NUMBER = Joined(Optional('-'), Word(NUMBERS))
+        E = Either(NUMBER, word)
+        E.options.append(Joined('(', E, ')'))
+        return E
+
+    def testHash(self):
+        self.assertEquals(grammar_hash(self.grammar()),
+                          grammar_hash(self.grammar()))
+        self.assertNotEquals(grammar_hash(self.grammar()),
+                             grammar_hash(self.grammar('dog')))
+
+        # (the same, once it's been fused, or used)
+        G = self.grammar()
+        G.parse('(-1)')
+        self.assertEquals(grammar_hash(fuse(G)), grammar_hash(self.grammar()))
+
+    def testSaveAndLoad(self):
+        plain = self.grammar()
+        first = fuse(self.grammar(), cache=self.directory)
+        self.assertEquals(len(os.listdir(self.directory)), 1)
+
+        # the second time, nothing needs working out:
+        is_regular = pc._RegularGrammar.is_regular
+        try:
+            del pc._RegularGrammar.is_regular
+            second = fuse(self.grammar(), cache=self.directory)
+        finally:
+            pc._RegularGrammar.is_regular = is_regular
+
+        fused = [type(p).__name__ for p in walk(second) if pc._fused(p)]
+        self.assertEquals(fused,
+                          [type(p).__name__ for p in walk(first)
+                           if pc._fused(p)])
+        self.assertTrue(fused)
+
+        for text in ['12', '((-3))', '(cat)', '(dog)']:
+            try:
+                expected = plain.parse(text)
+            except NotHere:
+                with self.assertRaises(NotHere):
+                    second.parse(text)
+                continue
+            self.assertEquals(output(second.parse(text)[1]),
+                              output(expected[1]))
+
+    def testLazyCompile(self):
+        fuse(self.grammar(), cache=self.directory)
+        G = fuse(self.grammar(), cache=self.directory)
+        fused = [pc._fused(p) for p in walk(G) if pc._fused(p)]
+        self.assertTrue(all(f._regex is None for f in fused))
+
+        self.assertReadsFully(G, '(-12)')
+        self.assertTrue(any(f._regex is not None for f in fused))
+
+    def testChangedGrammar(self):
+        fuse(self.grammar(), cache=self.directory)
+        fuse(self.grammar('dog'), cache=self.directory)
+        self.assertEquals(len(os.listdir(self.directory)), 2)
+
+    def testClearsOld(self):
+        for name in ('fused-%s-%s.marshal' % ('0' * 40, 'other'),
+                     'fused-%s.marshal' % ('1' * 40),
+                     'fused-%s-%s.marshal' % ('2' * 40, pc._code_digest()),
+                     'unrelated'):
+            with open(os.path.join(self.directory, name), 'wb') as f:
+                f.write(b'old')
+        long_ago = time.time() - (pc.CACHE_DAYS + 1) * 24 * 60 * 60
+        os.utime(os.path.join(self.directory, name), (long_ago, long_ago))
+        os.utime(os.path.join(self.directory, 'fused-%s-%s.marshal' % (
+            '2' * 40, pc._code_digest())), (long_ago, long_ago))
+
+        fuse(self.grammar(), cache=self.directory)
+        names = sorted(os.listdir(self.directory))
+        self.assertEquals(len(names), 2)
+        self.assertTrue(names[0].endswith('-%s.marshal' % pc._code_digest()))
+        self.assertNotIn('2' * 40, names[0])
+        self.assertEquals(names[1], 'unrelated')
+
+    def testParseOwner(self):
+        # (a class with its own parse isn't the same grammar, even with the
+        #  same name - nor is one from a module whose code has changed)
+        def own_parse(self, text, position=0):
+            return Joined.parse(self, text, position)
+        plain = type('Custom', (Joined, ), {})('a', 'b')
+        own = type('Custom', (Joined, ), {'parse': own_parse})('a', 'b')
+        self.assertNotEquals(grammar_hash(plain), grammar_hash(own))
+
+        import php
+        self.assertIn(pc._source_digest(php.__file__),
+                      pc._grammar_code(list(walk(php.PHP_BLOCK))))
+        self.assertEquals(pc._grammar_code(list(walk(self.grammar()))), '')
+
+    def testBrokenCache(self):
+        fuse(self.grammar(), cache=self.directory)
+        for name in os.listdir(self.directory):
+            with open(os.path.join(self.directory, name), 'wb') as f:
+                f.write(b'rubbish')
+
+        G = fuse(self.grammar(), cache=self.directory)
+        self.assertReadsFully(G, '(-12)')
+
+
+class TestSession(PCTestCase):
+    def testSuccess(self):
+        S = Joined('a', Word('b'))
+        p = Session('abbc').parse(S)
+        self.assertHasRead(p, 3)
+        self.assertOutputs(p, 'abb')
+
+    def testNotHereMessage(self):
+        with self.assertRaises(NotHere) as raised:
+            SpecificWord('Daniel').parse('Becky')
+        self.assertEquals(str(raised.exception),
+                          'Expected "Daniel", instead found: "Becky"')
+
+    def testFurthestFailure(self):
+        WORD = Word(LETTERS)
+        S = Multiple(Joined(WORD, Either(',', ';'), Optional('\n')))
+        P = Joined(S, '.')
+
+        text = 'one,two;\nthree,four!'
+
+        with self.assertRaises(ParseError) as raised:
+            Session(text).parse(P)
+
+        error = raised.exception
+        self.assertEquals(error.position, text.index('!'))
+        self.assertEquals((error.line, error.column), (2, 11))
+        self.assertEquals(set(p.letter for p in error.expected),
+                          set([',', ';']))
+        self.assertTrue(str(error).startswith('line 2, column 11: expected '))
+
+        # and it is still a NotHere, for anyone who only wants that:
+        with self.assertRaises(NotHere):
+            Session(text).parse(P)
+
+    def testFusedFailure(self):
+        P = fuse(Joined('x', Joined('(', Word(NUMBERS), ')')))
+
+        with self.assertRaises(ParseError) as raised:
+            Session('x(12]').parse(P)
+
+        error = raised.exception
+        self.assertEquals(error.position, 4)
+        self.assertEquals([p.letter for p in error.expected], [')'])
+
+
+    def testExpectedOnce(self):
+        # (the same parser failing again in the same place isn't news)
+        B = SingleChar('b')
+        P = Either(Joined('a', B), Joined('a', Optional('x'), B))
+        session = Session('ac')
+        with self.assertRaises(ParseError) as raised:
+            session.parse(P)
+        self.assertEquals(len(session.expected), len(set(session.expected)))
+        self.assertEquals(sorted(p.letter for p in raised.exception.expected),
+                          ['b', 'x'])
+
+        # (nor does looking ahead leave anything behind)
+        X = SingleChar('x')
+        Q = Either(Joined('a', And(X), 'y'), Joined('a', B))
+        session = Session('ac')
+        with self.assertRaises(ParseError):
+            session.parse(Q)
+        self.assertIn(B, session.expected)
+        self.assertNotIn(X, session.expected)
+
+    def testLookaheadNotExpected(self):
+        P = Joined(Not(Joined('x', Word(NUMBERS))), Word(LETTERS), '.')
+        with self.assertRaises(ParseError) as raised:
+            Session('xy!').parse(P)
+        self.assertEquals(raised.exception.position, 2)
+        self.assertEquals([p.letter for p in raised.exception.expected],
+                          ['.'])
+
+
+class TestResync(PCTestCase):
+    def testSkip(self):
+        R = Resync(';}', end=('?>', ), atoms=Joined('"', Until('"')))
+        for text, skipped in (('a b; c', 'a b;'),
+                              ('a (b; c); d', 'a (b; c);'),
+                              ('a { b; } c', 'a { b; }'),
+                              ('a "b;" c; d', 'a "b;" c;'),
+                              ('a b } c', 'a b '),
+                              ('a b ?> c', 'a b '),
+                              ('a b', 'a b')):
+            self.assertEquals(R.match(text), len(skipped))
+            self.assertEquals(R.parse(text)[1]['text'], skipped)
+
+        for text in ('}', '?>', ''):
+            with self.assertRaises(NotHere):
+                R.match(text)
+
+        # (end stops it even inside brackets - which may never be closed)
+        self.assertEquals(R.match('a (b; ?> c)'), 6)
+
+    def testOutermost(self):
+        R = Resync(';}', end=('?>', ), outermost=True)
+        self.assertEquals(R.match('} b; c'), 1)
+        self.assertEquals(R.match('a ) b; c'), 6)
+        self.assertEquals(R.match('a } ?>'), 3)
+
+
+class TestRecover(PCTestCase):
+    def setUp(self):
+        self.ITEM = Joined(Word(LETTERS), ';')
+        self.BLOCK = Either(self.ITEM)
+        self.LIST = Multiple(self.BLOCK, recover=Resync(';}', end='.'))
+        self.BLOCK.options.append(Joined('{', self.LIST, '}'))
+        self.P = Joined(self.LIST, '.')
+
+    def testRecover(self):
+        text = 'a;b!;{c;d d;e;}f;.'
+        session = Session(text, recover=True)
+        p = session.parse(self.P)
+        self.assertHasRead(p, len(text))
+        self.assertOutputs(p, text)
+
+        self.assertEquals([(e.line, e.column) for e in session.errors],
+                          [(1, 4), (1, 10)])
+        self.assertEquals([text[start:end] for node, start, end in spans(p[1])
+                           if 'error' in node], ['b!;', 'd d;'])
+        self.assertEquals(session.errors[0].expected, set([self.ITEM.parts[1]]))
+
+    def testNotRecovering(self):
+        with self.assertRaises(ParseError):
+            Session('a;b!;.').parse(self.P)
+        with self.assertRaises(NotHere):
+            self.P.parse('a;b!;.')
+
+    def testUnrecoverable(self):
+        session = Session('a;b!', recover=True)
+        with self.assertRaises(ParseError):
+            session.parse(self.P)
+
+    def testNotFused(self):
+        L = fuse(Multiple(Word(LETTERS), recover=Resync(';')))
+        self.assertNotIn('parse', L.__dict__)
+
+class TestBudget(PCTestCase):
+    def setUp(self):
+        self.P = Multiple(Joined(Word(LETTERS), Optional(' ')))
+        self.text = 'the cat sat on the mat ' * 100
+
+    def testWithinBudget(self):
+        session = Session(self.text, max_steps=5000, max_nodes=5000,
+                          timeout=60)
+        p = session.parse(self.P)
+        self.assertHasRead(p, len(self.text))
+        self.assertTrue(0 < session.steps <= 5000)
+        self.assertTrue(0 < session.nodes <= 5000)
+
+    def testTooManySteps(self):
+        with self.assertRaises(BudgetExceeded) as raised:
+            Session(self.text, max_steps=50).parse(self.P)
+
+        error = raised.exception
+        self.assertEquals(error.reason, 'steps')
+        self.assertEquals(error.session.steps, 51)
+        # it got some of the way through:
+        self.assertTrue(0 < error.position < len(self.text))
+        self.assertEquals(error.line, 1)
+
+    def testTooManyNodes(self):
+        with self.assertRaises(BudgetExceeded) as raised:
+            Session(self.text, max_nodes=20).parse(self.P)
+        self.assertEquals(raised.exception.reason, 'nodes')
+
+    def testTimeout(self):
+        with self.assertRaises(BudgetExceeded) as raised:
+            Session(self.text, timeout=-1).parse(self.P)
+        self.assertEquals(raised.exception.reason, 'time')
+
+    def testNotCaughtByEither(self):
+        E = Either(Joined(self.P, '!'), self.P)
+        with self.assertRaises(BudgetExceeded):
+            Session(self.text, max_steps=50).parse(E)
+
+        # and the Either is still fine to use afterwards:
+        self.assertReadsFully(E, 'the cat!')
+
+
+class TestParseTask(PCTestCase):
+    def setUp(self):
+        self.P = Multiple(Joined(Word(LETTERS), Optional(' ')))
+        self.text = 'the cat sat on the mat ' * 100
+
+    def testSteps(self):
+        task = ParseTask(self.P, self.text, steps=100)
+        progress = [task.progress]
+        while task.step():
+            progress.append(task.progress)
+
+        self.assertTrue(len(progress) > 5)
+        self.assertEquals(progress, sorted(progress))
+        self.assertEquals(task.progress, 1.0)
+        self.assertReadsFully(self.P, self.text)
+        self.assertEquals(task.result(), self.P.parse(self.text))
+
+    def testChars(self):
+        task = ParseTask(self.P, self.text, steps=10 ** 6, chars=500)
+        reached = [0]
+        while task.step():
+            reached.append(task.session.reached)
+
+        self.assertTrue(len(reached) > 2)
+        for before, after in zip(reached, reached[1:]):
+            self.assertTrue(after - before >= 500)
+
+    def testResultRunsToEnd(self):
+        task = ParseTask(self.P, self.text, steps=100)
+        self.assertHasRead(task.result(), len(self.text))
+
+    def testFailure(self):
+        task = ParseTask(Joined(self.P, '!'), self.text, steps=100)
+        with self.assertRaises(ParseError):
+            task.result()
+
+    def testCancel(self):
+        task = ParseTask(self.P, self.text, steps=100)
+        task.step()
+        task.cancel()
+        self.assertTrue(task.done)
+        self.assertFalse(task.step())
+        with self.assertRaises(ParseCancelled):
+            task.result()
+
+        task = ParseTask(self.P, self.text, steps=100)
+        task.cancel()
+        with self.assertRaises(ParseCancelled):
+            task.result()
+
+    def testClose(self):
+        task = ParseTask(self.P, self.text, steps=100)
+        task.step()
+        thread = task._thread
+        task.close()
+        self.assertTrue(task.done)
+        self.assertFalse(thread.is_alive())
+        with self.assertRaises(ParseCancelled):
+            task.result()
+
+        # (a finished one is left as it was)
+        with ParseTask(self.P, self.text, steps=100) as task:
+            self.assertHasRead(task.result(), len(self.text))
+        self.assertHasRead(task.result(), len(self.text))
+
+    def testWith(self):
+        with ParseTask(self.P, self.text, steps=100) as task:
+            task.step()
+            thread = task._thread
+        self.assertFalse(thread.is_alive())
+
+    def testDropped(self):
+        task = ParseTask(self.P, self.text, steps=100)
+        task.step()
+        thread = task._thread
+        del task
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+
+
+class TestLineIndex(PCTestCase):
+    def testLocation(self):
+        text = 'one\ntwo\n\nfour'
+        lines = LineIndex(text)
+
+        for position in range(len(text) + 1):
+            line = text.count('\n', 0, position) + 1
+            column = position - text.rfind('\n', 0, position)
+            self.assertEquals(lines.location(position), (line, column))
+
+    def testOffset(self):
+        lines = LineIndex('one\ntwo\n\nfour')
+        self.assertEquals(lines.offset(1), 0)
+        self.assertEquals(lines.offset(2, 3), 6)
+        self.assertEquals(lines.offset(4), 9)
+        self.assertEquals(lines.location(lines.offset(4, 2)), (4, 2))
+
+        with self.assertRaises(IndexError):
+            lines.offset(5)
+
+    def testSession(self):
+        session = Session('a\nbc')
+        self.assertIs(session.lines, session.lines)
+        self.assertEquals(session.location(3), (2, 2))
+
+
+class TestSpans(PCTestCase):
+    def testSpans(self):
+        P = Joined(Word(LETTERS),
+                   NamedJoin(('colon', ':'), ('value', Word(NUMBERS))))
+        length, p = P.parse('abc:12', 0)
+
+        self.assertEquals([(n['class'], start, end)
+                           for n, start, end in spans(p)],
+                          [(P, 0, 6), (P.parts[0], 0, 3), (P.parts[1], 3, 6),
+                           (P.parts[1].parts[0][1], 3, 4),
+                           (P.parts[1].parts[1][1], 4, 6)])
+
+    def testPosition(self):
+        P = Word(LETTERS)
+        length, p = P.parse('12abc', 2)
+        self.assertEquals(spans(p, 2), [(p, 2, 5)])
+
+    def testTrivia(self):
+        W = Word(' ')
+        P = Multiple(Trivia(W).around(Word(LETTERS)))
+        text = ' ab  cd '
+        length, p = P.parse(text)
+
+        found = [(n['class'], text[start:end]) for n, start, end in spans(p)]
+        self.assertEquals(found, [(P, ' ab  cd '),
+                                  (W, ' '), (P.original.actual, 'ab'),
+                                  (W, '  '), (P.original.actual, 'cd'),
+                                  (W, ' ')])
+
+
+class TestEditableTree(PCTestCase):
+    def setUp(self):
+        self.outputs = []
+        outputs = self.outputs
+
+        class Counted(Joined):
+            def output(self, data, clean=False):
+                outputs.append(data)
+                return Joined.output(self, data, clean)
+
+        self.ITEM = Counted(Word(LETTERS), ';')
+        self.BLOCK = Either(self.ITEM)
+        self.P = Multiple(Trivia(Word(' ')).around(self.BLOCK))
+        self.BLOCK.options.append(Counted('{', self.P, '}'))
+        self.text = 'a; {b; {c;} } d;'
+
+    def items(self, tree):
+        return dict((output(node), node) for node, _, _ in spans(tree.root)
+                    if node['class'] is self.ITEM)
+
+    def testOutput(self):
+        tree = EditableTree(self.P.parse(self.text)[1])
+        self.assertEquals(tree.output(), self.text)
+        self.assertEquals(len(self.outputs), 6)
+
+        del self.outputs[:]
+        self.assertEquals(tree.output(), self.text)
+        self.assertEquals(self.outputs, [])
+
+    def testReplace(self):
+        tree = EditableTree(self.P.parse(self.text)[1])
+        tree.output()
+        c = self.items(tree)['c;']
+
+        del self.outputs[:]
+        tree.replace(c, self.ITEM.parse('cc;')[1])
+        self.assertEquals(tree.output(), 'a; {b; {cc;} } d;')
+        # (only the new item, and the two blocks it's in:)
+        self.assertEquals(len(self.outputs), 3)
+
+        self.assertEquals(tree.output(clean=True), 'a; {b; {cc;} } d;')
+        self.assertEquals(tree.output(), 'a; {b; {cc;} } d;')
+
+    def testInsertRemove(self):
+        tree = EditableTree(self.P.parse(self.text)[1])
+        tree.output()
+        b = self.items(tree)['b; ']      # (with the trivia after it)
+        block = tree.parent(b)
+
+        tree.insert(block, 0, self.ITEM.parse('x;')[1])
+        self.assertEquals(tree.output(), 'a; {x;b; {c;} } d;')
+        tree.remove(b)
+        self.assertEquals(tree.output(), 'a; {x;{c;} } d;')
+
+    def testChanged(self):
+        tree = EditableTree(self.P.parse(self.text)[1])
+        tree.output()
+        d = self.items(tree)['d;']
+        d['parts'][0] = {'class': d['parts'][0]['class'], 'text': 'dd'}
+        self.assertEquals(tree.output(), self.text)
+        tree.changed(d)
+        self.assertEquals(tree.output(), 'a; {b; {c;} } dd;')
+
+    def testShared(self):
+        # (the ; nodes are all the same one, until they're in a tree)
+        trees = [EditableTree(self.ITEM.parse(text)[1]) for text in ('a;', 'b;')]
+        semicolon = trees[0].root['parts'][1]
+        self.assertIsNot(semicolon, self.ITEM.parts[1].data)
+        trees[0].replace(semicolon, SingleChar('!').parse('!')[1])
+        self.assertEquals(trees[0].output(), 'a!')
+        self.assertEquals(trees[1].output(), 'b;')
+        self.assertEquals(self.ITEM.parse('c;')[1]['parts'][1]['text'], ';')
 
 class TestReprs(TestCase):
     ''' these tests are internal to the library, and shouldn't be relied
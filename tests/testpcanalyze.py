@@ -0,0 +1,238 @@
+'''
+    tests for pcanalyze.py, static analysis of pc.py grammars.
+    ------
+    Copyright (C) 2014 Daniel Fairhead
+    GPL3 Licence.
+
+'''
+# pylint: disable=too-many-public-methods, missing-docstring, invalid-name
+# pylint: disable=no-self-use, wildcard-import
+
+from test import PCTestCase
+
+from pc import *
+from pcanalyze import *
+
+class TestNullableFirst(PCTestCase):
+    def testTerminals(self):
+        for parser, nullable, first in (
+                (Nothing(), True, ''),
+                (SingleChar('a'), False, 'a'),
+                (SpecificWord('if'), False, 'i'),
+                (Word('ab'), False, 'ab'),
+                (Until('!'), True, None),
+                (Regex('a*'), True, None)):
+            analysis = Analysis(parser)
+            self.assertEquals(analysis.nullable(parser), nullable)
+            self.assertEquals(analysis.first(parser),
+                              None if first is None else frozenset(first))
+
+    def testCombined(self):
+        P = Joined(Optional('-'), Word(NUMBERS))
+        analysis = Analysis(P)
+        self.assertFalse(analysis.nullable(P))
+        self.assertEquals(analysis.first(P), frozenset('-' + NUMBERS))
+
+        M = Multiple(Either('a', 'b'))
+        self.assertTrue(Analysis(M).nullable(M))
+        self.assertEquals(Analysis(M).first(M), frozenset('ab'))
+
+        S = SeparatedBy(Word('x'), ',', min=1)
+        self.assertFalse(Analysis(S).nullable(S))
+
+    def testRecursive(self):
+        E = Either('a')
+        E.options += (Joined('(', E, ')'), Joined(E, '+', E))
+        analysis = Analysis(E)
+        self.assertFalse(analysis.nullable(E))
+        self.assertEquals(analysis.first(E), frozenset('a('))
+
+    def testTrivia(self):
+        T = Trivia(Word(' '))
+        P = T.around('x')
+        analysis = Analysis(P)
+        self.assertTrue(analysis.nullable(T))
+        self.assertEquals(analysis.first(P), frozenset(' x'))
+
+    def testLookahead(self):
+        P = Joined(Not('x'), Word('xyz'))
+        analysis = Analysis(P)
+        self.assertTrue(analysis.nullable(P.parts[0]))
+        self.assertFalse(analysis.nullable(P))
+        self.assertEquals(analysis.first(P), frozenset('xyz'))
+
+        G = Guard(Not('x'), Word('xyz'))
+        analysis = Analysis(G)
+        self.assertFalse(analysis.nullable(G))
+        self.assertEquals(analysis.first(G), frozenset('xyz'))
+
+
+class TestDisjoint(PCTestCase):
+    def testDisjoint(self):
+        A, B, C = SpecificWord('if'), Word(NUMBERS), Word('abcdefghi')
+        N = Joined(Optional('x'))
+        analysis = Analysis(Either(A, B, C, N))
+        self.assertTrue(analysis.disjoint(A, B))
+        self.assertFalse(analysis.disjoint(A, C))
+        self.assertFalse(analysis.disjoint(B, N))   # (N can match nothing)
+
+    def testAfterTrivia(self):
+        T = Trivia(Word(' '))
+        A = Joined(T.around('if'), T.around('('))
+        B = T.around(Word(NUMBERS))
+        C = Trivia(Word(' ')).around(Word(NUMBERS))
+        analysis = Analysis(Either(A, B, C))
+
+        self.assertTrue(analysis.disjoint(A, B))
+        # (not the same trivia, so can't tell what comes after it)
+        self.assertFalse(analysis.disjoint(A, C))
+
+    def testEitherAfterTrivia(self):
+        # (each option of an Either, when they all start with the trivia)
+        T = Trivia(Word(' '))
+        CHANGE = Either(Joined(T.around('++'), T.around('$')),
+                        Joined(T.around('$'), T.around('++')))
+        CALL = Joined(T.around(Word(LETTERS)), T.around('('))
+        MIXED = Either(T.around('$'), Word(NUMBERS))
+        analysis = Analysis(Joined(CHANGE, CALL, MIXED))
+        self.assertTrue(analysis.disjoint(CHANGE, CALL))
+        self.assertFalse(analysis.disjoint(CHANGE, MIXED))
+        self.assertEquals(analysis.overlapping(Either(CHANGE, CALL)), [])
+
+
+class TestFollow(PCTestCase):
+    def testFollow(self):
+        A, B = Word('ab'), Optional(',')
+        P = Joined(A, B, ';')
+        analysis = Analysis(P)
+        self.assertEquals(analysis.follow(P), frozenset(['']))
+        self.assertEquals(analysis.follow(A), frozenset(',;'))
+        self.assertEquals(analysis.follow(B), frozenset(';'))
+
+    def testRepeated(self):
+        A = Word('ab')
+        L = SeparatedBy(A, ',')
+        P = Joined(Multiple(L), '.')
+        analysis = Analysis(P)
+        self.assertEquals(analysis.follow(A), frozenset('ab,.'))
+
+
+class TestFindings(PCTestCase):
+    def kinds(self, grammar, names=None):
+        return [(f.kind, f.rule) for f in Analysis(grammar).findings(names)]
+
+    def testShadowed(self):
+        OP = Either('+', '<', '<<', '=', Word('=!'), '!=')
+        analysis = Analysis(OP)
+        self.assertEquals(analysis.shadowed(OP),
+                          [(OP.options[1], OP.options[2]),
+                           (OP.options[4], OP.options[5])])
+        IF = Either('if', 'if')
+        self.assertEquals(len(Analysis(IF).shadowed(IF)), 1)
+
+        ELSE = Joined('else', Optional(Joined(' ', 'if')))
+        E = Either(SpecificWord('else'), Joined('else', ' if'), ELSE)
+        self.assertEquals(self.kinds(E, {'E': E}), [('shadowed', 'E')] * 2)
+
+    def testWordShadows(self):
+        W = Word(LETTERS)
+        E = Either(W, 'if', Joined(Word(NUMBERS), '!'))
+        self.assertEquals([l for _, l in Analysis(E).shadowed(E)],
+                          [E.options[1]])
+
+    def testNullableRepeat(self):
+        M = Multiple(Optional('x'))
+        self.assertEquals(self.kinds(M, {'M': M}), [('nullable-repeat', 'M')])
+
+    def testStarved(self):
+        W = Word('ab')
+        P = Joined(W, 'a')
+        self.assertEquals(self.kinds(P, {'P': P, 'W': W}), [('starved', 'W')])
+        self.assertEquals(self.kinds(Joined(W, Optional('a'))), [])
+
+    def testOverlap(self):
+        VAR = Joined('$', Word(LETTERS))
+        CALL = Joined(VAR, '(', ')')
+        E = Either(CALL, Joined(VAR, '++'), Joined('#', VAR))
+        analysis = Analysis(E)
+        self.assertEquals(analysis.overlapping(E),
+                          [(E.options[0], E.options[1], VAR)])
+        self.assertEquals(self.kinds(E, {'E': E}), [('overlap', 'E')])
+        # (trying a plain word first costs nothing)
+        OP = Either('++', '+')
+        self.assertEquals(Analysis(OP).overlapping(OP), [])
+
+    def testExponential(self):
+        THING = Either(Word(NUMBERS))
+        EXPR = Joined('(', THING, ')')
+        THING.options[:0] = [Joined(EXPR, '+', THING), EXPR]
+        self.assertEquals(self.kinds(THING, {'THING': THING, 'EXPR': EXPR}),
+                          [('exponential', 'THING')])
+        self.assertIn('EXPR', str(Analysis(THING).findings(
+            {'THING': THING, 'EXPR': EXPR})[0]))
+
+    def testLeftRecursion(self):
+        E = Either(Word(NUMBERS))
+        SUM = Joined(E, '+', E)
+        E.options.insert(0, SUM)
+        loops = Analysis(E).left_recursion()
+        self.assertEquals(loops, [[E, SUM, E]])
+
+        findings = Analysis(E).findings({'E': E, 'SUM': SUM})
+        self.assertEquals(findings[0].kind, 'left-recursion')
+        self.assertIn('E -> SUM -> E', findings[0].message)
+
+        # (through things which can match nothing, too)
+        O = Either('x')
+        P = Joined(Optional('-'), O)
+        O.options.append(P)
+        self.assertEquals(len(Analysis(P).left_recursion()), 1)
+
+    def testUnnamed(self):
+        E = Either(Word(LETTERS), 'if')
+        P = Joined('(', E, ')')
+        self.assertEquals(self.kinds(P, {'P': P}),
+                          [('shadowed', '%r in P' % E)])
+
+    def testInnermost(self):
+        # (named by the smallest rule they're in, even one which an Either
+        #  has taken the options of)
+        WORD = Word(LETTERS)
+        STRING = Joined('"', Until('"')) | Joined("'", Until("'"))
+        SKIP = Either(STRING, Word('#'))
+        THING = Either(Joined(WORD, '+', WORD), STRING, WORD)
+        P = Joined(Multiple(SKIP), THING)
+        names = {'P': P, 'SKIP': SKIP, 'STRING': STRING, 'THING': THING,
+                 'WORD': WORD}
+        rules = Analysis(P)._rules(names)  # pylint: disable=protected-access
+        self.assertEquals(rules[id(STRING.options[0])],
+                          '%r in STRING' % STRING.options[0])
+        self.assertEquals(rules[id(THING.options[0])],
+                          '%r in THING' % THING.options[0])
+        self.assertEquals(rules[id(WORD)], 'WORD')
+
+    def testLazy(self):
+        # (a Lazy parser has just the same findings as the parser itself)
+        TRIVIA = Trivia(Word(' '))
+        WORD = Word(LETTERS)
+        BLOCK = Joined(TRIVIA.around('{'), Multiple(WORD), '}')
+        LINE = Joined(TRIVIA.around(WORD), ';')
+        LAZY = Lazy(BLOCK, lambda text, position: 0)
+        for P in (Either(BLOCK, LINE, Joined(WORD, '=')),
+                  Either(BLOCK, Joined(TRIVIA.around('{'), '}'))):
+            plain = self.kinds(P, {'P': P})
+            P.options[0] = LAZY
+            self.assertEquals(self.kinds(P, {'P': P}), plain)
+
+    def testPHP(self):
+        import php
+        findings = Analysis(php.PHP_BLOCK).findings(vars(php))
+        self.assertNotIn('shadowed', [f.kind for f in findings])
+        self.assertIn(('exponential', 'THING'),
+                      [(f.kind, f.rule) for f in findings])
+        # (INPLACE_CHANGE's options all start with trivia, the same as these)
+        messages = [str(f) for f in findings]
+        for rule in ('FUNC_APP', 'EXPR'):
+            self.assertNotIn('overlap: THING: %s and INPLACE_CHANGE can start '
+                             'the same way' % rule, messages)
+        self.assertFalse([m for m in messages if 'RESYNC' in m])
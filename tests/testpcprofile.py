@@ -0,0 +1,178 @@
+'''
+    tests for pcprofile.py, profiling pc.py grammars.
+    ------
+    Copyright (C) 2014 Daniel Fairhead
+    GPL3 Licence.
+
+'''
+# pylint: disable=too-many-public-methods, missing-docstring, invalid-name
+# pylint: disable=no-self-use, wildcard-import
+
+import os
+import shutil
+import tempfile
+
+from test import PCTestCase
+
+from pc import *
+from pcprofile import *
+
+def grammar():
+    WORD = Word(LETTERS)
+    NUMBER = Word(NUMBERS)
+    CALL = Joined(WORD, '(', ')')
+    VALUE = Either(CALL, WORD, '(', NUMBER)
+    return Multiple(Joined(VALUE, Optional(' ')))
+
+TEXT = '1 2 3 x 4 f() 5 6 ( 7'
+
+class TestOptionProfile(PCTestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, 'test.order')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def testCounts(self):
+        G = grammar()
+        VALUE = G.original.parts[0]
+        profile = OptionProfile(G)
+        with profile:
+            self.assertHasRead(G.parse(TEXT), len(TEXT))
+
+        self.assertEquals(profile.wins(VALUE), ([1, 1, 1, 7], 1))
+        self.assertEquals([type(o) for o in VALUE.options],
+                          [Joined, Word, SingleChar, Word])
+
+    def testOrders(self):
+        G = grammar()
+        VALUE = G.original.parts[0]
+        CALL, WORD, BRACKET, NUMBER = VALUE.options
+        profile = OptionProfile(G)
+        with profile:
+            G.parse(TEXT)
+
+        # NUMBER can go first, but WORD must stay after CALL:
+        orders = profile.orders()
+        self.assertEquals(orders[VALUE], [NUMBER, CALL, WORD, BRACKET])
+        self.assertIn('options tried', profile.report())
+
+    def testReorder(self):
+        G = grammar()
+        before = G.parse(TEXT)
+        profile = OptionProfile(G)
+        with profile:
+            G.parse(TEXT)
+        profile.save(self.filename)
+
+        G = grammar()
+        self.assertTrue(reorder(G, self.filename))
+        VALUE = G.original.parts[0]
+        self.assertEquals([type(o) for o in VALUE.options],
+                          [Word, Joined, Word, SingleChar])
+        self.assertEquals(output(G.parse(TEXT)[1]), output(before[1]))
+
+        # (profiling it again still sees it as the original grammar)
+        profile = OptionProfile(G)
+        with profile:
+            G.parse(TEXT)
+        self.assertEquals(profile.hash, grammar_hash(grammar()))
+
+    def testOtherGrammar(self):
+        G = grammar()
+        profile = OptionProfile(G)
+        with profile:
+            G.parse(TEXT)
+        profile.save(self.filename)
+
+        other = Multiple(Either(Word(LETTERS), Word(NUMBERS)))
+        self.assertFalse(reorder(other, self.filename))
+        self.assertFalse(reorder(other, self.filename + '.missing'))
+
+
+class TestRuleStacks(PCTestCase):
+    def setUp(self):
+        self.WORD = Word(LETTERS)
+        self.NUMBER = Word(NUMBERS)
+        self.CALL = Joined(self.WORD, '(', ')')
+        self.VALUE = Either(self.CALL, self.WORD, self.NUMBER)
+        self.G = Multiple(Joined(self.VALUE, Optional(' ')))
+        self.names = {'WORD': self.WORD, 'NAME': self.WORD,
+                      'NUMBER': self.NUMBER, 'CALL': self.CALL,
+                      'VALUE': self.VALUE, 'G': self.G, 'TEXT': 'G'}
+
+    def testNames(self):
+        self.assertEquals(rule_names(self.G, self.names)[id(self.WORD)],
+                          'NAME/WORD')
+        self.assertNotIn(id(self.G.original),
+                         rule_names(self.G, self.names))
+
+    def testChars(self):
+        stacks = RuleStacks(self.G, self.names)
+        with stacks:
+            self.assertHasRead(self.G.parse('ab 12 f()'), 9)
+
+        lines = dict(line.rsplit(' ', 1)
+                     for line in stacks.collapsed('chars').splitlines())
+        self.assertEquals(lines, {
+            'G': '2',                               # the spaces
+            'G;VALUE;CALL': '2',                    # ()
+            'G;VALUE;CALL;NAME/WORD': '3',          # ab, f
+            'G;VALUE;NAME/WORD': '2',               # ab
+            'G;VALUE;NUMBER': '2'})                 # 12
+
+    def testTime(self):
+        stacks = RuleStacks(self.G, self.names)
+        with stacks:
+            self.G.parse('ab 12 f()' * 100)
+
+        for line in stacks.collapsed().splitlines():
+            stack, count = line.rsplit(' ', 1)
+            self.assertTrue(stack.startswith('G'))
+            self.assertGreaterEqual(int(count), 1)
+
+    def testUninstalled(self):
+        with RuleStacks(self.G, self.names):
+            self.assertIn('parse', self.VALUE.__dict__)
+        self.assertNotIn('parse', self.VALUE.__dict__)
+
+
+class TestAllocations(PCTestCase):
+    def setUp(self):
+        self.WORD = Word(LETTERS)
+        self.CALL = Joined(self.WORD, '(', ')')
+        self.VALUE = Either(self.CALL, self.WORD)
+        self.G = Multiple(Joined(self.VALUE, Optional(' ')))
+        self.names = {'WORD': self.WORD, 'CALL': self.CALL, 'G': self.G}
+
+    def testRetainedTransient(self):
+        allocations = Allocations(self.G, self.names)
+        with allocations:
+            allocations.settle(self.G.parse('ab cd()')[1])
+
+        totals = allocations.totals
+        # ab is read twice (once by CALL, which then fails), cd once:
+        self.assertEquals(totals['WORD'][:3], [2, 0, 2])
+        self.assertEquals(totals['WORD'][4:7], [1, 0, 1])
+        self.assertEquals(totals['CALL'][:3], [1, 1, 0])
+        self.assertEquals(totals['G'][:3], [1, 1, 0])
+        self.assertGreater(totals['WORD'][7], 0)
+        self.assertIn('WORD', allocations.report())
+
+    def testShared(self):
+        P = Multiple(SingleChar('a'))
+        allocations = Allocations(P)
+        with allocations:
+            allocations.settle(P.parse('aaa')[1])
+        self.assertEquals(allocations.totals.keys(), ['#0 %r' % P])
+        self.assertEquals(allocations.totals['#0 %r' % P][:3], [1, 1, 0])
+
+    def testFailed(self):
+        allocations = Allocations(self.CALL, self.names)
+        with allocations:
+            with self.assertRaises(NotHere):
+                self.CALL.parse('ab')
+            allocations.settle(None)
+        self.assertEquals(allocations.totals['WORD'][:7],
+                          [0, 0, 0, 0, 1, 0, 1])
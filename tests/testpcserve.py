@@ -0,0 +1,230 @@
+'''
+    tests for pcserve.py, the daemon which keeps grammars loaded.
+    ------
+    Copyright (C) 2014 Daniel Fairhead
+    GPL3 Licence.
+
+'''
+# pylint: disable=too-many-public-methods, missing-docstring, invalid-name
+# pylint: disable=no-self-use, wildcard-import
+
+import os
+import shutil
+import socket
+import stat
+import tempfile
+import threading
+import time
+
+from test import PCTestCase
+
+from pcserve import *
+
+PHP = '<?php $x = 1; echo $x; ?>'
+BAD = '<?php $x = 1;\n  $y = ; echo $x; ?>'
+
+class TestGrammars(PCTestCase):
+    def setUp(self):
+        self.grammars = Grammars(['php:PHP_BLOCK', 'php:THING'])
+
+    def testParse(self):
+        reply = self.grammars.handle({'command': 'parse', 'text': PHP})
+        self.assertTrue(reply['ok'])
+        self.assertEquals(reply['tree']['rule'], 'PHP_BLOCK')
+        self.assertEquals(reply['tree']['parts'][0]['text'], '<?php')
+
+        reply = self.grammars.handle({'command': 'parse', 'text': '$x + 1',
+                                      'grammar': 'php:THING'})
+        self.assertEquals(reply['tree']['rule'], 'INFIXED')
+
+    def testFormat(self):
+        # (not supported:  nothing has a clean output)
+        reply = self.grammars.handle({'command': 'format', 'text': PHP})
+        self.assertFalse(reply['ok'])
+        self.assertIn('not supported', reply['error'])
+
+    def testValidate(self):
+        reply = self.grammars.handle({'command': 'validate', 'text': PHP})
+        self.assertEquals(reply, {'ok': True, 'errors': []})
+
+        reply = self.grammars.handle({'command': 'validate', 'text': BAD})
+        self.assertTrue(reply['ok'])
+        self.assertEquals([(e['line'], e['column']) for e in reply['errors']],
+                          [(2, 8)])
+
+    def testErrors(self):
+        reply = self.grammars.handle({'command': 'parse', 'text': BAD})
+        self.assertFalse(reply['ok'])
+        self.assertEquals((reply['line'], reply['column']), (2, 8))
+
+        # (reads some, but not all of it)
+        reply = self.grammars.handle({'command': 'parse', 'text': PHP + '!'})
+        self.assertFalse(reply['ok'])
+
+        for request in ({'command': 'compile', 'text': PHP},
+                        {'command': 'parse', 'text': PHP, 'grammar': 'x:Y'},
+                        {'command': 'parse'},
+                        {'command': 'parse', 'path': '/not/a/file.php'}):
+            self.assertFalse(self.grammars.handle(request)['ok'])
+
+    def testTooDeep(self):
+        # (more than python's recursion limit copes with:  still a reply)
+        text = '<?php $a = %s; ?>' % ' + '.join(['1'] * 500)
+        reply = self.grammars.handle({'command': 'parse', 'text': text})
+        self.assertFalse(reply['ok'])
+        self.assertIn('RuntimeError', reply['error'])
+
+    def testPath(self):
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'test.php')
+            with open(path, 'w') as php_file:
+                php_file.write(PHP)
+            request = {'command': 'parse', 'path': path}
+            reply = self.grammars.handle(request)
+            self.assertEquals(reply['tree']['rule'], 'PHP_BLOCK')
+            self.assertIs(self.grammars.handle(request), reply)
+        finally:
+            shutil.rmtree(directory)
+
+
+class TestDaemon(PCTestCase):
+    workers = 0
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'test.sock')
+        self.daemon = Daemon(self.path, Grammars(['php:PHP_BLOCK']),
+                             workers=self.workers, idle=0.5)
+        self.daemon.timeout = 0.05
+        self.thread = threading.Thread(target=self.daemon.serve)
+        self.thread.start()
+
+    def tearDown(self):
+        self.daemon.stopping = True
+        self.thread.join()
+        shutil.rmtree(self.directory)
+
+    def testRequests(self):
+        self.assertTrue(request({'command': 'parse', 'text': PHP},
+                                self.path)['ok'])
+        self.assertFalse(request({'command': 'parse', 'text': BAD},
+                                 self.path)['ok'])
+
+    def testConcurrent(self):
+        replies = []
+        def ask():
+            text = '<?php %s ?>' % ('$x = $y + 1; ' * 20)
+            replies.append(request({'command': 'validate', 'text': text},
+                                   self.path))
+        threads = [threading.Thread(target=ask) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEquals(len(replies), 8)
+        self.assertFalse([reply for reply in replies if not reply['ok']])
+
+    def testBadRequest(self):
+        connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        connection.connect(self.path)
+        connection.sendall('not json\n')
+        self.assertIn('bad request', connection.makefile().readline())
+        connection.close()
+
+    def testTooDeep(self):
+        text = '<?php $a = %s; ?>' % ' + '.join(['1'] * 500)
+        for command in ('parse', 'validate'):
+            reply = request({'command': command, 'text': text}, self.path)
+            self.assertFalse(reply['ok'])
+        self.assertTrue(request({'command': 'parse', 'text': PHP},
+                                self.path)['ok'])
+
+    def testNoReply(self):
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        path = os.path.join(self.directory, 'silent.sock')
+        listener.bind(path)
+        listener.listen(1)
+        def hang_up():
+            connection = listener.accept()[0]
+            connection.makefile().readline()
+            connection.close()
+        thread = threading.Thread(target=hang_up)
+        thread.start()
+        try:
+            with self.assertRaises(RuntimeError):
+                request({'command': 'parse', 'text': PHP}, path)
+        finally:
+            thread.join()
+            listener.close()
+
+    def testIdle(self):
+        request({'command': 'validate', 'text': PHP}, self.path)
+        self.thread.join(5)
+        self.assertFalse(self.thread.is_alive())
+        self.assertFalse(os.path.exists(self.path))
+
+    def testStop(self):
+        self.assertTrue(request({'command': 'stop'}, self.path)['ok'])
+        self.thread.join(5)
+        self.assertFalse(self.thread.is_alive())
+
+    def testPrivate(self):
+        self.assertEquals(stat.S_IMODE(os.stat(self.path).st_mode), 0o600)
+
+    def testAlreadyServed(self):
+        with self.assertRaises(RuntimeError):
+            Daemon(self.path, Grammars(['php:PHP_BLOCK']), workers=0)
+
+
+class TestDaemonWorkers(TestDaemon):
+    workers = 2
+
+
+class TestStale(PCTestCase):
+    def testStaleSocket(self):
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'test.sock')
+            dead = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            dead.bind(path)
+            dead.close()
+
+            daemon = Daemon(path, Grammars(['php:PHP_BLOCK']), workers=0,
+                            idle=0)
+            daemon.serve()
+            self.assertFalse(os.path.exists(path))
+        finally:
+            shutil.rmtree(directory)
+
+class TestDefaultSocket(PCTestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.environ = os.environ.pop('XDG_RUNTIME_DIR', None)
+        self.tempdir, tempfile.tempdir = tempfile.tempdir, self.directory
+
+    def tearDown(self):
+        tempfile.tempdir = self.tempdir
+        if self.environ is not None:
+            os.environ['XDG_RUNTIME_DIR'] = self.environ
+        shutil.rmtree(self.directory)
+
+    def testRuntimeDir(self):
+        os.environ['XDG_RUNTIME_DIR'] = self.directory
+        try:
+            self.assertEquals(default_socket(),
+                              os.path.join(self.directory, 'pcserve.sock'))
+        finally:
+            del os.environ['XDG_RUNTIME_DIR']
+
+    def testPrivateDir(self):
+        path = default_socket()
+        directory = os.path.dirname(path)
+        self.assertEquals(os.path.dirname(directory), self.directory)
+        self.assertEquals(stat.S_IMODE(os.stat(directory).st_mode), 0o700)
+        self.assertEquals(default_socket(), path)
+
+        # (one anyone else can get into won't do)
+        os.chmod(directory, 0o777)
+        with self.assertRaises(RuntimeError):
+            default_socket()
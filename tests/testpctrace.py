@@ -0,0 +1,120 @@
+'''
+    tests for pctrace.py, the backtracking tracer for pc.py grammars.
+    ------
+    Copyright (C) 2014 Daniel Fairhead
+    GPL3 Licence.
+
+'''
+# pylint: disable=too-many-public-methods, missing-docstring, invalid-name
+# pylint: disable=no-self-use, wildcard-import
+
+import os
+import shutil
+import tempfile
+from StringIO import StringIO
+
+from test import PCTestCase
+
+from pc import *
+from pctrace import *
+
+class TestTracer(PCTestCase):
+    def setUp(self):
+        self.A = SpecificWord('ab')
+        self.B = Word('abc')
+        self.E = Either(Joined(self.A, '!'), self.B)
+
+    def testEvents(self):
+        tracer = Tracer(self.E)
+        with tracer:
+            self.assertHasRead(self.E.parse('abc'), 3)
+
+        events = [(name.split(' ', 1)[1], start, end, reached, depth)
+                  for name, start, end, reached, depth, _
+                  in sorted(tracer.trace(), key=lambda e: e[5])]
+        self.assertEquals(events, [
+            (repr(self.E), 0, 3, 3, 0),
+            (repr(self.E.options[0]), 0, None, 2, 1),
+            (repr(self.A), 0, 2, 2, 2),
+            ("<SingleChar:\"!\">", 2, None, 2, 2),
+            (repr(self.B), 0, 3, 3, 1)])
+
+    def testUninstalled(self):
+        F = fuse(Joined(Word(LETTERS), '!'))
+        fused_parse = F.parse
+
+        with Tracer(Multiple(Joined(F, self.E))):
+            self.assertNotEqual(F.parse, fused_parse)
+            self.assertIn('parse', self.E.__dict__)
+
+        self.assertEquals(F.parse, fused_parse)
+        self.assertNotIn('parse', self.E.__dict__)
+        self.assertNotIn('parse', self.A.__dict__)
+
+    def testRing(self):
+        tracer = Tracer(self.B, size=4)
+        with tracer:
+            for i in range(1, 11):
+                self.B.parse('a' * i + 'x')
+
+        trace = tracer.trace()
+        self.assertEquals(tracer.count, 10)
+        self.assertEquals(len(trace), 4)
+        self.assertEquals([end for _, _, end, _, _, _ in trace],
+                          [7, 8, 9, 10])
+
+    def testWasted(self):
+        tracer = Tracer(self.E)
+        with tracer:
+            self.E.parse('abc')
+            self.E.parse('abc')
+
+        wasted = dict((name.split(' ', 1)[1], counts)
+                      for name, counts in tracer.trace().wasted().items())
+        self.assertEquals(wasted[repr(self.E.options[0])], (2, 2, 4))
+        self.assertEquals(wasted[repr(self.B)], (2, 0, 0))
+
+
+class TestTraceFiles(PCTestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, 'test.pctrace')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def testSaveLoad(self):
+        P = Multiple(Either(Joined('a', 'b'), 'a'))
+        tracer = Tracer(P)
+        with tracer:
+            P.parse('abaab')
+
+        trace = tracer.trace()
+        trace.save(self.filename)
+        loaded = Trace.load(self.filename)
+
+        self.assertEquals(loaded.names, trace.names)
+        self.assertEquals(list(loaded), list(trace))
+
+    def testReplay(self):
+        text = 'ab\naa!'
+        P = Multiple(Either(Joined('a', '!'), Word('ab\n')))
+        tracer = Tracer(P)
+        with tracer:
+            P.parse(text)
+
+        out = StringIO()
+        tracer.trace().replay(text, out)
+        lines = out.getvalue().splitlines()
+
+        self.assertEquals(len(lines), len(tracer.trace()))
+        self.assertIn("FAIL 'a'|", lines[2])
+        self.assertIn("ok   'ab\\naa'", lines[5])
+        self.assertTrue(lines[6].strip().startswith('2:3 '))
+        self.assertIn("FAIL ''|", lines[6])
+
+    def testBadFile(self):
+        with open(self.filename, 'wb') as f:
+            f.write(b'not a trace')
+        with self.assertRaises((ValueError, EOFError, TypeError)):
+            Trace.load(self.filename)
@@ -0,0 +1,130 @@
+'''
+    tests for pctree.py, saving & loading parsed trees.
+    ------
+    Copyright (C) 2014 Daniel Fairhead
+    GPL3 Licence.
+
+'''
+# pylint: disable=too-many-public-methods, missing-docstring, invalid-name
+# pylint: disable=no-self-use, wildcard-import
+
+from array import array
+import os
+import shutil
+import tempfile
+
+from test import PCTestCase
+
+from pc import *
+from pctree import *
+from php import PHP_BLOCK
+
+PHP = '''<?php
+    $x = 1; // comment
+    if ($x == 2) { echo "hi"; } else { $y = foo($x, $z, 3); }
+    /* block */ for ($i = 0; $i < 10; $i++) { print $i; }
+?>'''
+
+def shape(tree):
+    ''' tree, as plain dicts & lists. '''
+    if isinstance(tree, dict):
+        return dict((key, value if key == 'class' else shape(value))
+                    for key, value in tree.items())
+    elif isinstance(tree, list):
+        return [shape(value) for value in tree]
+    return tree
+
+class TestSaveLoad(PCTestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, 'test.pctree')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def assertRoundTrips(self, grammar, text):
+        tree = grammar.parse(text)[1]
+        save(tree, grammar, self.filename)
+        loaded = load(self.filename, grammar)
+        self.assertEquals(output(loaded), text)
+        self.assertEquals(shape(loaded), shape(tree))
+        return loaded
+
+    def testPHP(self):
+        self.assertRoundTrips(PHP_BLOCK, PHP)
+
+    def testNamed(self):
+        P = Multiple(NamedJoin(('name', Word(LETTERS)),
+                               ('value', Optional(Joined('=', Word(NUMBERS)))),
+                               ('end', ';')))
+        self.assertRoundTrips(P, 'a=1;bc;d=234;')
+
+    def testUnicode(self):
+        P = Multiple(Trivia(Word(u' ')).around(Word(u'\xe9\u263a')))
+        loaded = self.assertRoundTrips(P, u' \u263a\xe9 \xe9 ')
+        self.assertIsInstance(output(loaded), unicode)
+
+    def testShared(self):
+        P = Multiple(Either('a', 'b'))
+        loaded = self.assertRoundTrips(P, 'abba')
+        self.assertIs(loaded['parts'][0], P.original.options[0].data)
+
+    def testLazy(self):
+        save(PHP_BLOCK.parse(PHP)[1], PHP_BLOCK, self.filename)
+        loaded = load(self.filename, PHP_BLOCK)
+
+        self.assertIsInstance(loaded, LazyNode)
+        self.assertIs(loaded['class'], PHP_BLOCK)
+        statements = loaded['parts'][1]
+        self.assertIsNotNone(statements._lazy)
+
+        statement = statements['parts'][1]
+        self.assertIsNone(statements._lazy)
+        self.assertIsNotNone(statements['parts'][0]._lazy)
+        # (with the comments & whitespace after it)
+        self.assertEquals(output(statement),
+                          PHP[PHP.index('if'):PHP.index('for')])
+
+    def testDumpsLoads(self):
+        tree = PHP_BLOCK.parse(PHP)[1]
+        loaded = loads(dumps(tree, PHP_BLOCK), PHP_BLOCK)
+        self.assertIsInstance(loaded, LazyNode)
+        self.assertEquals(shape(loaded), shape(tree))
+        with self.assertRaises(ValueError):
+            loads(b'not a tree' * 10, PHP_BLOCK)
+
+    def testOtherGrammar(self):
+        save(PHP_BLOCK.parse(PHP)[1], PHP_BLOCK, self.filename)
+        with self.assertRaises(ValueError):
+            load(self.filename, Multiple(Word(LETTERS)))
+
+        with open(self.filename, 'wb') as tree_file:
+            tree_file.write(b'not a tree, really' * 10)
+        with self.assertRaises(ValueError):
+            load(self.filename, PHP_BLOCK)
+
+
+class TestColumns(PCTestCase):
+    def testSpans(self):
+        tree = PHP_BLOCK.parse(PHP)[1]
+        table = columns(tree, PHP_BLOCK)
+        self.assertEquals(len(table), len(spans(tree)))
+        self.assertEquals([(node['class'], start, end)
+                           for node, start, end in spans(tree)],
+                          [(table.parser(row), table.start[row], table.end[row])
+                           for row in range(len(table))])
+
+    def testParents(self):
+        WORD = Word(LETTERS)
+        P = Multiple(Joined(WORD, Optional(Trivia(Word(' ')).around(','))))
+        table = columns(P.parse('ab, c,d')[1], P, position=10)
+
+        # Multiple, then (Joined, ab , ' ') (Joined, c ,) (Joined, d Nothing)
+        self.assertEquals(list(table.parent), [-1, 0, 1, 1, 1, 0, 5, 5,
+                                               0, 8, 8])
+        self.assertEquals(list(table.depth), [0, 1, 2, 2, 2, 1, 2, 2,
+                                              1, 2, 2])
+        self.assertEquals(list(table.start), [10, 10, 10, 12, 13, 14, 14, 15,
+                                              16, 16, 17])
+        self.assertEquals(table.rows(WORD), [2, 6, 9])
+        self.assertEquals(table.rule.itemsize, array('i').itemsize)
@@ -9,6 +9,10 @@
 # pylint: disable=no-self-use, wildcard-import
 
 from unittest import TestCase
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+import sys
+
 from test import PCTestCase
 
 from pc import *
@@ -102,8 +106,9 @@ class TestOperator(PCTestCase):
         self.assertReadsFully(OPERATOR, '===')
         self.assertReadsFully(OPERATOR, '==')
         self.assertReadsFully(OPERATOR, '=')
-        # TODO
-        pass
+        self.assertReadsFully(OPERATOR, '<<')
+        self.assertReadsFully(OPERATOR, '>>')
+        self.assertReadsFully(OPERATOR, '<')
     def testBad(self):
         # TODO
         pass
@@ -190,6 +195,16 @@ class TestCommentsOrWhiteSpace(PCTestCase):
         self.assertHasRead(p, len(text))
         self.assertOutputs(p, text)
 
+    def testSameAsMultiple(self):
+        plain = Multiple(Either(WHITESPACE, COMMENT))
+        for text in ('', 'x', ' x', '/x', '/* x */x', '// a\n\t/**/ /* b',
+                     '\n /* a */\n // b\n  '):
+            for position in (0, 1):
+                expected = plain.parse(text, position)
+                length, got = COMMENTS_OR_WHITESPACE.parse(text, position)
+                self.assertEquals(length, expected[0])
+                self.assertEquals(got['parts'], expected[1]['parts'])
+
 
 
 ########################################
@@ -212,6 +227,15 @@ class TestThing(PCTestCase):
         # TODO
         pass
 
+    def testKeywords(self):
+        for keyword in ('if', 'else', 'foreach', 'as', 'return'):
+            with self.assertRaises(NotHere):
+                CONST.parse(keyword)
+        for word in ('iffy', 'elsewhere', 'format', 'as_', 'CONST'):
+            self.assertReadsFully(CONST, word)
+        # (a CONST's node is just the WORD)
+        self.assertIs(CONST.parse('CONST')[1]['class'], WORD)
+
 class TestFuncApp(PCTestCase):
     def testGood(self):
         text = 'blah($s)'
@@ -241,6 +265,14 @@ class TestFuncApp(PCTestCase):
         self.assertReadsFully(FUNC_APP, '''foo(bar(), baz(FIBBLE, $teapot),
                                            $apricot)''')
 
+    def testManyArguments(self):
+        text = 'blah(%s)' % ', '.join(['$x'] * 500)
+        self.assertReadsFully(FUNC_APP, text)
+
+        length, b = FUNC_APP.parse(text)
+        arguments = b['parts'][2]['parts']
+        self.assertEquals(len(arguments), 999)
+
 class TestInfixed(PCTestCase):
     def testGood(self):
         self.assertReadsFully(INFIXED, '2 + 21')
@@ -374,3 +406,253 @@ class TestPHPEcho(PCTestCase):
 
         for t in things:
             self.assertReadsFully(PHP_BLOCK, t)
+
+class TestPHPRecover(PCTestCase):
+    def testErrors(self):
+        text = '''<?php
+            $x = 1;
+            $y = ;
+            if ($x) { $z = = 2; echo "a;}"; }
+            foo bar { baz; }
+            $w = 3;
+            ?>'''
+        session = Session(text, recover=True)
+        length, tree = session.parse(PHP_BLOCK)
+        self.assertEquals(length, len(text))
+        self.assertEquals(output(tree), text)
+
+        self.assertEquals([(e.line, e.column) for e in session.errors],
+                          [(3, 18), (4, 28), (5, 13)])
+        self.assertEquals([text[start:end] for node, start, end in spans(tree)
+                           if 'error' in node],
+                          ['$y = ;', '$z = = 2;', 'foo bar { baz; }'])
+
+        # (and the statements either side are all still there)
+        self.assertEquals(len([node for node, _, _ in spans(tree)
+                               if node['class'] is PHP_LINE]), 3)
+
+    def testStrayCloser(self):
+        for text in ('<?php $x = 1; } $y = 2; ?>', '<?php $x = 1; ) $y = 2; ?>'):
+            session = Session(text, recover=True)
+            self.assertHasRead(session.parse(PHP_BLOCK), len(text))
+            self.assertEquals([(e.line, e.column) for e in session.errors],
+                              [(1, 15)])
+
+    def testUnclosed(self):
+        # (an unclosed bracket doesn't swallow the rest of the file)
+        text = '<?php $x = (1; ?>\n<p>hi</p>\n<?php $y = 2; ?>\n<b>x</b>'
+        session = Session(text, recover=True)
+        length, tree = session.parse(PHP_FILE)
+        self.assertEquals(length, len(text))
+        self.assertEquals([part['class'] for part in tree['parts']],
+                          [PHP_BLOCK, HTML, PHP_BLOCK, HTML])
+        self.assertEquals([text[start:end] for node, start, end in spans(tree)
+                           if 'error' in node], ['$x = (1; '])
+
+    def testNoErrors(self):
+        text = '<?php $x = 1; if ($x) { echo $x; } ?>'
+        session = Session(text, recover=True)
+        self.assertEquals(session.parse(PHP_BLOCK), PHP_BLOCK.parse(text))
+        self.assertEquals(session.errors, [])
+
+
+class TestPHPFile(PCTestCase):
+    TEMPLATE = '''<html>
+<?php $x = 1; echo "?>"; /* ?> */ ?>
+<p class="<?= $x ?>"><?=foo($x);?></p>
+<?php if ($x) { echo $x; }
+'''
+
+    def testIslands(self):
+        length, tree = PHP_FILE.parse(self.TEMPLATE)
+        self.assertEquals(length, len(self.TEMPLATE))
+        self.assertOutputs((length, tree), self.TEMPLATE)
+        self.assertEquals([part['class'] for part in tree['parts']],
+                          [HTML, PHP_BLOCK, HTML, ECHO_BLOCK, HTML,
+                           ECHO_BLOCK, HTML, PHP_BLOCK])
+        self.assertEquals(tree['parts'][2]['text'], '\n<p class="')
+
+    def testUnterminated(self):
+        self.assertReadsFully(PHP_BLOCK, '<?php $x = 1;')
+        self.assertReadsFully(PHP_BLOCK, '<?php $x = 1; // the end')
+        self.assertReadsFully(PHP_FILE, '<p><?= $x')
+        with self.assertRaises(NotHere):
+            PHP_FILE.parse('<?php $x = 1; ?')
+
+    def testHTMLOnly(self):
+        self.assertReadsFully(PHP_FILE, '<p>a < b, <? c</p>')
+
+    def testErrors(self):
+        with self.assertRaises(ParseError) as raised:
+            Session('<p>\n<?= $x = ?>').parse(PHP_FILE)
+        self.assertEquals(raised.exception.line, 2)
+
+    def testRecover(self):
+        text = '<p>\n<?= $x = ?>\n<?= $y ?><?php $z = ; ?>'
+        session = Session(text, recover=True)
+        length, tree = session.parse(PHP_FILE)
+        self.assertEquals(length, len(text))
+        self.assertEquals([part['class'] for part in tree['parts']],
+                          [HTML, ISLAND_RESYNC, HTML, ECHO_BLOCK, PHP_BLOCK])
+        self.assertEquals(output(tree['parts'][1]), '<?= $x = ?>')
+        self.assertEquals([(err.line, err.column) for err in session.errors],
+                          [(2, 10), (3, 21)])
+
+    def testParallel(self):
+        pool = Pool(2)
+        try:
+            text = (self.TEMPLATE + '?>') * 3
+            serial = PHP_FILE.parse(text)
+            length, tree = parse_file(text, pool)
+            self.assertEquals(length, len(text))
+            self.assertEquals([(n['class'], s, e) for n, s, e in spans(tree)],
+                              [(n['class'], s, e)
+                               for n, s, e in spans(serial[1])])
+
+            # (where the blocks aren't where they were guessed to be, or
+            #  don't parse, it's all parsed the usual way)
+            odd = '<?php echo "a\\"; ?>"; ?>'
+            self.assertEquals(parse_file(odd, pool)[0], len(odd))
+            with self.assertRaises(NotHere):
+                parse_file('<?php $x = ; ?>', pool)
+        finally:
+            pool.terminate()
+            pool.join()
+
+        self.assertEquals(parse_file(self.TEMPLATE), PHP_FILE.parse(
+            self.TEMPLATE))
+
+class TestPHPLazy(PCTestCase):
+    TEXT = '''<?php
+        $x = 1; // comment {
+        if ($x == 2) { echo "}"; /* } */ } else { $y = foo($x, '{', 3); }
+        /* block */ for ($i = 0; $i < 10; $i++) { if ($i) { print $i; } }
+        while ($x) // {
+            { $x--; } ?>'''
+
+    def testScan(self):
+        self.assertEquals(scan_block(' { a { b } } c', 0), 13)
+        self.assertEquals(scan_block('{ "}" // }\n }', 0), 13)
+        with self.assertRaises(NotHere):
+            scan_block('x { }', 0)
+        with self.assertRaises(NotHere):
+            scan_block('{ /* } */', 0)
+
+    def testSameTree(self):
+        eager = PHP_BLOCK.parse(self.TEXT)
+        lazy = Session(self.TEXT, lazy=True).parse(PHP_BLOCK)
+        self.assertEquals(lazy[0], len(self.TEXT))
+        self.assertEquals(list(spans(lazy[1])), list(spans(eager[1])))
+        self.assertEquals(lazy, eager)
+
+    def testDeferred(self):
+        tree = Session(self.TEXT, lazy=True).parse(PHP_BLOCK)[1]
+        statements = tree['parts'][1]['parts']
+        block = statements[1]['parts'][0]['parts'][2]
+        self.assertIsInstance(block, UnparsedNode)
+        self.assertIs(block['class'], BLOCK)
+        self.assertEquals(output(block), '{ echo "}"; /* } */ } ')
+
+        with self.assertRaises(ParseError):
+            output(Session('<?php if ($x) { $x = ; } ?>',
+                           lazy=True).parse(PHP_BLOCK)[1])
+
+class TestPHPMatch(PCTestCase):
+    def testMatch(self):
+        text = '''<?php
+            $x = 1; // comment
+            if ($x == 2) { echo "hi"; } else { $y = foo($x, $z, 3); }
+            /* block */ for ($i = 0; $i < 10; $i++) { print $i; }
+            ?>'''
+        self.assertEquals(PHP_BLOCK.match(text), len(text))
+        self.assertEquals(PHP_BLOCK.match(text), PHP_BLOCK.parse(text)[0])
+
+        with self.assertRaises(NotHere):
+            PHP_BLOCK.match('<?php $x = ; ?>')
+
+class TestPHPSpans(PCTestCase):
+    def testSpans(self):
+        text = '<?php\n  $x = 1; // one\n  if ($x) { echo "hi"; }\n?>'
+        length, p = PHP_BLOCK.parse(text)
+
+        lines = LineIndex(text)
+        found = spans(p)
+        for node, start, end in found:
+            if 'text' in node:
+                self.assertEquals(text[start:end], node['text'])
+
+        echo = [start for node, start, end in found
+                if node.get('text') == 'echo']
+        self.assertEquals([lines.location(start) for start in echo], [(3, 13)])
+
+class TestPHPErrors(PCTestCase):
+    def testMissingValue(self):
+        text = '<?php\n  echo "hi";\n  $x = ;\n?>'
+        with self.assertRaises(ParseError) as raised:
+            Session(text).parse(PHP_BLOCK)
+
+        self.assertEquals((raised.exception.line, raised.exception.column),
+                          (3, 8))
+
+    def testMissingSemicolon(self):
+        text = '<?php if ($x) {\n  echo "x" }\n?>'
+        with self.assertRaises(ParseError) as raised:
+            Session(text).parse(PHP_BLOCK)
+
+        self.assertEquals((raised.exception.line, raised.exception.column),
+                          (2, 12))
+        self.assertIn(SEMICOLON, raised.exception.expected)
+
+
+class TestPHPBudget(PCTestCase):
+    def testDeepBrackets(self):
+        text = '<?php $x = ' + '(' * 20 + '1' + ')' * 20 + '; ?>'
+        with self.assertRaises(BudgetExceeded) as raised:
+            Session(text, max_steps=10000).parse(PHP_BLOCK)
+        self.assertTrue(raised.exception.position > len('<?php $x = '))
+
+
+class TestPHPThreads(PCTestCase):
+    ''' the module level grammar objects are shared by every thread. '''
+
+    texts = [
+        '<?php echo "hi"; ?>',
+        '<?php $x = foo($a, bar($b + 2), "c") + 21; ?>',
+        '<?php if($x == 21) { echo "hi"; } else { echo (1 + (2 + 3)); } ?>',
+        '''<?php for($x=0;$x<200;$x++) {
+                echo $x; } ?>''',
+        '<?php foreach ($xs as $k => $v) { $total .= $k + $v; } ?>',
+        '<?php $x = ; ?>',
+        ]
+
+    def setUp(self):
+        # switch threads as often as possible, to give races a chance:
+        if hasattr(sys, 'setswitchinterval'):
+            self.interval = sys.getswitchinterval()
+            sys.setswitchinterval(1e-6)
+        else:
+            self.interval = sys.getcheckinterval()
+            sys.setcheckinterval(1)
+
+    def tearDown(self):
+        if hasattr(sys, 'setswitchinterval'):
+            sys.setswitchinterval(self.interval)
+        else:
+            sys.setcheckinterval(self.interval)
+
+    def parse(self, text):
+        try:
+            return PHP_BLOCK.parse(text)
+        except NotHere:
+            return None
+
+    def testConcurrentParses(self):
+        expected = [self.parse(text) for text in self.texts]
+        pool = ThreadPool(8)
+        try:
+            results = pool.map(self.parse, self.texts * 50, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+
+        self.assertEquals(results, expected * 50)